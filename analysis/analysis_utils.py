@@ -7,16 +7,33 @@ import numpy as np
 import mpmath
 import time
 import multiprocessing as mp
-import csv
+import concurrent.futures
 import astropy.coordinates as astroCoords
 import astropy.units as u
 import heapq
 from kbmodpy import kbmod as kb
 from astropy.io import fits
 from astropy.wcs import WCS
-from sklearn.cluster import DBSCAN
+from scipy.spatial import cKDTree
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
 from skimage import measure
 from collections import OrderedDict
+from multiprocessing import shared_memory
+
+def _map_shared_rows(func, shm_name, shape, dtype, start, stop):
+    """
+    Worker side of PostProcess.map_rows(). Attaches to the shared memory block
+    holding the array and applies func to rows start:stop of it.
+    """
+    shm = shared_memory.SharedMemory(name=shm_name)
+    try:
+        rows = np.ndarray(shape, dtype=dtype, buffer=shm.buf)[start:stop]
+        result = func(rows)
+        del rows
+    finally:
+        shm.close()
+    return(result)
 
 class SharedTools():
     """
@@ -172,7 +189,12 @@ class Interface(SharedTools):
     def save_results(self, res_filepath, out_suffix, keep):
         """
         This function saves results from a given search method (either region
-        search or grid search)
+        search or grid search) to a single uncompressed numpy bundle,
+        results_<out_suffix>.npz. Every value is stored under its own key so
+        it can be read lazily with np.load(). The trajectories are split into
+        the typed columns 'lh', 'flux', 'x', 'y', 'vx', 'vy' and 'num_obs'.
+        Rows of unequal length, like 'lc_index' and 'times', are stored flat
+        with a '<key>_offsets' array holding where each row starts and ends.
         INPUT-
             res_filepath : string
             out_suffix : string
@@ -186,35 +208,54 @@ class Interface(SharedTools):
         print('---------------------------------------')
         print("Saving Results")
         print('---------------------------------------', flush=True)
-        np.savetxt('%s/results_%s.txt' % (res_filepath, out_suffix),
-                   np.array(keep['results'])[keep['final_results']], fmt='%s')
-        with open('%s/lc_%s.txt' % (res_filepath, out_suffix), 'w') as f:
-            writer = csv.writer(f)
-            writer.writerows(np.array(keep['lc'])[keep['final_results']])
-        with open('%s/psi_%s.txt' % (res_filepath, out_suffix), 'w') as f:
-            writer = csv.writer(f)
-            writer.writerows(
-                np.array(keep['psi_curves'])[keep['final_results']])
-        with open('%s/phi_%s.txt' % (res_filepath, out_suffix), 'w') as f:
-            writer = csv.writer(f)
-            writer.writerows(
-                np.array(keep['phi_curves'])[keep['final_results']])
-        with open('%s/lc_index_%s.txt' % (res_filepath, out_suffix), 'w') as f:
-            writer = csv.writer(f)
-            writer.writerows(np.array(keep['lc_index'])[keep['final_results']])
-        with open('%s/times_%s.txt' % (res_filepath, out_suffix), 'w') as f:
-            writer = csv.writer(f)
-            writer.writerows(np.array(keep['times'])[keep['final_results']])
-        np.savetxt(
-            '%s/filtered_likes_%s.txt' % (res_filepath, out_suffix),
-            np.array(keep['new_lh'])[keep['final_results']], fmt='%.4f')
-        np.savetxt(
-            '%s/ps_%s.txt' % (res_filepath, out_suffix),
-            np.array(keep['stamps'])[keep['final_results']].reshape(
-                len(np.array(keep['stamps'])[keep['final_results']]), 441), fmt='%.4f')
-        stamps_to_save = np.array(keep['all_stamps'])
-        np.save(
-            '%s/all_ps_%s.npy' % (res_filepath, out_suffix), stamps_to_save)
+        final_results = np.asarray(keep['final_results'], dtype=int)
+        traj = kb.trajectories_to_array(
+            [keep['results'][i] for i in final_results])
+        bundle = OrderedDict([
+            ('lh', traj['lh']), ('flux', traj['flux']), ('x', traj['x']),
+            ('y', traj['y']), ('vx', traj['x_v']), ('vy', traj['y_v']),
+            ('num_obs', traj['obs_count'])])
+        # Bundle key for each per-result value of keep
+        bundle_keys = [
+            ('lc', 'lc'), ('psi_curves', 'psi'), ('phi_curves', 'phi'),
+            ('lc_index', 'lc_index'), ('times', 'times'),
+            ('new_lh', 'filtered_likes'), ('stamps', 'ps')]
+        for keep_key, bundle_key in bundle_keys:
+            rows = keep.get(keep_key, [])
+            # Skip values this search did not compute. With no results
+            # every key is written, empty, so the bundle still loads
+            if len(rows) == 0 and len(final_results) > 0:
+                continue
+            values, offsets = self._pack_rows(rows, final_results)
+            bundle[bundle_key] = values
+            if offsets is not None:
+                bundle[bundle_key+'_offsets'] = offsets
+        if len(keep.get('all_stamps', [])) > 0:
+            # Already in the order of final_results
+            bundle['all_ps'] = np.array(keep['all_stamps'])
+        np.savez('%s/results_%s.npz' % (res_filepath, out_suffix), **bundle)
+
+    def _pack_rows(self, rows, order):
+        """
+        Stack rows[order] into one array. When the rows differ in length they
+        are concatenated instead and the offsets of each row are returned too.
+        """
+        if len(rows) == 0 or np.ndim(rows[0]) == 0:
+            return(np.asarray(rows)[order], None)
+        lengths = np.fromiter(map(len, rows), dtype=np.int64, count=len(rows))
+        values = np.concatenate(rows)
+        if (lengths == lengths[0]).all():
+            values = values.reshape((len(rows),)+np.shape(rows[0]))
+            return(values[order], None)
+        starts = np.zeros(len(rows), dtype=np.int64)
+        np.cumsum(lengths[:-1], out=starts[1:])
+        lengths = lengths[order]
+        offsets = np.zeros(len(lengths)+1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        # Position of every kept value in the concatenated rows
+        index = np.arange(offsets[-1]) + np.repeat(
+            starts[order]-offsets[:-1], lengths)
+        return(values[index], offsets)
 
     def _calc_ecliptic_angle(self, test_wcs, angle_to_ecliptic=0.):
         """
@@ -280,8 +321,89 @@ class PostProcess(SharedTools):
         self.coeff = None
         self.num_cores = config['num_cores']
         self.sigmaG_lims = config['sigmaG_lims']
+        self.pool_type = config.get('pool_type', 'process')
+        if self.pool_type not in ['process', 'thread']:
+            raise ValueError('pool_type must be process or thread')
+        self._executor = None
+        return
+
+    def __enter__(self):
+        return(self)
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.shutdown()
+        return(False)
+
+    def __getstate__(self):
+        # Bound methods are pickled to process workers without the executor
+        state = self.__dict__.copy()
+        state['_executor'] = None
+        return(state)
+
+    def get_executor(self):
+        """
+        Return the worker pool shared by every PostProcess stage, creating it
+        on first use. It is a process pool or a thread pool depending on
+        config['pool_type'], with config['num_cores'] workers.
+        """
+        if self._executor is None:
+            if self.pool_type == 'thread':
+                self._executor = concurrent.futures.ThreadPoolExecutor(
+                    max_workers=self.num_cores)
+            else:
+                self._executor = concurrent.futures.ProcessPoolExecutor(
+                    max_workers=self.num_cores)
+        return(self._executor)
+
+    def shutdown(self):
+        """
+        Shut down the worker pool. A new one is created if another stage
+        needs it.
+        """
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
         return
 
+    def map_rows(self, func, array):
+        """
+        Apply func to blocks of rows of array on the worker pool and return
+        the concatenated results in row order. Process workers read the array
+        from shared memory rather than receiving a pickled copy.
+        INPUT-
+            func : callable
+                Takes a block of rows and returns a list with one value per
+                row. Must be picklable for a process pool.
+            array : numpy array
+                The array to process, split along its first axis.
+        OUTPUT-
+            results : list
+                The values returned by func for every row.
+        """
+        array = np.ascontiguousarray(array)
+        num_rows = len(array)
+        if num_rows == 0:
+            return([])
+        executor = self.get_executor()
+        bounds = np.linspace(
+            0, num_rows, min(self.num_cores, num_rows)+1).astype(int)
+        if self.pool_type == 'thread':
+            futures = [executor.submit(func, array[start:stop])
+                       for start, stop in zip(bounds[:-1], bounds[1:])]
+            return([val for f in futures for val in f.result()])
+        shm = shared_memory.SharedMemory(create=True, size=array.nbytes)
+        try:
+            np.ndarray(array.shape, dtype=array.dtype, buffer=shm.buf)[:] = array
+            futures = [
+                executor.submit(_map_shared_rows, func, shm.name, array.shape,
+                                array.dtype, start, stop)
+                for start, stop in zip(bounds[:-1], bounds[1:])]
+            results = [val for f in futures for val in f.result()]
+        finally:
+            shm.close()
+            shm.unlink()
+        return(results)
+
     def apply_mask(self, stack, mask_num_images=2, mask_threshold=120.):
         """
         This function applys a mask to the images in a KBMOD stack. This mask
@@ -327,7 +449,7 @@ class PostProcess(SharedTools):
         This function loads results that are output by the gpu grid search.
         Results are loaded in chunks and evaluated to see if the minimum
         likelihood level has been reached. If not, another chunk of results is
-        fetched.
+        fetched. Only the results that pass filtering are kept.
         INPUT-
             search : kbmod search object
             image_params : dictionary
@@ -353,63 +475,179 @@ class PostProcess(SharedTools):
                 'results'. It is a standard results dictionary generated by
                 self.gen_results_dict().
         """
+        keep = self.gen_results_dict()
+        res_num = 0
+        for res_num, chunk_keep in self.iter_filtered_chunks(
+            search, image_params, lh_level, filter_type, chunk_size, max_lh):
+            self._extend_keep(keep, chunk_keep)
+        print('Keeping {} of {} total results'.format(
+            np.shape(keep['psi_curves'])[0], res_num), flush=True)
+        return(keep)
+
+    def stream_results(
+        self, search, image_params, lh_level, filter_type='clipped_sigmaG',
+        chunk_size=500000, max_lh=1e9, center_thresh=0.03,
+        peak_offset=[2., 2.], mom_lims=[35.5, 35.5, 1., .25, .25]):
+        """
+        This function runs load_results(), get_coadd_stamps() and
+        apply_stamp_filter() as one pipeline. Each chunk of results flows
+        through light curve filtering and stamp filtering before the next is
+        fetched, so only the results that pass both are ever held and memory
+        does not grow with the number of results scanned.
+        INPUT-
+            search : kbmod search object
+            image_params : dictionary
+                Contains the following image parameters:
+                Julian day, x size of the images, y size of the images,
+                ecliptic angle of the images.
+            lh_level : float
+                The minimum likelihood theshold for an acceptable result.
+            filter_type : string
+                The type of initial filtering to apply, as in load_results().
+            chunk_size : int
+                The number of results to load at a given time from search.
+            max_lh : float
+                The maximum likelihood threshold for an acceptable results.
+            center_thresh, peak_offset, mom_lims :
+                The stamp filter settings, as in apply_stamp_filter().
+        OUTPUT-
+            keep : dictionary
+                The results that passed, with their coadded 'stamps' and
+                'final_results' sorted by new likelihood as set by
+                apply_stamp_filter().
+        """
+        keep = self.gen_results_dict()
+        res_num = 0
+        chunks = self.iter_filtered_chunks(
+            search, image_params, lh_level, filter_type, chunk_size, max_lh)
+        for res_num, chunk_keep in self.iter_stamp_filtered(
+            chunks, search, center_thresh, peak_offset, mom_lims):
+            self._extend_keep(keep, chunk_keep)
+        keep['final_results'] = np.argsort(np.array(keep['new_lh']))[::-1]
+        print('Keeping {} of {} total results'.format(
+            len(keep['results']), res_num), flush=True)
+        return(keep)
+
+    def iter_filtered_chunks(
+        self, search, image_params, lh_level, filter_type='clipped_sigmaG',
+        chunk_size=500000, max_lh=1e9):
+        """
+        This generator fetches the search results chunk by chunk, filters
+        their light curves and yields the survivors of each chunk. It stops
+        after the first chunk that reaches lh_level.
+        INPUT-
+            See load_results().
+        OUTPUT-
+            res_num : int
+                The number of results scanned so far.
+            chunk_keep : dictionary
+                The results of the chunk that passed, in the format of
+                self.gen_results_dict(). 'results' holds records of the
+                structured kb.trajectory_dtype array.
+        """
         if filter_type=='clipped_sigmaG':
             filter_func = self.apply_clipped_sigmaG
         elif filter_type=='clipped_average':
             filter_func = self.apply_clipped_average
         elif filter_type=='kalman':
             filter_func = self.apply_kalman_filter
-        keep = self.gen_results_dict() 
-        tmp_results = self.gen_results_dict()
         likelihood_limit = False
         res_num = 0
-        psi_curves = []
-        phi_curves = []
-        all_results = []
         print('---------------------------------------')
         print("Retrieving Results")
         print('---------------------------------------')
         while likelihood_limit is False:
             print('Getting results...')
-            tmp_psi_curves = []
-            tmp_phi_curves = []
-            results = search.get_results(res_num, chunk_size)
+            results_arr = search.get_results_array(res_num, chunk_size)
+            if len(results_arr) == 0:
+                # Suppression can leave fewer results than one chunk
+                break
+            if len(results_arr) < chunk_size:
+                likelihood_limit = True
             print('---------------------------------------')
             chunk_headers = ("Chunk Start", "Chunk Max Likelihood",
                              "Chunk Min. Likelihood")
-            chunk_values = (res_num, results[0].lh, results[-1].lh)
+            chunk_values = (res_num, results_arr['lh'][0],
+                            results_arr['lh'][-1])
             for header, val, in zip(chunk_headers, chunk_values):
-                if type(val) == np.int:
+                if type(val) == int:
                     print('%s = %i' % (header, val))
                 else:
                     print('%s = %.2f' % (header, val))
             print('---------------------------------------')
-            # Find the size of the psi phi curves and preallocate arrays
-            foo_psi,_=search.lightcurve(results[0])
-            curve_len = len(foo_psi.flatten())
-            curve_shape = [len(results),curve_len]
-            for i,line in enumerate(results):
-                if line.lh < max_lh:
-                    curve_index = i+res_num
-                    psi_curve, phi_curve = search.lightcurve(line)
-                    tmp_psi_curves.append(psi_curve)
-                    tmp_phi_curves.append(phi_curve)
-                    all_results.append(line)
-                    if line.lh < lh_level:
-                        likelihood_limit = True
-                        break
-            if len(tmp_psi_curves)>0:
-                tmp_results['psi_curves'] = tmp_psi_curves
-                tmp_results['phi_curves'] = tmp_phi_curves
-                tmp_results['results'] = results
+            # Keep results below max_lh, stopping after the first one
+            # below lh_level
+            lh = results_arr['lh']
+            in_range = lh < max_lh
+            below_level = np.where(in_range & (lh < lh_level))[0]
+            if len(below_level) > 0:
+                likelihood_limit = True
+                in_range[below_level[0]+1:] = False
+            rows = results_arr[in_range]
+            del(results_arr)
+            chunk_keep = self.gen_results_dict()
+            if len(rows)>0:
+                # Compute the curves for the whole chunk in one call
+                psi_curves, phi_curves = search.psi_phi_curves(rows)
+                tmp_results = {'psi_curves': psi_curves,
+                               'phi_curves': phi_curves, 'results': rows,
+                               'results_array': rows}
                 keep_idx_results = filter_func(
                     tmp_results, search, image_params, lh_level)
-                keep = self.read_filter_results(
-                    keep_idx_results, keep, search, tmp_psi_curves,
-                    tmp_phi_curves, results, image_params, lh_level)
-            res_num+=chunk_size
-        print('Keeping {} of {} total results'.format(
-            np.shape(keep['psi_curves'])[0], res_num), flush=True)
+                chunk_keep = self.read_filter_results(
+                    keep_idx_results, chunk_keep, search, psi_curves,
+                    phi_curves, rows, image_params, lh_level)
+            res_num+=len(lh)
+            yield res_num, chunk_keep
+
+    def iter_stamp_filtered(
+        self, chunks, search, center_thresh=0.03, peak_offset=[2., 2.],
+        mom_lims=[35.5, 35.5, 1., .25, .25]):
+        """
+        This generator coadds the stamps of each chunk yielded by
+        iter_filtered_chunks() and yields only the results whose stamps pass
+        the tests of apply_stamp_filter().
+        INPUT-
+            chunks : generator
+                Yields (res_num, chunk_keep) as iter_filtered_chunks() does.
+            search : kbmod search object
+            center_thresh, peak_offset, mom_lims :
+                The stamp filter settings, as in apply_stamp_filter().
+        OUTPUT-
+            res_num : int
+                The number of results scanned so far.
+            chunk_keep : dictionary
+                The results of the chunk that passed, with their 'stamps'.
+        """
+        self.center_thresh = center_thresh
+        self.peak_offset = peak_offset
+        self.mom_lims = mom_lims
+        for res_num, chunk_keep in chunks:
+            if len(chunk_keep['results']) > 0:
+                stamps = search.stacked_sci_batch(
+                    np.array(chunk_keep['results']), 10)
+                passed = np.where(np.array(self.map_rows(
+                    self._stamp_filter_rows, stamps)) == 1)[0]
+                for key in ['results', 'new_lh', 'lc', 'lc_index',
+                            'psi_curves', 'phi_curves', 'times']:
+                    chunk_keep[key] = [chunk_keep[key][i] for i in passed]
+                chunk_keep['stamps'] = list(stamps[passed])
+                print('Keeping {} results after stamp filtering'.format(
+                    len(passed)), flush=True)
+            yield res_num, chunk_keep
+
+    def _extend_keep(self, keep, chunk_keep):
+        """
+        Append the results of one chunk to keep, turning the trajectory
+        records into kbmod trajectory objects.
+        """
+        for key, values in chunk_keep.items():
+            if key == 'results':
+                if len(values) > 0:
+                    keep[key].extend(
+                        kb.array_to_trajectories(np.array(values)))
+            elif key != 'final_results':
+                keep[key].extend(values)
         return(keep)
 
     def read_filter_results(
@@ -492,14 +730,10 @@ class PostProcess(SharedTools):
                 'results'. These are populated in Interface.load_results().
         """
         start = time.time()
-        for i,result in enumerate(keep['results']):
-            #stamps = search.sci_stamps(result, 10)
-            #stamp_arr = np.array(
-            #    [np.array(stamps[s_idx]) for s_idx in keep['lc_index'][i]])
-            stamps = np.array(search.stacked_sci(result, 10))
-            #stamps[np.isnan(stamps)]=0
-            #keep['stamps'].append(np.sum(stamp_arr, axis=0))
-            keep['stamps'].append(stamps)
+        if len(keep['results']) > 0:
+            stamps = search.stacked_sci_batch(
+                kb.trajectories_to_array(keep['results']), 10)
+            keep['stamps'].extend(list(stamps))
         print('Loaded coadded stamps. {:.3f}s elapsed'.format(
             time.time()-start), flush=True)
         return(keep)
@@ -520,11 +754,11 @@ class PostProcess(SharedTools):
                 'results'. These are populated in Interface.load_results().
         """
         final_results = keep['final_results']
-        for result in np.array(keep['results'])[final_results]:
-            stamps = search.sci_stamps(result, 10)
-            all_stamps = np.array(
-                [np.array(stamp).reshape(21,21) for stamp in stamps])
-            keep['all_stamps'].append(all_stamps)
+        final = np.array(keep['results'])[final_results]
+        if len(final) > 0:
+            all_stamps = search.sci_stamps_batch(
+                kb.trajectories_to_array(final), 10)
+            keep['all_stamps'].extend(list(all_stamps))
         return(keep)
 
     def apply_clipped_sigmaG(
@@ -566,17 +800,16 @@ class PostProcess(SharedTools):
             else:
                 self.percentiles = [25,75]
             self.coeff = self._find_sigmaG_coeff(self.percentiles)
-        print('Starting pooling...')
-        pool = mp.Pool(processes=self.num_cores)
-        num_curves = len(psi_curves)
-        index_list = [j for j in range(num_curves)]
-        zipped_curves = zip(
-            psi_curves, phi_curves, index_list)
-        keep_idx_results = pool.starmap_async(
-            self._clipped_sigmaG, zipped_curves)
-        pool.close()
-        pool.join()
-        keep_idx_results = keep_idx_results.get()
+        if 'results_array' in old_results:
+            # Clip in the search itself, on the curves already read
+            keep_mask, new_lh = search.sigmag_filter(
+                psi_curves, phi_curves, self.percentiles[0],
+                self.percentiles[1], self.coeff,
+                flux=(filter_type=='flux'))
+            keep_idx_results = self._sigmaG_results(keep_mask, new_lh)
+        else:
+            keep_idx_results = self._batch_clipped_sigmaG(
+                psi_curves, phi_curves)
         end_time = time.time()
         time_elapsed = end_time-start_time
         print('{:.2f}s elapsed'.format(time_elapsed))
@@ -617,15 +850,7 @@ class PostProcess(SharedTools):
         results = old_results['results']
         keep = self.gen_results_dict()
 
-        print('Starting pooling...')
-        pool = mp.Pool(processes=self.num_cores)
-        zipped_curves = zip(
-            psi_curves, phi_curves, [j for j in range(len(psi_curves))])
-        keep_idx_results = pool.starmap_async(
-            self._clipped_average, zipped_curves)
-        pool.close()
-        pool.join()
-        keep_idx_results = keep_idx_results.get()
+        keep_idx_results = self._batch_clipped_average(psi_curves, phi_curves)
         end_time = time.time()
         time_elapsed = end_time-start_time
         print('{:.2f}s elapsed'.format(time_elapsed))
@@ -777,6 +1002,139 @@ class PostProcess(SharedTools):
                 psi_curve[max_lh_index], phi_curve[max_lh_index])
             return(index,max_lh_index,new_lh)
 
+    def _batch_clipped_sigmaG(self, psi_curves, phi_curves, n_sigma=2):
+        """
+        This function applies the same filter as _clipped_sigmaG() to every
+        row of a matrix of curves at once.
+        INPUT-
+            psi_curves : numpy array
+                A (N, n_images) matrix of Psi curves, such as those loaded in
+                from Interface.load_results().
+            phi_curves : numpy array
+                The matching (N, n_images) matrix of Phi curves.
+            n_sigma : integer
+                The number of standard deviations away from the median that
+                the largest likelihood values (N=num_clipped) must be in order
+                to be eliminated.
+        OUTPUT-
+            keep_idx_results : list
+                list of tuples containing the index of a results, the
+                indices of the passing values in the lightcurve, and the
+                new likelihood for the lightcurve, as returned by
+                _clipped_sigmaG().
+        """
+        masked_phi = np.copy(phi_curves)
+        masked_phi[masked_phi==0] = 1e9
+        if self.lc_filter_type=='flux':
+            lh = psi_curves/masked_phi
+        else:
+            if self.lc_filter_type!='lh':
+                print('Invalid filter type, defaulting to likelihood',
+                      flush=True)
+            lh = psi_curves/np.sqrt(masked_phi)
+        lower_per, median, upper_per = np.percentile(
+            lh, [self.percentiles[0], 50, self.percentiles[1]], axis=1)
+        sigmaG = self.coeff*(upper_per-lower_per)
+        nSigmaG = n_sigma*sigmaG
+        good = np.logical_and(lh > (median-nSigmaG)[:, np.newaxis],
+                              lh < (median+nSigmaG)[:, np.newaxis])
+        new_lh = self._batch_compute_lh(psi_curves, phi_curves, good)
+        return(self._sigmaG_results(good, new_lh))
+
+    def _sigmaG_results(self, good, new_lh):
+        """
+        This function converts the kept-epoch masks and likelihoods of
+        sigmaG filtering to the format returned by _clipped_sigmaG().
+        INPUT-
+            good : numpy array
+                A (N, n_images) boolean matrix of the kept epochs.
+            new_lh : numpy array
+                The new likelihood of each row.
+        OUTPUT-
+            keep_idx_results : list
+                list of tuples containing the index of a results, the
+                indices of the passing values in the lightcurve, and the
+                new likelihood for the lightcurve.
+        """
+        keep_idx_results = []
+        for index, good_index in enumerate(self._mask_to_indices(good)):
+            if len(good_index)==0:
+                keep_idx_results.append((index, [-1], 0))
+            else:
+                keep_idx_results.append((index, good_index, new_lh[index]))
+        return(keep_idx_results)
+
+    def _batch_clipped_average(
+        self, psi_curves, phi_curves, num_clipped=5, n_sigma=4,
+        lower_lh_limit=-100):
+        """
+        This function applies the same filter as _clipped_average() to every
+        row of a matrix of curves at once.
+        INPUT-
+            psi_curves : numpy array
+                A (N, n_images) matrix of Psi curves, such as those loaded in
+                from Interface.load_results().
+            phi_curves : numpy array
+                The matching (N, n_images) matrix of Phi curves.
+            num_clipped : integer
+                The number of likelihood values to consider eliminating. Only
+                considers the largest N=num_clipped values.
+            n_sigma : integer
+                The number of standard deviations away from the median that
+                the largest likelihood values (N=num_clipped) must be in order
+                to be eliminated.
+            lower_lh_limit : float
+                Likelihood values lower than lower_lh_limit are automatically
+                eliminated from consideration.
+        OUTPUT-
+            keep_idx_results : list
+                list of tuples containing the index of a results, the
+                indices of the passing values in the lightcurve, and the
+                new likelihood for the lightcurve, as returned by
+                _clipped_average().
+        """
+        masked_phi = np.copy(phi_curves)
+        masked_phi[masked_phi==0] = 1e9
+        lh = psi_curves/np.sqrt(masked_phi)
+        num_curves, curve_len = lh.shape
+        # Every value tied with one of the num_clipped largest is left out,
+        # the same as np.in1d against heapq.nlargest
+        sorted_lh = np.sort(lh, axis=1)
+        nth_largest = sorted_lh[:, curve_len-min(num_clipped, curve_len)]
+        clipped = np.logical_and(
+            lh > lower_lh_limit, lh < nth_largest[:, np.newaxis])
+        clipped_count = np.sum(clipped, axis=1)
+        # Masked median, taking the middle of each row's sorted clipped
+        # values like np.median does
+        clipped_sorted = np.sort(
+            np.where(clipped, lh, np.inf).astype(lh.dtype), axis=1)
+        rows = np.arange(num_curves)
+        low_mid = np.maximum(clipped_count-1, 0)//2
+        high_mid = clipped_count//2
+        median = (clipped_sorted[rows, low_mid] +
+                  clipped_sorted[rows, np.minimum(high_mid, curve_len-1)])/2
+        # Masked variance, as np.var
+        safe_count = np.maximum(clipped_count, 1).astype(lh.dtype)
+        mean = self._batch_masked_sum(lh, clipped)/safe_count
+        sq_dev = np.abs(lh-mean[:, np.newaxis])**2
+        sigma = np.sqrt(self._batch_masked_sum(sq_dev, clipped)/safe_count)
+        outlier = lh > (median+n_sigma*sigma)[:, np.newaxis]
+        has_outlier = np.any(outlier, axis=1)
+        upper_limit = np.where(
+            has_outlier, np.min(np.where(outlier, lh, np.inf), axis=1),
+            np.max(lh, axis=1)+1)
+        max_lh_index = np.logical_and(
+            lh > lower_lh_limit, lh < upper_limit[:, np.newaxis])
+        new_lh = self._batch_compute_lh(psi_curves, phi_curves, max_lh_index)
+        keep_idx_results = []
+        for index, good_index in enumerate(
+            self._mask_to_indices(max_lh_index)):
+            if clipped_count[index]==0:
+                keep_idx_results.append((index, [-1], 0))
+            else:
+                keep_idx_results.append((index, good_index, new_lh[index]))
+        return(keep_idx_results)
+
     def apply_kalman_filter(self, old_results, search, image_params, lh_level):
         """
         This function applies a kalman filter to the results of a KBMOD search
@@ -806,15 +1164,7 @@ class PostProcess(SharedTools):
         results = old_results['results']
         keep = self.gen_results_dict()
 
-        print('Starting pooling...')
-        pool = mp.Pool(processes=self.num_cores)
-        zipped_curves = zip(
-            psi_curves, phi_curves, [j for j in range(len(psi_curves))])
-        keep_idx_results = pool.starmap_async(
-            self._return_indices, zipped_curves)
-        pool.close()
-        pool.join()
-        keep_idx_results = keep_idx_results.get()
+        keep_idx_results = self._batch_return_indices(psi_curves, phi_curves)
         print('---------------------------------------')
         return(keep_idx_results)
 
@@ -845,13 +1195,9 @@ class PostProcess(SharedTools):
         print('---------------------------------------', flush=True)
         if len(lh_sorted_idx) > 0:
             print("Stamp filtering %i results" % len(lh_sorted_idx))
-            pool = mp.Pool(processes=self.num_cores)
-            stamp_filt_pool = pool.map_async(
-                self._stamp_filter_parallel,
+            stamp_filt_results = self.map_rows(
+                self._stamp_filter_rows,
                 np.array(keep['stamps'])[lh_sorted_idx])
-            pool.close()
-            pool.join()
-            stamp_filt_results = stamp_filt_pool.get()
             stamp_filt_idx = lh_sorted_idx[np.where(
                 np.array(stamp_filt_results) == 1)]
             if len(stamp_filt_idx) > 0:
@@ -860,7 +1206,6 @@ class PostProcess(SharedTools):
                 keep['final_results'] = []
             del(stamp_filt_results)
             del(stamp_filt_idx)
-            del(stamp_filt_pool)
         else:
             keep['final_results'] = lh_sorted_idx
         print('Keeping %i results' % len(keep['final_results']))
@@ -1004,6 +1349,199 @@ class PostProcess(SharedTools):
             new_lh = self._compute_lh(new_psi,new_phi)
             return (val_on, flux_idx[reverse_idx], new_lh)
 
+    def _batch_kalman_filter(self, obs, var):
+        """
+        This function runs _kalman_filter() over every row of a matrix at
+        once. Rows may be padded at the end, the padding does not change the
+        earlier values of a row.
+        INPUT-
+            obs : numpy array
+                A (N, length) matrix of flux values.
+            var : numpy array
+                The matching (N, length) matrix of flux variances.
+        OUTPUT-
+            xhat : numpy array
+                The kalman flux of each row
+            P : numpy array
+                The kalman error of each row
+        """
+        num_rows, length = obs.shape
+        xhat = np.zeros((num_rows, length))
+        P = np.zeros((num_rows, length))
+        Q = 1.
+
+        xhat[:, 0] = obs[:, 0]
+        P[:, 0] = var[:, 0]
+
+        for k in range(1, length):
+            xhatminus = xhat[:, k-1]
+            Pminus = P[:, k-1] + Q
+
+            K = Pminus / (Pminus + var[:, k])
+            xhat[:, k] = xhatminus + K*(obs[:, k]-xhatminus)
+            P[:, k] = (1-K)*Pminus
+        return xhat, P
+
+    def _batch_return_indices(self, psi_curves, phi_curves):
+        """
+        This function applies the same Kalman filtering as _return_indices()
+        to every row of a matrix of curves at once.
+        INPUT-
+            psi_curves : numpy array
+                A (N, n_images) matrix of Psi curves, such as those loaded in
+                from Interface.load_results().
+            phi_curves : numpy array
+                The matching (N, n_images) matrix of Phi curves.
+        OUTPUT-
+            keep_idx_results : list
+                list of tuples containing the index of a results, the
+                indices of the passing values in the lightcurve, and the
+                new likelihood for the lightcurve, as returned by
+                _return_indices().
+        """
+        masked_phi = np.copy(phi_curves)
+        masked_phi[masked_phi==0] = 1e9
+        flux_vals = psi_curves/masked_phi
+        positive = flux_vals > 0.
+        flux_count = np.sum(positive, axis=1)
+        num_curves, curve_len = flux_vals.shape
+        # Move each row's positive fluxes to the front, keeping their order,
+        # so the filter runs over the same sequence as flux_idx
+        order = np.argsort(~positive, axis=1, kind='stable')
+        valid = np.arange(curve_len)[np.newaxis, :] < flux_count[:, np.newaxis]
+        fluxes = np.take_along_axis(flux_vals, order, axis=1)
+        inv_flux = np.take_along_axis(masked_phi, order, axis=1)
+        inv_flux[inv_flux < -999.] = 9999999.
+        with np.errstate(divide='ignore', invalid='ignore'):
+            f_var = (1./inv_flux)
+        fluxes = np.where(valid, fluxes, 0).astype(flux_vals.dtype)
+        f_var = np.where(valid, f_var, 1).astype(f_var.dtype)
+        # The same values with each row's valid part reversed
+        reverse = np.maximum(
+            flux_count[:, np.newaxis]-1-np.arange(curve_len)[np.newaxis, :], 0)
+        fluxes_back = np.where(
+            valid, np.take_along_axis(fluxes, reverse, axis=1), 0)
+        f_var_back = np.where(
+            valid, np.take_along_axis(f_var, reverse, axis=1), 1)
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            ## 1st pass
+            kalman_flux, kalman_error = self._batch_kalman_filter(
+                fluxes, f_var)
+            failed = np.any(np.logical_and(valid, kalman_error < 0.), axis=1)
+            deviations = np.abs(kalman_flux - fluxes) / kalman_error**.5
+            keep_fwd = np.logical_and(valid, deviations < 5.)
+
+            ## Second Pass (reverse order in case bright object is first
+            ## datapoint)
+            kalman_flux, kalman_error = self._batch_kalman_filter(
+                fluxes_back, f_var_back)
+            failed |= np.any(
+                np.logical_and(valid, kalman_error < 0.), axis=1)
+            deviations = np.abs(kalman_flux - fluxes_back) / kalman_error**.5
+            keep_back = np.logical_and(valid, deviations < 5.)
+        failed |= flux_count < 2
+
+        use_fwd = np.sum(keep_fwd, axis=1) >= np.sum(keep_back, axis=1)
+        # Map the kept positions back to image indices
+        keep_sorted = np.where(
+            use_fwd[:, np.newaxis], keep_fwd,
+            np.logical_and(valid, np.take_along_axis(keep_back, reverse, axis=1)))
+        keep_mask = np.zeros_like(keep_sorted)
+        np.put_along_axis(keep_mask, order, keep_sorted, axis=1)
+        new_lh = self._batch_compute_lh(
+            psi_curves, phi_curves, keep_mask, reverse_rows=~use_fwd)
+        keep_idx_results = []
+        for index, keep_idx in enumerate(self._mask_to_indices(keep_mask)):
+            if failed[index]:
+                keep_idx_results.append(([], [-1], []))
+            elif use_fwd[index]:
+                keep_idx_results.append((index, keep_idx, new_lh[index]))
+            else:
+                # The reverse pass lists indices last to first
+                keep_idx_results.append(
+                    (index, keep_idx[::-1], new_lh[index]))
+        return(keep_idx_results)
+
+    def _batch_compute_lh(
+        self, psi_curves, phi_curves, keep_mask, reverse_rows=None):
+        """
+        This function computes _compute_lh() for every row of a matrix of
+        curves, using only the values selected in each row.
+        INPUT-
+            psi_curves : numpy array
+                A (N, n_images) matrix of Psi curves.
+            phi_curves : numpy array
+                The matching (N, n_images) matrix of Phi curves.
+            keep_mask : numpy array
+                A (N, n_images) boolean matrix of the values to use.
+            reverse_rows : numpy array
+                Optional boolean array of the rows whose values are summed
+                last to first.
+        OUTPUT-
+            lh : numpy array
+                The likelihood of each row.
+        """
+        psi_sum = self._batch_masked_sum(psi_curves, keep_mask, reverse_rows)
+        phi_sum = self._batch_masked_sum(phi_curves, keep_mask, reverse_rows)
+        all_zero = np.logical_not(np.any(
+            np.logical_and(keep_mask, psi_curves!=0), axis=1))
+        with np.errstate(divide='ignore', invalid='ignore'):
+            lh = psi_sum/np.sqrt(phi_sum)
+        lh[all_zero] = 0
+        return(lh)
+
+    def _batch_masked_sum(self, values, keep_mask, reverse_rows=None):
+        """
+        This function sums the selected values of every row of a matrix.
+        The kept values of each row are packed together and rows with the
+        same number of them are summed together, so every sum is the same
+        as np.sum() of that row's selected values.
+        INPUT-
+            values : numpy array
+                A (N, n_images) matrix.
+            keep_mask : numpy array
+                A (N, n_images) boolean matrix of the values to sum.
+            reverse_rows : numpy array
+                Optional boolean array of the rows whose values are summed
+                last to first.
+        OUTPUT-
+            sums : numpy array
+                The sum of each row's selected values.
+        """
+        order = np.argsort(~keep_mask, axis=1, kind='stable')
+        if reverse_rows is not None:
+            last = keep_mask.shape[1]-1
+            order_back = last-np.argsort(
+                ~keep_mask[:, ::-1], axis=1, kind='stable')
+            order = np.where(reverse_rows[:, np.newaxis], order_back, order)
+        packed = np.take_along_axis(values, order, axis=1)
+        counts = np.sum(keep_mask, axis=1)
+        sums = np.zeros(len(values), dtype=values.dtype)
+        for count in np.unique(counts):
+            if count==0:
+                continue
+            rows = counts==count
+            sums[rows] = np.sum(packed[rows, :count], axis=1)
+        return(sums)
+
+    def _mask_to_indices(self, keep_mask):
+        """
+        This function converts a boolean matrix to a list with the indices of
+        the True values in each row.
+        INPUT-
+            keep_mask : numpy array
+                A (N, n_images) boolean matrix.
+        OUTPUT-
+            indices : list
+                A list of N numpy arrays of column indices.
+        """
+        if len(keep_mask)==0:
+            return([])
+        rows, cols = np.nonzero(keep_mask)
+        splits = np.cumsum(np.sum(keep_mask, axis=1))[:-1]
+        return(np.split(cols, splits))
+
     def _compute_lh(self, psi_values, phi_values):
         """
         This function computes the likelihood that there is a source along
@@ -1028,10 +1566,14 @@ class PostProcess(SharedTools):
         self, results, x_size, y_size, v_lim, ang_lim, dbscan_args=None):
         """
         This function clusters results and selects the highest-likelihood
-        trajectory from a given cluster.
+        trajectory from a given cluster. Results closer than eps in the
+        scaled (x, y, velocity, angle) space are linked and every connected
+        group is a cluster, the same clusters DBSCAN finds with
+        min_samples=-1.
         INPUT-
             results : kbmod results
-                A list of kbmod trajectory results such as are stored in
+                A structured array of kbmod trajectories (kb.trajectory_dtype)
+                or a list of kbmod trajectory results such as are stored in
                 keep['results'].
             x_size : list 
                 The width of the images used in the kbmod stack, such as are
@@ -1046,7 +1588,7 @@ class PostProcess(SharedTools):
                 The angle limits of the search, such as are stored in
                 image_params['ang_lim']
             dbscan_args : dictionary
-                Arguments to pass to dbscan.
+                Clustering arguments. Only 'eps' is used.
         OUTPUT-
             top_vals : numpy array
                 An array of the indices for the best trajectories of each
@@ -1058,40 +1600,126 @@ class PostProcess(SharedTools):
             default_dbscan_args.update(dbscan_args)
         dbscan_args = default_dbscan_args
 
-        x_arr = []
-        y_arr = []
-        vel_arr = []
-        ang_arr = []
+        if getattr(results, 'dtype', None) is None or results.dtype.names is None:
+            results = kb.trajectories_to_array(list(results))
+        if len(results) == 0:
+            return np.array([], dtype=int)
 
-        for line in results:
-            x_arr.append(line.x)
-            y_arr.append(line.y)
-            vel_arr.append(np.sqrt(line.x_v**2. + line.y_v**2.))
-            ang_arr.append(np.arctan(line.y_v/line.x_v))
-
-        x_arr = np.array(x_arr)
-        y_arr = np.array(y_arr)
-        vel_arr = np.array(vel_arr)
-        ang_arr = np.array(ang_arr)
+        x_arr = results['x'].astype(np.float64)
+        y_arr = results['y'].astype(np.float64)
+        x_v = results['x_v'].astype(np.float64)
+        y_v = results['y_v'].astype(np.float64)
+        vel_arr = np.sqrt(x_v**2. + y_v**2.)
+        ang_arr = np.arctan2(y_v, x_v)
 
         scaled_x = x_arr/x_size
         scaled_y = y_arr/y_size
         scaled_vel = (vel_arr - v_lim[0])/(v_lim[1] - v_lim[0])
         scaled_ang = (ang_arr - ang_lim[0])/(ang_lim[1] - ang_lim[0])
 
-        db_cluster = DBSCAN(**dbscan_args)
-        db_cluster.fit(np.array([scaled_x, scaled_y,
-                                scaled_vel, scaled_ang], dtype=np.float).T)
-
-        top_vals = []
-        for cluster_num in np.unique(db_cluster.labels_):
-            cluster_vals = np.where(db_cluster.labels_ == cluster_num)[0]
-            top_vals.append(cluster_vals[0])
-
-        del(db_cluster)
+        points = np.array([scaled_x, scaled_y, scaled_vel, scaled_ang]).T
+        pairs = cKDTree(points).query_pairs(
+            dbscan_args['eps'], output_type='ndarray')
+        num_results = len(points)
+        graph = coo_matrix(
+            (np.ones(len(pairs), dtype=bool), (pairs[:, 0], pairs[:, 1])),
+            shape=(num_results, num_results))
+        num_clusters, labels = connected_components(graph, directed=False)
+
+        # Highest likelihood member of each cluster, the earliest on ties.
+        # Clusters are numbered in the order of their first member.
+        order = np.lexsort((np.arange(num_results), -results['lh'], labels))
+        first = np.ones(num_results, dtype=bool)
+        first[1:] = labels[order][1:] != labels[order][:-1]
+        top_vals = order[first]
 
         return top_vals
     
+    def _stamp_filter_rows(self, stamp_rows):
+        """
+        This function runs _batch_stamp_filter() over a block of stamps.
+        INPUT-
+            stamp_rows : numpy array
+                The coadded stamps of several trajectories.
+        OUTPUT-
+            keep_stamps : list
+                A 1 (True) or 0 (False) value for each stamp.
+        """
+        return(list(self._batch_stamp_filter(stamp_rows)))
+
+    def _return_indices_rows(self, curve_rows):
+        """
+        This function runs _batch_return_indices() over a block of curves.
+        INPUT-
+            curve_rows : numpy array
+                A (N, 2, n_images) array holding the Psi and Phi curves of
+                several trajectories.
+        OUTPUT-
+            keep_idx_results : list
+                The tuples returned by _batch_return_indices(), indexed
+                within the block.
+        """
+        return(self._batch_return_indices(curve_rows[:, 0], curve_rows[:, 1]))
+
+    def _batch_stamp_filter(self, stamps):
+        """
+        This function applies the same tests as _stamp_filter_parallel() to
+        a whole array of stamps at once.
+        INPUT-
+            stamps : numpy array
+                A (N, 21, 21) array of coadded stamps.
+        OUTPUT-
+            keep_stamps : numpy array
+                A 1 (True) or 0 (False) value for each stamp.
+        """
+        center_thresh = self.center_thresh
+        x_peak_offset, y_peak_offset = self.peak_offset
+        mom_lims = self.mom_lims
+        stamps = np.asarray(stamps).reshape(-1, 21, 21)
+        s = stamps - np.min(stamps, axis=(1, 2), keepdims=True)
+        s /= np.sum(s, axis=(1, 2), keepdims=True)
+        s = np.array(s, dtype=np.dtype('float64'))
+        # measure.moments_central(s, center=(10,10)) over every stamp, with
+        # the same products so the moments match exactly
+        mom = s
+        orders = np.arange(4, dtype=np.float64)
+        for dim in [1, 2]:
+            delta = np.arange(21, dtype=np.float64) - 10
+            powers_of_delta = delta[:, np.newaxis] ** orders
+            labels = [0, 1, 2]
+            out_labels = [0, 1, 2]
+            labels[dim] = 3
+            out_labels[dim] = 4
+            mom = np.einsum(mom, labels, powers_of_delta, [3, 4], out_labels,
+                            optimize='greedy')
+        mom_list = [mom[:, 2, 0], mom[:, 0, 2], mom[:, 1, 1], mom[:, 1, 0],
+                    mom[:, 0, 1]]
+        # Peak row and column. When several pixels tie for the peak the
+        # largest distance from the center is used, as in
+        # _stamp_filter_parallel()
+        is_peak = s == np.max(s, axis=(1, 2), keepdims=True)
+        multi_peak = np.sum(is_peak, axis=(1, 2)) > 1
+        flat_peak = np.argmax(is_peak.reshape(len(s), -1), axis=1)
+        dist = np.abs(np.arange(21)-10.)
+        peak_1 = np.where(
+            multi_peak,
+            np.max(np.where(is_peak, dist[:, np.newaxis], 0), axis=(1, 2)),
+            flat_peak//21)
+        peak_2 = np.where(
+            multi_peak,
+            np.max(np.where(is_peak, dist[np.newaxis, :], 0), axis=(1, 2)),
+            flat_peak%21)
+        keep_stamps = ((mom_list[0] < mom_lims[0]) & (mom_list[1] < mom_lims[1])
+            & (np.abs(mom_list[2]) < mom_lims[2])
+            & (np.abs(mom_list[3]) < mom_lims[3])
+            & (np.abs(mom_list[4]) < mom_lims[4])
+            & (np.abs(peak_1 - 10.) < x_peak_offset)
+            & (np.abs(peak_2 - 10.) < y_peak_offset))
+        center = np.max(
+            stamps/np.sum(stamps, axis=(1, 2), keepdims=True), axis=(1, 2))
+        keep_stamps &= center > center_thresh
+        return(keep_stamps.astype(int))
+
     def _stamp_filter_parallel(self, stamps):
         """
         This function filters an individual stamp and returns a true or false
@@ -13,8 +13,31 @@ class create_stamps(object):
 
         return
 
-    def load_lightcurves(self, lc_filename, lc_index_filename):
+    def load_bundle(self, bundle_filename):
+        """
+        Open a results_<suffix>.npz bundle written by
+        Interface.save_results(). Keys are only read when accessed.
+        """
+        return np.load(bundle_filename)
 
+    def bundle_rows(self, bundle, key):
+        """
+        Return the per-result rows stored under key in a results bundle,
+        splitting ragged values at their '<key>_offsets'.
+        """
+        if key+'_offsets' in bundle.files:
+            offsets = bundle[key+'_offsets']
+            values = bundle[key]
+            return [values[start:end]
+                    for start, end in zip(offsets[:-1], offsets[1:])]
+        return list(bundle[key])
+
+    def load_lightcurves(self, lc_filename, lc_index_filename=None):
+
+        if lc_filename.endswith('.npz'):
+            bundle = self.load_bundle(lc_filename)
+            return (self.bundle_rows(bundle, 'lc'),
+                    self.bundle_rows(bundle, 'lc_index'))
         lc = []
         lc_index = []
         with open(lc_filename, 'r') as f:
@@ -28,7 +51,13 @@ class create_stamps(object):
 
         return lc, lc_index
 
-    def load_psi_phi(self, psi_filename, phi_filename, lc_index_filename):
+    def load_psi_phi(
+        self, psi_filename, phi_filename=None, lc_index_filename=None):
+        if psi_filename.endswith('.npz'):
+            bundle = self.load_bundle(psi_filename)
+            return(self.bundle_rows(bundle, 'psi'),
+                   self.bundle_rows(bundle, 'phi'),
+                   self.bundle_rows(bundle, 'lc_index'))
         psi = []
         phi = []
         lc_index = []
@@ -48,6 +77,8 @@ class create_stamps(object):
 
     def load_times(self, time_filename):
 
+        if time_filename.endswith('.npz'):
+            return self.bundle_rows(self.load_bundle(time_filename), 'times')
         times = []
         with open(time_filename, 'r') as f:
             reader = csv.reader(f)
@@ -58,7 +89,12 @@ class create_stamps(object):
 
     def load_stamps(self, stamp_filename):
 
-        stamps = np.genfromtxt(stamp_filename)
+        if stamp_filename.endswith('.npz'):
+            stamps = self.load_bundle(stamp_filename)['ps']
+            stamps = stamps.reshape(
+                len(stamps), int(np.prod(stamps.shape[1:])))
+        else:
+            stamps = np.genfromtxt(stamp_filename)
         if len(np.shape(stamps)) < 2:
             stamps = np.array([stamps])
         stamp_normalized = stamps/np.sum(stamps, axis=1).reshape(len(stamps), 1)
@@ -75,8 +111,16 @@ class create_stamps(object):
 
     def load_results(self, res_filename):
 
+        names = ['lh', 'flux', 'x', 'y', 'vx', 'vy', 'num_obs']
+        if res_filename.endswith('.npz'):
+            bundle = self.load_bundle(res_filename)
+            results = np.zeros(
+                len(bundle['lh']), dtype=[(name, float) for name in names])
+            for name in names:
+                results[name] = bundle[name]
+            return results
         results = np.genfromtxt(res_filename, usecols=(1,3,5,7,9,11,13),
-                                names=['lh', 'flux', 'x', 'y', 'vx', 'vy', 'num_obs'])
+                                names=names)
         return results
 
     def plot_all_stamps(
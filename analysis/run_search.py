@@ -4,7 +4,6 @@ import shutil
 import pandas as pd
 import numpy as np
 import time
-import multiprocessing as mp
 import astropy.coordinates as astroCoords
 import astropy.units as u
 from kbmodpy import kbmod as kb
@@ -18,7 +17,8 @@ class region_search:
     """
     CLASS CURRENTLY DOES NOT WORK
     """
-    def __init__(self,v_guess,radius,num_obs):
+    def __init__(self,v_guess,radius,num_obs,num_cores=16,
+                 pool_type='process'):
         """
         INPUT-
             v_guess : float array
@@ -28,10 +28,17 @@ class region_search:
                 radius in velocity space to search, centered around 'v_guess'
             num_obs : int
                 The minimum number of observations required to keep the object
+            num_cores : int
+                The number of workers used to filter the results.
+            pool_type : string
+                'process' or 'thread', the kind of worker pool, as in
+                PostProcess.
         """
         self.v_guess = v_guess
         self.radius = radius
         self.num_obs = num_obs
+        self.num_cores = num_cores
+        self.pool_type = pool_type
         return
 
     def run_search(self, im_filepath, res_filepath, out_suffix, time_file,
@@ -54,10 +61,10 @@ class region_search:
         param_values = (*self.v_guess,self.radius)
         for header, val in zip(param_headers, param_values):
             print('%s = %.4f' % (header, val))
-        results = search.region_search(
+        results = search.region_search_array(
             *self.v_guess, self.radius, likelihood_level, int(self.num_obs))
         duration = image_params['times'][-1]-image_params['times'][0]
-        # Convert the results to the grid formatting
+        # Convert the results to the grid formatting, as one array
         grid_results = kb.region_to_grid(results,duration)
         # Process the search results
         keep = self.process_region_results(
@@ -87,32 +94,30 @@ class region_search:
         print('---------------------------------------')
         print("Processing Results")
         print('---------------------------------------')
-        print('Starting pooling...')
-        pool = mp.Pool(processes=16)
+        kb_post_process = PostProcess(
+            {'num_cores':self.num_cores, 'sigmaG_lims':None,
+             'pool_type':self.pool_type})
         print('Getting results...')
 
-        psi_curves = []
-        phi_curves = []
-        # print(results)
-        for line in results:
-            psi_curve, phi_curve = search.lightcurve(line)
-            psi_curves.append(np.array(psi_curve).flatten())
-            phi_curve = np.array(phi_curve).flatten()
-            phi_curve[phi_curve == 0.] = 99999999.
-            phi_curves.append(phi_curve)
+        # Curves of every result in one call
+        results = kb.trajectories_to_array(results)
+        psi_curves, phi_curves = search.psi_phi_curves(results)
+        phi_curves[phi_curves == 0.] = 99999999.
 
-        keep_idx_results = pool.starmap_async(
-            return_indices,
-            zip(psi_curves, phi_curves, [j for j in range(len(psi_curves))]))
-        pool.close()
-        pool.join()
-        keep_idx_results = keep_idx_results.get()
+        # Kalman filter the curves on the shared worker pool
+        keep_idx_results = kb_post_process.map_rows(
+            kb_post_process._return_indices_rows,
+            np.stack([psi_curves, phi_curves], axis=1))
+        kb_post_process.shutdown()
         if (len(keep_idx_results) < 1):
             keep_idx_results = [(0,[-1],0.)]
 
         if (len(keep_idx_results[0]) < 3):
             keep_idx_results = [(0, [-1], 0.)]
 
+        # Epochs that survived filtering, one row per kept result
+        coadd_epochs = []
+        kept_rows = []
         for result_on in range(len(psi_curves)):
 
             if keep_idx_results[result_on][1][0] == -1:
@@ -124,15 +129,19 @@ class region_search:
             else:
                 keep_idx = keep_idx_results[result_on][1]
                 new_likelihood = keep_idx_results[result_on][2]
-                keep['results'].append(results[result_on])
+                kept_rows.append(result_on)
                 keep['new_lh'].append(new_likelihood)
-                stamps = search.sci_stamps(results[result_on], 10)
-                stamp_arr = np.array(
-                    [np.array(stamps[s_idx]) for s_idx in keep_idx])
-                keep['stamps'].append(np.sum(stamp_arr, axis=0))
+                epochs = np.zeros(len(psi_curves[result_on]), dtype=bool)
+                epochs[keep_idx] = True
+                coadd_epochs.append(epochs)
                 keep['lc'].append(
                     (psi_curves[result_on]/phi_curves[result_on])[keep_idx])
                 keep['times'].append(image_params['mjd'][keep_idx])
+        if len(kept_rows) > 0:
+            # Coadd only the kept epochs of every result in one call
+            keep['stamps'] = list(search.coadd_stamps_batch(
+                results[kept_rows], 10, kb.coadd_sum, np.array(coadd_epochs)))
+        keep['results'] = kb.array_to_trajectories(results[kept_rows])
         print(len(keep['results']))
         # Needed for compatibility with grid_search save functions
         keep['final_results'] = range(len(keep['results']))
@@ -167,7 +176,8 @@ class run_search:
             'visit_in_filename':[0,6], 'file_format':'{0:06d}.fits',
             'sigmaG_lims':[25,75], 'chunk_size':500000, 'max_lh':1000.,
             'filter_type':'clipped_sigmaG', 'center_thresh':0.03,
-            'peak_offset':[2.,2.], 'mom_lims':[35.5,35.5,2.0,0.3,0.3]
+            'peak_offset':[2.,2.], 'mom_lims':[35.5,35.5,2.0,0.3,0.3],
+            'pool_type':'process', 'nms_tolerances':None
         }
         self.config = {**defaults, **input_parameters}
         if (self.config['im_filepath'] is None):
@@ -202,6 +212,9 @@ class run_search:
                         *image_params['vel_lims'])
         for header, val in zip(param_headers, param_values):
             print('%s = %.4f' % (header, val))
+        if self.config['nms_tolerances'] is not None:
+            # Drop results near a more likely one before post processing
+            search.enable_nms(*self.config['nms_tolerances'])
         search.gpu(
             int(self.config['ang_arr'][2]), int(self.config['v_arr'][2]),
             *image_params['ang_lims'], *image_params['vel_lims'],
@@ -259,20 +272,19 @@ class run_search:
         search = kb.stack_search(stack, psf)
 
         search, image_params = self.do_gpu_search(search, image_params)
-        # Load the KBMOD results into Python and apply a filter based on
-        # 'filter_type'
-        keep = kb_post_process.load_results(
+        # Stream the KBMOD results through light curve filtering based on
+        # 'filter_type' and stamp filtering, keeping only what passes
+        keep = kb_post_process.stream_results(
             search, image_params, self.config['lh_level'],
             chunk_size=self.config['chunk_size'], 
             filter_type=self.config['filter_type'],
-            max_lh=self.config['max_lh'])
-        keep = kb_post_process.get_coadd_stamps(keep, search)
-        keep = kb_post_process.apply_stamp_filter(
-            keep, center_thresh=self.config['center_thresh'],
+            max_lh=self.config['max_lh'],
+            center_thresh=self.config['center_thresh'],
             peak_offset=self.config['peak_offset'], 
             mom_lims=self.config['mom_lims'])
         keep = kb_post_process.apply_clustering(keep, image_params)
         keep = kb_post_process.get_all_stamps(keep, search)
+        kb_post_process.shutdown()
         del(search)
         # Save the results
         kb_interface.save_results(
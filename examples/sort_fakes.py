@@ -47,17 +47,14 @@ def compare_fakes(image_dir, results_dir, results_suffix_list, time_file):
 
         stamper = create_stamps()
         
-        times_filename = os.path.join(results_dir, 'times_%s.txt' % results_suffix)
-        times_list = stamper.load_times(times_filename)
+        bundle_filename = os.path.join(results_dir, 'results_%s.npz' % results_suffix)
+        times_list = stamper.load_times(bundle_filename)
 
-        lc_filename = os.path.join(results_dir, 'lc_%s.txt' % results_suffix)
-        lc_list = stamper.load_lightcurves(lc_filename)
+        lc_list, lc_index = stamper.load_lightcurves(bundle_filename)
 
-        stamp_filename = os.path.join(results_dir, 'ps_%s.txt' % results_suffix)
-        stamps = stamper.load_stamps(stamp_filename)
+        stamps = stamper.load_stamps(bundle_filename)
 
-        result_filename = os.path.join(results_dir, 'results_%s.txt' % results_suffix)
-        results = stamper.load_results(result_filename)
+        results = stamper.load_results(bundle_filename)
 
         fake_df = pd.read_csv(os.path.join(results_dir, 'results_fakes_%s.txt' % results_suffix),
                               delimiter=' ', names=['x','y','xv','yv','flux','mag'], skiprows=1)
@@ -5,6 +5,8 @@
 #include "../src/RawImage.cpp"
 #include "../src/LayeredImage.cpp"
 #include "../src/ImageStack.cpp"
+#include "../src/RegionQueue.cpp"
+#include "../src/PyramidOverlay.cpp"
 #include "../src/KBMOSearch.cpp"
 
 namespace py = pybind11;
@@ -20,6 +22,12 @@ using td = kbmod::trajRegion;
 using std::to_string;
 
 PYBIND11_MODULE(kbmod, m) {
+	PYBIND11_NUMPY_DTYPE_EX(tj, xVel, "x_v", yVel, "y_v", lh, "lh",
+		flux, "flux", x, "x", y, "y", obsCount, "obs_count");
+	m.attr("trajectory_dtype") = py::dtype::of<tj>();
+	PYBIND11_NUMPY_DTYPE(td, ix, iy, fx, fy, depth, obs_count,
+		likelihood, flux);
+	m.attr("traj_region_dtype") = py::dtype::of<td>();
 	py::class_<pf>(m, "psf", py::buffer_protocol())
 		.def_buffer([](pf &m) -> py::buffer_info {
 			return py::buffer_info(
@@ -77,6 +85,8 @@ PYBIND11_MODULE(kbmod, m) {
 		.def(py::init<const std::string>())
 		.def(py::init<std::string, int, int, 
 			double, float, float>())
+		.def(py::init<std::string, int, int,
+			float, float, double, unsigned long>())
 		.def("apply_mask_flags", &li::applyMaskFlags)
 		.def("apply_mask_threshold", &li::applyMaskThreshold)
 		.def("sub_template", &li::subtractTemplate)
@@ -113,6 +123,9 @@ PYBIND11_MODULE(kbmod, m) {
 		.def("apply_master_mask", &is::applyMasterMask)
 		.def("grow_mask", &is::growMask)
 		.def("simple_difference", &is::simpleDifference)
+		.def("template_difference", &is::templateDifference)
+		.def("build_template", &is::buildTemplate)
+		.def("get_template", &is::getTemplate)
 		.def("save_master_mask", &is::saveMasterMask)
 		.def("save_images", &is::saveImages)
 		.def("get_master_mask", &is::getMasterMask)
@@ -120,6 +133,14 @@ PYBIND11_MODULE(kbmod, m) {
 		.def("get_masks", &is::getMasks)
 		.def("get_variances", &is::getVariances)
 		.def("convolve", &is::convolve)
+		.def("inject", [](is &s, py::array_t<tj, py::array::c_style> t, pf &p) {
+			py::gil_scoped_release release;
+			s.inject(t.data(), t.size(), p);
+		})
+		.def("inject", [](is &s, const std::vector<tj> &t, pf &p) {
+			py::gil_scoped_release release;
+			s.inject(t.data(), t.size(), p);
+		})
 		.def("get_width", &is::getWidth)
 		.def("get_height", &is::getHeight)
 		.def("get_ppi", &is::getPPI);
@@ -127,15 +148,41 @@ PYBIND11_MODULE(kbmod, m) {
 		.def(py::init<is &, pf &>())
 		.def("save_psi_phi", &ks::savePsiPhi)
 		.def("gpu", &ks::gpu)
-		.def("region_search", &ks::regionSearch)
+		.def("region_search", &ks::regionSearch,
+			py::call_guard<py::gil_scoped_release>())
+		.def("region_search_array", [](ks &s, float xVel, float yVel,
+				float radius, float minLH, int minObservations) {
+			std::vector<td> *res;
+			{
+				py::gil_scoped_release release;
+				res = new std::vector<td>(s.regionSearch(
+						xVel, yVel, radius, minLH, minObservations));
+			}
+			// The array views the results and frees them when collected
+			py::capsule owner(res, [](void *v) {
+				delete reinterpret_cast<std::vector<td>*>(v);
+			});
+			return py::array_t<td>(res->size(), res->data(), owner);
+		})
+		.def("region_search_discs", &ks::regionSearchDiscs,
+			py::call_guard<py::gil_scoped_release>())
+		.def("region_search_polygon", &ks::regionSearchPolygon,
+			py::call_guard<py::gil_scoped_release>())
 		.def("set_debug", &ks::setDebug)
+		.def("set_frontier_budget", &ks::setFrontierBudget)
+		.def("set_region_batch_size", &ks::setRegionBatchSize)
+		.def("enable_nms", &ks::enableNMS)
+		.def("disable_nms", &ks::disableNMS)
+		.def("get_stats", &ks::getStats)
 		.def("filter_min_obs", &ks::filterResults)
 		// For testing
 		.def("extreme_in_region", &ks::findExtremeInRegion)
+		.def("indexed_extreme", &ks::findIndexedExtreme)
 		.def("biggest_fit", &ks::biggestFit)
 		.def("read_pixel_depth", &ks::readPixelDepth)
 		.def("subdivide", &ks::subdivide)
-		.def("filter_bounds", &ks::filterBounds)
+		.def("filter_bounds", (std::vector<td>& (ks::*)(std::vector<td>&,
+			float, float, float, float)) &ks::filterBounds)
 		.def("square_sdf", &ks::squareSDF)
 		.def("filter_lh", &ks::filterLH)
 		.def("pixel_extreme", &ks::pixelExtreme)
@@ -154,7 +201,133 @@ PYBIND11_MODULE(kbmod, m) {
 		.def("get_psi_pooled", &ks::getPsiPooled)
 		.def("get_phi_pooled", &ks::getPhiPooled)
 		.def("clear_psi_phi", &ks::clearPsiPhi)
+		.def("psi_phi_curves", [](ks &s, py::array_t<tj, py::array::c_style> trajs) {
+			if (trajs.ndim() != 1)
+				throw std::runtime_error("trajectories must be a 1D array");
+			ssize_t count = trajs.shape(0);
+			ssize_t imgCount = s.getImageCount();
+			py::array_t<float> psi({count, imgCount});
+			py::array_t<float> phi({count, imgCount});
+			const tj *in = trajs.data();
+			float *psiOut = psi.mutable_data();
+			float *phiOut = phi.mutable_data();
+			{
+				py::gil_scoped_release release;
+				s.psiPhiCurves(in, count, psiOut, phiOut);
+			}
+			return py::make_tuple(psi, phi);
+		})
+		.def("sigmag_filter", [](ks &s, py::array_t<tj, py::array::c_style> trajs,
+				float lower, float upper, float coeff, float nSigma, bool flux) {
+			if (trajs.ndim() != 1)
+				throw std::runtime_error("trajectories must be a 1D array");
+			ssize_t count = trajs.shape(0);
+			ssize_t imgCount = s.getImageCount();
+			py::array_t<bool> keep({count, imgCount});
+			py::array_t<float> lh(count);
+			const tj *in = trajs.data();
+			unsigned char *keepOut = reinterpret_cast<unsigned char*>(keep.mutable_data());
+			float *lhOut = lh.mutable_data();
+			{
+				py::gil_scoped_release release;
+				s.sigmaGFilter(in, count, lower, upper, coeff, nSigma, flux,
+					keepOut, lhOut);
+			}
+			return py::make_tuple(keep, lh);
+		}, py::arg("trajectories"), py::arg("lower_percentile"),
+			py::arg("upper_percentile"), py::arg("coeff"),
+			py::arg("n_sigma") = 2.0, py::arg("flux") = false)
+		.def("sigmag_filter", [](ks &s,
+				py::array_t<float, py::array::c_style | py::array::forcecast> psi,
+				py::array_t<float, py::array::c_style | py::array::forcecast> phi,
+				float lower, float upper, float coeff, float nSigma, bool flux) {
+			if (psi.ndim() != 2 || phi.ndim() != 2 ||
+				psi.shape(0) != phi.shape(0) || psi.shape(1) != phi.shape(1))
+				throw std::runtime_error("psi and phi curves must be 2D arrays of the same shape");
+			ssize_t count = psi.shape(0);
+			ssize_t imgCount = psi.shape(1);
+			py::array_t<bool> keep({count, imgCount});
+			py::array_t<float> lh(count);
+			const float *psiIn = psi.data();
+			const float *phiIn = phi.data();
+			unsigned char *keepOut = reinterpret_cast<unsigned char*>(keep.mutable_data());
+			float *lhOut = lh.mutable_data();
+			{
+				py::gil_scoped_release release;
+				s.sigmaGFilter(psiIn, phiIn, count, imgCount, lower, upper,
+					coeff, nSigma, flux, keepOut, lhOut);
+			}
+			return py::make_tuple(keep, lh);
+		}, py::arg("psi_curves"), py::arg("phi_curves"),
+			py::arg("lower_percentile"), py::arg("upper_percentile"),
+			py::arg("coeff"), py::arg("n_sigma") = 2.0, py::arg("flux") = false)
+		.def("sci_stamps_batch", [](ks &s, py::array_t<tj, py::array::c_style> trajs,
+				int radius) {
+			if (trajs.ndim() != 1)
+				throw std::runtime_error("trajectories must be a 1D array");
+			if (radius<0) throw std::runtime_error("stamp radius must be at least 0");
+			ssize_t count = trajs.shape(0);
+			ssize_t imgCount = s.getImageCount();
+			ssize_t dim = 2*radius+1;
+			py::array_t<float> stamps({count, imgCount, dim, dim});
+			const tj *in = trajs.data();
+			float *out = stamps.mutable_data();
+			{
+				py::gil_scoped_release release;
+				s.scienceStampsBatch(in, count, radius, out);
+			}
+			return stamps;
+		})
+		.def("stacked_sci_batch", [](ks &s, py::array_t<tj, py::array::c_style> trajs,
+				int radius) {
+			if (trajs.ndim() != 1)
+				throw std::runtime_error("trajectories must be a 1D array");
+			if (radius<0) throw std::runtime_error("stamp radius must be at least 0");
+			ssize_t count = trajs.shape(0);
+			ssize_t dim = 2*radius+1;
+			py::array_t<float> stamps({count, dim, dim});
+			const tj *in = trajs.data();
+			float *out = stamps.mutable_data();
+			{
+				py::gil_scoped_release release;
+				s.stackedScienceBatch(in, count, radius, out);
+			}
+			return stamps;
+		})
+		.def("coadd_stamps_batch", [](ks &s, py::array_t<tj, py::array::c_style> trajs,
+				int radius, short method, py::object epochs) {
+			if (trajs.ndim() != 1)
+				throw std::runtime_error("trajectories must be a 1D array");
+			if (radius<0) throw std::runtime_error("stamp radius must be at least 0");
+			ssize_t count = trajs.shape(0);
+			ssize_t dim = 2*radius+1;
+			py::array_t<unsigned char, py::array::c_style | py::array::forcecast> mask;
+			const unsigned char *maskData = nullptr;
+			if (!epochs.is_none()) {
+				mask = epochs.cast<py::array_t<unsigned char,
+					py::array::c_style | py::array::forcecast>>();
+				if (mask.ndim() != 2 || mask.shape(0) != count ||
+					mask.shape(1) != static_cast<ssize_t>(s.getImageCount()))
+					throw std::runtime_error("epoch mask must be (trajectories, images)");
+				maskData = mask.data();
+			}
+			py::array_t<float> stamps({count, dim, dim});
+			const tj *in = trajs.data();
+			float *out = stamps.mutable_data();
+			{
+				py::gil_scoped_release release;
+				s.coaddStampsBatch(in, count, radius, method, maskData, out);
+			}
+			return stamps;
+		}, py::arg("trajectories"), py::arg("radius"), py::arg("method"),
+			py::arg("epochs") = py::none())
 		.def("get_results", &ks::getResults)
+		.def("get_results_array", [](ks &s, int start, int count) {
+			std::vector<tj> res = s.getResults(start, count);
+			py::array_t<tj> arr(res.size());
+			std::copy(res.begin(), res.end(), arr.mutable_data());
+			return arr;
+		})
 		.def("save_results", &ks::saveResults);
 	py::class_<tj>(m, "trajectory")
 		.def(py::init<>())
@@ -196,5 +369,47 @@ PYBIND11_MODULE(kbmod, m) {
 			     " flux " + to_string(t.flux);
 			}
 		);
+	m.def("synthetic_stack", [](int width, int height,
+			std::vector<float> times, pf &psf, float noise, float variance,
+			float background, int starCount, float starFlux,
+			float badPixelFraction, int badPixelFlag, unsigned long seed) {
+		kbmod::syntheticParams params;
+		params.width = width;
+		params.height = height;
+		params.times = times;
+		params.noiseStDev = noise;
+		params.pixelVariance = variance;
+		params.background = background;
+		params.starCount = starCount;
+		params.starFlux = starFlux;
+		params.badPixelFraction = badPixelFraction;
+		params.badPixelFlag = badPixelFlag;
+		params.seed = seed;
+		py::gil_scoped_release release;
+		return is::synthetic(params, psf);
+	}, py::arg("width"), py::arg("height"), py::arg("times"), py::arg("psf"),
+		py::arg("noise") = 1.0, py::arg("variance") = 1.0,
+		py::arg("background") = 0.0, py::arg("star_count") = 0,
+		py::arg("star_flux") = 0.0, py::arg("bad_pixel_fraction") = 0.0,
+		py::arg("bad_pixel_flag") = 1, py::arg("seed") = 0);
+	// Structured arrays are already in the right form
+	m.def("trajectories_to_array", [](py::array_t<tj> arr) { return arr; });
+	m.def("trajectories_to_array", [](const std::vector<tj>& t) {
+		py::array_t<tj> arr(t.size());
+		std::copy(t.begin(), t.end(), arr.mutable_data());
+		return arr;
+	});
+	m.def("array_to_trajectories", [](py::array_t<tj, py::array::c_style> arr) {
+		return std::vector<tj>(arr.data(), arr.data()+arr.size());
+	});
+	m.def("regions_to_array", [](py::array_t<td> arr) { return arr; });
+	m.def("regions_to_array", [](const std::vector<td>& r) {
+		py::array_t<td> arr(r.size());
+		std::copy(r.begin(), r.end(), arr.mutable_data());
+		return arr;
+	});
+	m.def("array_to_regions", [](py::array_t<td, py::array::c_style> arr) {
+		return std::vector<td>(arr.data(), arr.data()+arr.size());
+	});
 }
 
@@ -1,6 +1,5 @@
 import kbmod
 import numpy
-import re
 import pdb
 # layered image functions
 
@@ -97,89 +96,126 @@ def compare_trajectory(a, b, v_thresh, pix_thresh):
     else:
         return False
 
+def _matching_pairs(results, tests, v_thresh, pix_thresh):
+    # All (result, test) index pairs that compare_trajectory accepts,
+    # sorted by result then test
+    from scipy.spatial import cKDTree
+    res = kbmod.trajectories_to_array(results)
+    test = kbmod.trajectories_to_array(tests)
+    if len(res) == 0 or len(test) == 0:
+        return numpy.zeros(0, dtype=int), numpy.zeros(0, dtype=int)
+    # Scale each axis by its tolerance so candidates are within a
+    # Chebyshev distance of one, then apply the exact tests
+    pix_scale = 1.0/pix_thresh if pix_thresh > 0 else 1.0
+    v_scale = 1.0/v_thresh if v_thresh > 0 else 1.0
+    def coords(arr):
+        return numpy.column_stack([
+            arr['x']*pix_scale, arr['y']*pix_scale,
+            arr['x_v'].astype(float)*v_scale, arr['y_v'].astype(float)*v_scale])
+    pairs = cKDTree(coords(res)).sparse_distance_matrix(
+        cKDTree(coords(test)), 1.0+1e-6, p=numpy.inf, output_type='ndarray')
+    r, t = pairs['i'], pairs['j']
+    keep = ((numpy.abs(res['x'][r].astype(int)-test['x'][t]) <= pix_thresh) &
+        (numpy.abs(res['y'][r].astype(int)-test['y'][t]) <= pix_thresh) &
+        (numpy.abs(res['x_v'][r].astype(float)-test['x_v'][t]) < v_thresh) &
+        (numpy.abs(res['y_v'][r].astype(float)-test['y_v'][t]) < v_thresh))
+    order = numpy.lexsort((t[keep], r[keep]))
+    return r[keep][order], t[keep][order]
+
+def match_trajectory_indices(results, tests, v_thresh, pix_thresh):
+    # Each result in turn claims the first unclaimed test it matches
+    r, t = _matching_pairs(results, tests, v_thresh, pix_thresh)
+    claimed = numpy.zeros(len(tests), dtype=bool)
+    matched = []
+    for i, j in zip(r.tolist(), t.tolist()):
+        if (matched and matched[-1] == i) or claimed[j]:
+            continue
+        claimed[j] = True
+        matched.append(i)
+    return numpy.array(matched, dtype=int), numpy.where(~claimed)[0]
+
 def match_trajectories(results_list, test_list, v_thresh, pix_thresh):
-    matches = []
-    unmatched = []
-    for r in results_list:
-        if any(compare_trajectory(r, test, v_thresh, pix_thresh)
-        for test in test_list):
-            matches.append(r)
-    for t in test_list:
-        if (t.obs_count == 0):
-            unmatched.append(t)
-        t.obs_count = 0
-    return matches, unmatched
+    matched, unmatched = match_trajectory_indices(
+        results_list, test_list, v_thresh, pix_thresh)
+    if isinstance(results_list, numpy.ndarray):
+        return results_list[matched], test_list[unmatched]
+    return ([results_list[i] for i in matched],
+            [test_list[i] for i in unmatched])
 
 def score_results(results, test, v_thresh, pix_thresh):
-    score = 0
-    for t in range(len(test)):
-        for i in range(len(results)):
-            if (compare_trajectory(results[i], test[t], v_thresh, pix_thresh)):
-                score += i
-                test[t].obs_count = 0
-                break
-            if (i==len(results)-1):
-                score += i
-    return score/len(test)
-
-def save_trajectories(t_list, path):
+    # Index of the first result matching each test, the last index if none
+    r, t = _matching_pairs(results, test, v_thresh, pix_thresh)
+    first = numpy.full(len(test), max(len(results)-1, 0))
+    numpy.minimum.at(first, t, r)
+    return int(first.sum())/len(test)
+
+# Column order of the legacy text format, as printed by str(trajectory)
+_traj_text_columns = ['lh', 'flux', 'x', 'y', 'x_v', 'y_v', 'obs_count']
+_traj_text_format = 'lh: %f flux: %f x: %d y: %d x_v: %f y_v: %f obs_count: %d'
+_traj_magic = b'\x93NUMPY'
+
+def save_trajectories(t_list, path, text=False):
     if (len(t_list) == 0):
         return
     if (type(t_list[0]) == kbmod.traj_region):
         t_list = region_to_grid(t_list)
-    with open(path, 'w+') as f:
-        for t in t_list:
-            f.write(str(t)+'\n')
-
-def load_trajectories(path):
-    t_list = []
-    with open(path, 'r') as f:
-        for line in f.readlines():
-            nums = re.findall(r"[-+]?\d*\.\d+|\d+", line)
-            t = kbmod.trajectory()
-            t.lh = float(nums[0])
-            t.flux = float(nums[1])
-            t.x = int(float(nums[2]))
-            t.y = int(float(nums[3]))
-            t.x_v = float(nums[4])
-            t.y_v = float(nums[5])
-            t.obs_count = int(float(nums[6]))
-            t_list.append(t)
-    return t_list
-    
+    arr = kbmod.trajectories_to_array(t_list)
+    with open(path, 'wb+') as f:
+        if text:
+            rows = arr[_traj_text_columns].tolist()
+            f.write(''.join(
+                _traj_text_format % row + '\n' for row in rows).encode())
+        else:
+            numpy.save(f, arr)
+
+def load_trajectories(path, as_array=False):
+    with open(path, 'rb') as f:
+        binary = f.read(len(_traj_magic)) == _traj_magic
+    if binary:
+        arr = numpy.load(path)
+    else:
+        # Legacy text, every other token is a value
+        cols = numpy.loadtxt(path, usecols=(1,3,5,7,9,11,13), ndmin=2)
+        arr = numpy.zeros(len(cols), dtype=kbmod.trajectory_dtype)
+        for i, name in enumerate(_traj_text_columns):
+            arr[name] = cols[:,i]
+    if as_array:
+        return arr
+    return kbmod.array_to_trajectories(arr)
+
 def grid_to_region(t_list, duration):
-    r_list = []
-    for t in t_list:
-        r = kbmod.traj_region()
-        r.ix = t.x
-        r.iy = t.y
-        r.fx = t.x+t.x_v*duration
-        r.fy = t.y+t.y_v*duration
-        r.depth = 0
-        r.obs_count = t.obs_count
-        r.likelihood = t.lh
-        r.flux = t.flux
-        r_list.append(r)
-    return r_list
+    t = kbmod.trajectories_to_array(t_list)
+    r = numpy.zeros(len(t), dtype=kbmod.traj_region_dtype)
+    r['ix'] = t['x']
+    r['iy'] = t['y']
+    r['fx'] = t['x']+t['x_v'].astype(float)*duration
+    r['fy'] = t['y']+t['y_v'].astype(float)*duration
+    r['obs_count'] = t['obs_count']
+    r['likelihood'] = t['lh']
+    r['flux'] = t['flux']
+    if isinstance(t_list, numpy.ndarray):
+        return r
+    return kbmod.array_to_regions(r)
 
 def region_to_grid(r_list, duration):
-    t_list = []
-    for r in r_list:
-        t = kbmod.trajectory()
-        t.x = int(r.ix)
-        t.y = int(r.iy)
-        t.x_v = (r.fx-r.ix)/duration
-        t.y_v = (r.fy-r.iy)/duration
-        t.lh = r.likelihood
-        t.flux = r.flux
-        t.obs_count = r.obs_count
-        t_list.append(t)
-    return t_list
+    r = kbmod.regions_to_array(r_list)
+    t = numpy.zeros(len(r), dtype=kbmod.trajectory_dtype)
+    t['x'] = r['ix'].astype(int)
+    t['y'] = r['iy'].astype(int)
+    t['x_v'] = (r['fx'].astype(float)-r['ix'])/duration
+    t['y_v'] = (r['fy'].astype(float)-r['iy'])/duration
+    t['lh'] = r['likelihood']
+    t['flux'] = r['flux']
+    t['obs_count'] = r['obs_count']
+    if isinstance(r_list, numpy.ndarray):
+        return t
+    return kbmod.array_to_trajectories(t)
 
 kbmod.save_trajectories = save_trajectories
 kbmod.load_trajectories = load_trajectories
 kbmod.grid_to_region = grid_to_region
 kbmod.region_to_grid = region_to_grid
+kbmod.match_trajectory_indices = match_trajectory_indices
 kbmod.match_trajectories = match_trajectories
 kbmod.score_results = score_results
 
@@ -187,4 +223,11 @@ kbmod.score_results = score_results
 kbmod.__version__ = "0.3.4"
 kbmod.pool_max = 1
 kbmod.pool_min = 0
+kbmod.template_mean = 0
+kbmod.template_median = 1
+kbmod.template_clipped_mean = 2
+kbmod.coadd_sum = 0
+kbmod.coadd_mean = 1
+kbmod.coadd_median = 2
+kbmod.coadd_weighted = 3
 kbmod.no_data = -9999.0
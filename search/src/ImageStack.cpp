@@ -24,15 +24,69 @@ ImageStack::ImageStack(std::vector<std::string> files)
 ImageStack::ImageStack(std::vector<LayeredImage> imgs)
 {
 	verbose = true;
-	images = imgs;
+	images = std::move(imgs);
 	extractImageTimes();
 	setTimeOrigin();
 	fileNames = std::vector<std::string>();
-	for (LayeredImage& i : imgs) fileNames.push_back(i.getName());
+	for (LayeredImage& i : images) fileNames.push_back(i.getName());
 	masterMask = RawImage(getWidth(), getHeight());
 	avgTemplate = RawImage(getWidth(), getHeight());
 }
 
+ImageStack ImageStack::synthetic(const syntheticParams& params,
+		PointSpreadFunc& psf)
+{
+	int count = params.times.size();
+	if (count == 0) throw std::runtime_error("a synthetic stack needs images");
+	if (params.width <= 0 || params.height <= 0)
+		throw std::runtime_error("synthetic images need a positive size");
+	// Every random stream is derived from the seed and what it is
+	// used for, never from thread order, so a seed always gives the
+	// same stack
+	auto streamSeed = [&](unsigned image, unsigned use) {
+		std::seed_seq seq{static_cast<unsigned>(params.seed),
+			static_cast<unsigned>(params.seed >> 16 >> 16), image, use};
+		unsigned out;
+		seq.generate(&out, &out+1);
+		return out;
+	};
+
+	// The star field is shared by all images
+	std::mt19937 starGen(streamSeed(0, 0));
+	std::uniform_real_distribution<float> starX(0.0, params.width);
+	std::uniform_real_distribution<float> starY(0.0, params.height);
+	std::uniform_real_distribution<float> starFlux(
+			0.5*params.starFlux, 1.5*params.starFlux);
+	std::vector<std::array<float,3>> stars(params.starCount);
+	for (auto& s : stars) s = {{starX(starGen), starY(starGen), starFlux(starGen)}};
+
+	// The noise of each image is drawn in parallel as it is made
+	std::vector<LayeredImage> imgs;
+	imgs.reserve(count);
+	for (int i=0; i<count; ++i)
+	{
+		imgs.emplace_back("synthetic"+std::to_string(i),
+				params.width, params.height, params.noiseStDev,
+				params.pixelVariance, params.times[i], streamSeed(i+1, 1));
+	}
+	#pragma omp parallel for schedule(dynamic)
+	for (int i=0; i<count; ++i)
+	{
+		LayeredImage& im = imgs[i];
+		float *sci = im.getSDataRef();
+		for (unsigned p=0; p<im.getPPI(); ++p) sci[p] += params.background;
+		for (auto& s : stars) im.addObject(s[0], s[1], s[2], psf);
+		if (params.badPixelFraction > 0.0) {
+			const uint64_t maskKey = splitMix64(streamSeed(i+1, 2));
+			float *mask = im.getMDataRef();
+			for (unsigned p=0; p<im.getPPI(); ++p)
+				if (counterUniform(maskKey, p) < params.badPixelFraction)
+					mask[p] = params.badPixelFlag;
+		}
+	}
+	return ImageStack(std::move(imgs));
+}
+
 void ImageStack::loadImages()
 {
 
@@ -77,7 +131,7 @@ unsigned ImageStack::imgCount()
 	return images.size();
 }
 
-std::vector<float> ImageStack::getTimes()
+const std::vector<float>& ImageStack::getTimes()
 {
 	return imageTimes;
 }
@@ -101,6 +155,21 @@ void ImageStack::convolve(PointSpreadFunc psf)
 	for (auto& i : images) i.convolve(psf);
 }
 
+void ImageStack::inject(const trajectory *trajs, int count, PointSpreadFunc& psf)
+{
+	// Each image is only written by one thread
+	#pragma omp parallel for schedule(dynamic)
+	for (int i=0; i<images.size(); ++i)
+	{
+		float t = imageTimes[i];
+		for (int n=0; n<count; ++n)
+		{
+			const trajectory& tr = trajs[n];
+			images[i].addObject(tr.x+t*tr.xVel, tr.y+t*tr.yVel, tr.flux, psf);
+		}
+	}
+}
+
 void ImageStack::saveMasterMask(std::string path)
 {
 	//std::cout << masterMask.getWidth() << "\n";
@@ -194,24 +263,115 @@ void ImageStack::createMasterMask(int flags, int threshold)
 
 void ImageStack::simpleDifference()
 {
-	createTemplate();
-	for (auto& i : images) i.subtractTemplate(avgTemplate);
+	createTemplate(TEMPLATE_MEAN, 0.0, true);
 }
 
-void ImageStack::createTemplate()
+void ImageStack::templateDifference(short method, float clipSigma)
 {
-	assert(avgTemplate.getWidth() == getWidth() &&
-		   avgTemplate.getHeight() == getHeight() );
+	createTemplate(method, clipSigma, true);
+}
+
+void ImageStack::buildTemplate(short method, float clipSigma)
+{
+	createTemplate(method, clipSigma, false);
+}
+
+RawImage ImageStack::getTemplate()
+{
+	return avgTemplate;
+}
+
+void ImageStack::createTemplate(short method, float clipSigma, bool subtract)
+{
+	if (method != TEMPLATE_MEAN && method != TEMPLATE_MEDIAN &&
+		method != TEMPLATE_CLIPPED_MEAN)
+		throw std::runtime_error("Unknown template method");
+	avgTemplate = RawImage(getWidth(), getHeight());
 	float *templatePix = avgTemplate.getDataRef();
-	for (auto& i : images)
+	const int count = imgCount();
+	const unsigned ppi = getPPI();
+	std::vector<float*> sciPix;
+	for (auto& i : images) sciPix.push_back(i.getSDataRef());
+
+	// The stack is processed in blocks of contiguous pixels (row segments)
+	// so each image's slice of a block stays in cache while the template
+	// pixels are combined and then subtracted, instead of making a
+	// transposed copy of the whole stack
+	const int blockCount = (ppi+TEMPLATE_BLOCK_PIXELS-1)/TEMPLATE_BLOCK_PIXELS;
+	#pragma omp parallel
+	{
+		std::vector<float> stackPix(count);
+		#pragma omp for schedule(dynamic)
+		for (int b=0; b<blockCount; ++b)
+		{
+			unsigned start = b*TEMPLATE_BLOCK_PIXELS;
+			unsigned end = std::min(start+TEMPLATE_BLOCK_PIXELS, ppi);
+			for (unsigned p=start; p<end; ++p)
+			{
+				int valid = 0;
+				for (int i=0; i<count; ++i)
+				{
+					float pix = sciPix[i][p];
+					if (pix != NO_DATA) stackPix[valid++] = pix;
+				}
+				templatePix[p] = combinePixels(stackPix.data(),
+						valid, method, clipSigma);
+			}
+			if (!subtract) continue;
+			for (int i=0; i<count; ++i)
+			{
+				float *imgPix = sciPix[i];
+				for (unsigned p=start; p<end; ++p)
+				{
+					if (imgPix[p] != NO_DATA && templatePix[p] != NO_DATA)
+						imgPix[p] -= templatePix[p];
+				}
+			}
+		}
+	}
+}
+
+float ImageStack::combinePixels(float *vals, int count,
+		short method, float clipSigma)
+{
+	if (count == 0) return NO_DATA;
+	if (method == TEMPLATE_MEDIAN) return medianPixels(vals, count);
+	if (method == TEMPLATE_CLIPPED_MEAN)
 	{
-		float *imgPix = i.getSDataRef();
-		for (unsigned p=0; p < getPPI(); ++p)
-			templatePix[p] += imgPix[p];
+		// Iteratively reject pixels more than clipSigma standard
+		// deviations from the median
+		for (int iter=0; iter<TEMPLATE_CLIP_ITERATIONS && count>2; ++iter)
+		{
+			float center = medianPixels(vals, count);
+			double sum = 0.0;
+			for (int i=0; i<count; ++i) sum += vals[i];
+			double mean = sum/count;
+			double sqSum = 0.0;
+			for (int i=0; i<count; ++i) sqSum += (vals[i]-mean)*(vals[i]-mean);
+			float limit = clipSigma*sqrt(sqSum/count);
+			int kept = 0;
+			for (int i=0; i<count; ++i)
+			{
+				if (std::abs(vals[i]-center) <= limit) vals[kept++] = vals[i];
+			}
+			if (kept == count || kept == 0) break;
+			count = kept;
+		}
 	}
+	double sum = 0.0;
+	for (int i=0; i<count; ++i) sum += vals[i];
+	return static_cast<float>(sum/count);
+}
 
-	for (unsigned p=0; p<getPPI(); ++p)
-		templatePix[p] /= static_cast<float>(imgCount());
+float ImageStack::medianPixels(float *vals, int count)
+{
+	// Partially sorts vals in place
+	int mid = count/2;
+	std::nth_element(vals, vals+mid, vals+count);
+	float median = vals[mid];
+	if (count%2 == 0)
+		median = 0.5*(median + *std::max_element(vals, vals+mid));
+	return median;
 }
 
 
@@ -13,7 +13,10 @@
 #include <string>
 #include <list>
 #include <iostream>
+#include <algorithm>
+#include <cmath>
 #include <stdexcept>
+#include <random>
 #include "LayeredImage.h"
 
 namespace kbmod {
@@ -22,14 +25,17 @@ class ImageStack : public ImageBase {
 public:
 	ImageStack(std::vector<std::string> files);
 	ImageStack(std::vector<LayeredImage> imgs);
+	static ImageStack synthetic(const syntheticParams& params,
+			PointSpreadFunc& psf);
 	std::vector<LayeredImage>& getImages();
 	unsigned imgCount();
-	std::vector<float> getTimes();
+	const std::vector<float>& getTimes();
 	void setTimes(std::vector<float> times);
 	void resetImages();
 	void saveMasterMask(std::string path);
 	void saveImages(std::string path);
 	RawImage getMasterMask();
+	RawImage getTemplate();
 	std::vector<RawImage> getSciences();
 	std::vector<RawImage> getMasks();
 	std::vector<RawImage> getVariances();
@@ -38,11 +44,15 @@ public:
 	void applyMaskThreshold(float thresh);
 	void growMask();
 	void simpleDifference();
+	void templateDifference(short method, float clipSigma);
+	void buildTemplate(short method, float clipSigma);
 	virtual void convolve(PointSpreadFunc psf) override;
+	void inject(const trajectory *trajs, int count, PointSpreadFunc& psf);
 	unsigned getWidth() override { return images[0].getWidth(); }
 	unsigned getHeight() override { return images[0].getHeight(); }
 	long* getDimensions() override { return images[0].getDimensions(); }
 	unsigned getPPI() override { return images[0].getPPI(); }
+	static float medianPixels(float *vals, int count);
 	virtual ~ImageStack() {};
 
 private:
@@ -50,7 +60,8 @@ private:
 	void extractImageTimes();
 	void setTimeOrigin();
 	void createMasterMask(int flags, int threshold);
-	void createTemplate();
+	void createTemplate(short method, float clipSigma, bool subtract);
+	float combinePixels(float *vals, int count, short method, float clipSigma);
 	std::vector<std::string> fileNames;
 	std::vector<LayeredImage> images;
 	RawImage masterMask;
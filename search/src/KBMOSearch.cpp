@@ -18,9 +18,19 @@ KBMOSearch::KBMOSearch(ImageStack& imstack, PointSpreadFunc& PSF) :
 	searchRegionsBounded = 0;
 	individualEval = 0;
 	nodesProcessed = 0;
+	regionsSpilled = 0;
+	spillMerges = 0;
+	spillCompactions = 0;
+	sharedReaders = 0;
+	bytesAllocated = 0;
 	maxResultCount = 100000;
+	frontierBudget = REGION_FRONTIER_BUDGET;
+	regionBatchSize = REGION_BATCH_SIZE;
 	debugInfo = false;
 	psiPhiGenerated = false;
+	nmsEnabled = false;
+	nmsPixelTolerance = 0.0;
+	nmsVelocityTolerance = 0.0;
 }
 
 void KBMOSearch::gpu(
@@ -48,34 +58,110 @@ void KBMOSearch::savePsiPhi(std::string path)
 void KBMOSearch::search(bool useGpu, int aSteps, int vSteps, float minAngle,
 		float maxAngle, float minVelocity, float maxVelocity, int minObservations)
 {
-	preparePsiPhi();
+	SharedReader reader(*this, false);
 	createSearchList(aSteps, vSteps, minAngle, maxAngle, minVelocity, maxVelocity);
-	startTimer("Creating interleaved psi/phi buffer");
+	startTimer("interleave", "Creating interleaved psi/phi buffer");
 	createInterleavedPsiPhi();
-	endTimer();
+	endTimer("interleave");
 	results = std::vector<trajectory>(stack.getPPI()*RESULTS_PER_PIXEL);
+	bytesAllocated += results.size()*sizeof(trajectory);
 	if (debugInfo) std::cout <<
 			searchList.size() << " trajectories... \n" << std::flush;
-	startTimer("Searching");
+	startTimer("grid_search", "Searching");
 	useGpu ? gpuSearch(minObservations) : cpuSearch(minObservations);
-	endTimer();
+	double searchTime = endTimer("grid_search");
+	double evaluated = static_cast<double>(searchList.size())*stack.getPPI();
+	setStat("grid_trajectories", evaluated);
+	setStat("grid_trajectories_per_second", evaluated/searchTime);
 	// Free all but results?
 	interleavedPsiPhi = std::vector<float>();
-	startTimer("Sorting results");
+	startTimer("sort", "Sorting results");
 	sortResults();
-	endTimer();
+	endTimer("sort");
+	if (nmsEnabled) {
+		startTimer("nms", "Suppressing near duplicate results");
+		suppressResults();
+		endTimer("nms");
+	}
+}
+
+void KBMOSearch::setRegionBatchSize(unsigned size)
+{
+	if (size == 0)
+		throw std::runtime_error("The region batch size must be at least 1");
+	regionBatchSize = size;
+}
+
+void KBMOSearch::enableNMS(float pixelTolerance, float velocityTolerance)
+{
+	if (pixelTolerance < 0.0 || velocityTolerance < 0.0)
+		throw std::runtime_error("NMS tolerances must be at least 0");
+	nmsEnabled = true;
+	nmsPixelTolerance = pixelTolerance;
+	nmsVelocityTolerance = velocityTolerance;
 }
 
 std::vector<trajRegion> KBMOSearch::regionSearch(
 		float xVel, float yVel, float radius,
 		float minLH, int minObservations)
 {
-	preparePsiPhi();
-	poolAllImages();
-	startTimer("Searching regions");
+	velocityDisc disc = {xVel, yVel, radius};
+	return areaSearch(std::vector<velocityDisc>(1, disc),
+			std::vector<std::pair<float,float>>(), minLH, minObservations);
+}
+
+std::vector<trajRegion> KBMOSearch::regionSearchDiscs(
+		std::vector<std::tuple<float,float,float>> discs,
+		float minLH, int minObservations)
+{
+	if (discs.empty())
+		throw std::runtime_error("At least one velocity disc is required");
+	std::vector<velocityDisc> area;
+	for (auto& d : discs)
+	{
+		velocityDisc disc = {std::get<0>(d), std::get<1>(d), std::get<2>(d)};
+		area.push_back(disc);
+	}
+	return areaSearch(area, std::vector<std::pair<float,float>>(),
+			minLH, minObservations);
+}
+
+std::vector<trajRegion> KBMOSearch::regionSearchPolygon(
+		std::vector<std::pair<float,float>> vertices,
+		float minLH, int minObservations)
+{
+	if (vertices.size() < 3)
+		throw std::runtime_error("A velocity polygon needs at least 3 vertices");
+	return areaSearch(std::vector<velocityDisc>(), vertices,
+			minLH, minObservations);
+}
+
+std::vector<trajRegion> KBMOSearch::areaSearch(
+		const std::vector<velocityDisc>& discs,
+		const std::vector<std::pair<float,float>>& polygon,
+		float minLH, int minObservations)
+{
+	SharedReader reader(*this, true);
+	// Timed here rather than with startTimer, since
+	// several region searches may run at once
+	if (debugInfo) std::cout << "Searching regions... " << std::flush;
+	auto start = std::chrono::system_clock::now();
+	long long nodes = 0;
 	std::vector<trajRegion> res =
-			resSearch(xVel, yVel, radius, minObservations, minLH);
-	endTimer();
+			resSearch(discs, polygon, minObservations, minLH, nodes);
+	std::chrono::duration<double> elapsed =
+			std::chrono::system_clock::now()-start;
+	double searchTime = elapsed.count();
+	{
+		// Recorded together, so they all describe the same search
+		std::lock_guard<std::mutex> lock(statsLock);
+		stageStats["time_region_search"] = searchTime;
+		stageStats["region_nodes"] = nodes;
+		stageStats["region_nodes_per_second"] = nodes/searchTime;
+		stageStats["region_searches"] += 1;
+	}
+	if (debugInfo) std::cout << " Took " << searchTime
+			<< " seconds.\n" << std::flush;
 	if (debugInfo) {
 		std::cout << totalPixelsRead <<
 				" pixels read, computed bounds on "
@@ -83,33 +169,71 @@ std::vector<trajRegion> KBMOSearch::regionSearch(
 				<< static_cast<float>(totalPixelsRead)/static_cast<float>(regionsMaxed)
 				<< " pixels read per region\n"
 				<< searchRegionsBounded << " bounds computed on 4D regions\n"
-				<< individualEval << " individual trajectories LH computed\n";
+				<< individualEval << " individual trajectories LH computed\n"
+				<< nodes << " nodes processed at "
+				<< nodes/searchTime << " nodes per second\n";
 	}
 	//clearPooled();
 	return res;
 }
 
+KBMOSearch::SharedReader::SharedReader(KBMOSearch& s, bool pyramids) :
+		search(s)
+{
+	// The images are shared by every search, build them once
+	std::lock_guard<std::mutex> lock(search.pyramidLock);
+	search.buildPsiPhi();
+	if (pyramids && search.pooledPsi.empty()) search.poolAllImages();
+	search.sharedReaders++;
+}
+
+KBMOSearch::SharedReader::~SharedReader()
+{
+	std::lock_guard<std::mutex> lock(search.pyramidLock);
+	if (--search.sharedReaders == 0) search.readersDone.notify_all();
+}
+
 void KBMOSearch::clearPsiPhi()
 {
+	// Wait for searches still reading the images to finish
+	std::unique_lock<std::mutex> lock(pyramidLock);
+	readersDone.wait(lock, [this] { return sharedReaders == 0; });
+	releasePsiPhi();
+}
+
+void KBMOSearch::releasePsiPhi()
+{
+	// The caller holds pyramidLock
 	psiPhiGenerated = false;
+	clearPooled();
 	psiImages = std::vector<RawImage>();
 	phiImages = std::vector<RawImage>();
 }
 
 void KBMOSearch::clearPooled()
 {
+	// The caller holds pyramidLock
 	pooledPsi = std::vector<std::vector<RawImage>>();
 	pooledPhi = std::vector<std::vector<RawImage>>();
+	psiIndex = std::vector<std::vector<RawImage>>();
+	phiIndex = std::vector<std::vector<RawImage>>();
 }
 
 void KBMOSearch::preparePsiPhi()
 {
+	std::lock_guard<std::mutex> lock(pyramidLock);
+	buildPsiPhi();
+}
+
+void KBMOSearch::buildPsiPhi()
+{
+	// The caller holds pyramidLock
 	if (!psiPhiGenerated) {
-		startTimer("Preparing psi and phi images");
+		startTimer("psi_phi", "Preparing psi and phi images");
 		// Compute Phi and Psi from convolved images
 		// while leaving masked pixels alone
 		// Reinsert 0s for NO_DATA?
-		clearPsiPhi();
+		releasePsiPhi();
 		std::vector<LayeredImage> imgs = stack.getImages();
 		for (int i=0; i<stack.imgCount(); ++i)
 		{
@@ -133,63 +257,241 @@ void KBMOSearch::preparePsiPhi()
 			psiImages.push_back(RawImage(stack.getWidth(), stack.getHeight(), currentPsi));
 			phiImages.push_back(RawImage(stack.getWidth(), stack.getHeight(), currentPhi));
 		}
-		endTimer();
-		startTimer("Convolving images");
+		bytesAllocated += 2*sizeof(float)*stack.imgCount()*stack.getPPI();
+		endTimer("psi_phi");
+		startTimer("convolve", "Convolving images");
 		gpuConvolve();
-		endTimer();
+		endTimer("convolve");
 		psiPhiGenerated = true;
 	}
 }
 
 void KBMOSearch::poolAllImages()
 {
+	// The caller holds pyramidLock
 	clearPooled();
-	startTimer("Pooling images");
-	pooledPsi = poolSet(psiImages, pooledPsi, POOL_MAX);
-	pooledPhi = poolSet(phiImages, pooledPhi, POOL_MIN);
-	endTimer();
+	startTimer("pooling", "Pooling images");
+	int imgCount = psiImages.size();
+	pooledPsi = std::vector<std::vector<RawImage>>(imgCount);
+	pooledPhi = std::vector<std::vector<RawImage>>(imgCount);
+	psiIndex = std::vector<std::vector<RawImage>>(imgCount);
+	phiIndex = std::vector<std::vector<RawImage>>(imgCount);
+	#pragma omp parallel for schedule(dynamic)
+	for (int i=0; i<imgCount; ++i)
+	{
+		poolPair(psiImages[i], phiImages[i], pooledPsi[i], pooledPhi[i]);
+		indexPyramid(pooledPsi[i], psiIndex[i], POOL_MAX);
+		indexPyramid(pooledPhi[i], phiIndex[i], POOL_MIN);
+	}
+	bytesAllocated += pyramidBytes();
+	endTimer("pooling");
+}
+
+void KBMOSearch::indexPyramid(std::vector<RawImage>& pyramid,
+		std::vector<RawImage>& index, int poolType)
+{
+	index.clear();
+	index.reserve(pyramid.size());
+	for (auto& level : pyramid)
+	{
+		index.push_back(RawImage(level.getWidth(), level.getHeight()));
+		indexArea(level, index.back(), poolType,
+				0, 0, level.getWidth(), level.getHeight());
+	}
+}
+
+void KBMOSearch::indexArea(RawImage& level, RawImage& index, int poolType,
+		int x0, int y0, int x1, int y1)
+{
+	const int window = 1 << REGION_INDEX_ORDER;
+	const int width = level.getWidth();
+	const int height = level.getHeight();
+	x0 = std::max(x0, 0);
+	y0 = std::max(y0, 0);
+	x1 = std::min(x1, width);
+	y1 = std::min(y1, height);
+	if (x1 <= x0 || y1 <= y0) return;
+	const float empty = poolType == POOL_MAX ? -FLT_MAX : FLT_MAX;
+	// Patch covering every pixel the recomputed windows reach
+	const int pw = std::min(x1+window-1, width)-x0;
+	const int ph = std::min(y1+window-1, height)-y0;
+	std::vector<float> patch(pw*ph);
+	float *src = level.getDataRef();
+	for (int y=0; y<ph; ++y)
+	{
+		for (int x=0; x<pw; ++x)
+		{
+			float pix = src[(y0+y)*width+x0+x];
+			patch[y*pw+x] = pix == NO_DATA ? empty : pix;
+		}
+	}
+	windowExtremes(patch, pw, ph, poolType);
+	float *dest = index.getDataRef();
+	for (int y=y0; y<y1; ++y)
+	{
+		for (int x=x0; x<x1; ++x)
+		{
+			dest[y*width+x] = patch[(y-y0)*pw+x-x0];
+		}
+	}
+}
+
+void KBMOSearch::indexArea(PyramidOverlay& pyramid, PyramidOverlay& index,
+		unsigned img, unsigned depth, int poolType, int x0, int y0, int x1, int y1)
+{
+	// Same as above, reading and writing through a search's overlays
+	const int window = 1 << REGION_INDEX_ORDER;
+	const int width = pyramid.getWidth(img, depth);
+	const int height = pyramid.getHeight(img, depth);
+	x0 = std::max(x0, 0);
+	y0 = std::max(y0, 0);
+	x1 = std::min(x1, width);
+	y1 = std::min(y1, height);
+	if (x1 <= x0 || y1 <= y0) return;
+	const float empty = poolType == POOL_MAX ? -FLT_MAX : FLT_MAX;
+	const int pw = std::min(x1+window-1, width)-x0;
+	const int ph = std::min(y1+window-1, height)-y0;
+	std::vector<float> patch(pw*ph);
+	for (int y=0; y<ph; ++y)
+	{
+		for (int x=0; x<pw; ++x)
+		{
+			float pix = pyramid.getPixel(img, depth, x0+x, y0+y);
+			patch[y*pw+x] = pix == NO_DATA ? empty : pix;
+		}
+	}
+	windowExtremes(patch, pw, ph, poolType);
+	for (int y=y0; y<y1; ++y)
+	{
+		for (int x=x0; x<x1; ++x)
+		{
+			index.setPixel(img, depth, x, y, patch[(y-y0)*pw+x-x0]);
+		}
+	}
+}
+
+void KBMOSearch::windowExtremes(std::vector<float>& patch,
+		int pw, int ph, int poolType)
+{
+	// Each index pixel holds the extreme of the window of
+	// 2^REGION_INDEX_ORDER level pixels with its lower corner there.
+	// Masked pixels are stored as the value opposite the goal
+	// so the windows can be combined with plain max/min.
+	// Double the window size in place, reading only
+	// entries that have not been overwritten yet
+	const int window = 1 << REGION_INDEX_ORDER;
+	for (int step=1; step<window; step*=2)
+	{
+		for (int y=0; y<ph; ++y)
+		{
+			float *row = &patch[y*pw];
+			float *next = y+step < ph ? &patch[(y+step)*pw] : nullptr;
+			for (int x=0; x<pw; ++x)
+			{
+				float v = row[x];
+				bool right = x+step < pw;
+				if (poolType == POOL_MAX) {
+					if (right) v = std::max(v, row[x+step]);
+					if (next) v = std::max(v, next[x]);
+					if (next && right) v = std::max(v, next[x+step]);
+				} else {
+					if (right) v = std::min(v, row[x+step]);
+					if (next) v = std::min(v, next[x]);
+					if (next && right) v = std::min(v, next[x+step]);
+				}
+				row[x] = v;
+			}
+		}
+	}
 }
 
-std::vector<std::vector<RawImage>>& KBMOSearch::poolSet(
-		std::vector<RawImage> imagesToPool,
-		std::vector<std::vector<RawImage>>& destination, short mode)
+void KBMOSearch::poolPair(RawImage& psi, RawImage& phi,
+		std::vector<RawImage>& psiMip, std::vector<RawImage>& phiMip)
 {
-	for (auto& i : imagesToPool) {
-		std::vector<RawImage> pooled;
-		pooled = poolSingle(pooled, i, mode);
-		destination.push_back(pooled);
+	// Allocate every level of both pyramids up front
+	psiMip.push_back(psi);
+	phiMip.push_back(phi);
+	while (psiMip.back().getPPI() > 1) {
+		unsigned w = (psiMip.back().getWidth()+1)/2;
+		unsigned h = (psiMip.back().getHeight()+1)/2;
+		psiMip.push_back(RawImage(w, h));
+		phiMip.push_back(RawImage(w, h));
+	}
+
+	// Pool a row of a level as soon as the rows it depends on in the
+	// level below are complete, preferring the deepest level, so every
+	// level is built in one pass while its source rows are still in cache
+	int levels = psiMip.size();
+	std::vector<unsigned> rowsDone(levels, 0);
+	rowsDone[0] = psi.getHeight();
+	bool progress = true;
+	while (progress) {
+		progress = false;
+		for (int d=levels-1; d>0; --d)
+		{
+			unsigned row = rowsDone[d];
+			if (row >= psiMip[d].getHeight()) continue;
+			unsigned needed = std::min(2*row+2, psiMip[d-1].getHeight());
+			if (rowsDone[d-1] < needed) continue;
+			poolRow(psiMip[d-1], phiMip[d-1], psiMip[d], phiMip[d], row);
+			rowsDone[d]++;
+			progress = true;
+			break;
+		}
 	}
-	return destination;
 }
 
-std::vector<RawImage> KBMOSearch::poolSingle(
-		std::vector<RawImage>& mip, RawImage& img, short mode)
+void KBMOSearch::poolRow(RawImage& srcPsi, RawImage& srcPhi,
+		RawImage& destPsi, RawImage& destPhi, unsigned row)
 {
-	mip.push_back(img);
-	RawImage& current = img;
-	while (current.getPPI() > 1) {
-		current = current.pool(mode);
-		mip.push_back(current);
+	// Same rules as the pool kernel: pixels outside the source image
+	// are treated as NO_DATA, max pooling of an entirely masked block
+	// is left at -FLT_MAX and min pooling of one is set to NO_DATA
+	const unsigned srcWidth = srcPsi.getWidth();
+	const unsigned destWidth = destPsi.getWidth();
+	const float *psiRow0 = srcPsi.getDataRef()+2*row*srcWidth;
+	const float *phiRow0 = srcPhi.getDataRef()+2*row*srcWidth;
+	const bool hasRow1 = 2*row+1 < srcPsi.getHeight();
+	const float *psiRow1 = hasRow1 ? psiRow0+srcWidth : psiRow0;
+	const float *phiRow1 = hasRow1 ? phiRow0+srcWidth : phiRow0;
+	float *psiDest = destPsi.getDataRef()+row*destWidth;
+	float *phiDest = destPhi.getDataRef()+row*destWidth;
+	for (unsigned x=0; x<destWidth; ++x)
+	{
+		unsigned x0 = 2*x;
+		unsigned x1 = x0+1 < srcWidth ? x0+1 : x0;
+		float psiMax = -FLT_MAX;
+		psiMax = maxMasked(psiRow0[x0], psiMax);
+		psiMax = maxMasked(psiRow0[x1], psiMax);
+		psiMax = maxMasked(psiRow1[x0], psiMax);
+		psiMax = maxMasked(psiRow1[x1], psiMax);
+		float phiMin = FLT_MAX;
+		phiMin = minMasked(phiRow0[x0], phiMin);
+		phiMin = minMasked(phiRow0[x1], phiMin);
+		phiMin = minMasked(phiRow1[x0], phiMin);
+		phiMin = minMasked(phiRow1[x1], phiMin);
+		psiDest[x] = psiMax;
+		phiDest[x] = phiMin == FLT_MAX ? NO_DATA : phiMin;
 	}
-	return mip;
 }
 
-void KBMOSearch::repoolArea(trajRegion& t)
+void KBMOSearch::repoolArea(trajRegion& t, RegionView& view)
 {
 	// Repool small area of images after bright object
 	// has been removed
 	// This should probably be refactored in to multiple methods
-	std::vector<float> times = stack.getTimes();
+	const std::vector<float>& times = stack.getTimes();
 	float xv = (t.fx-t.ix)/times.back();
 	float yv = (t.fy-t.iy)/times.back();
 	for (unsigned i=0; i<pooledPsi.size(); ++i)
 	{
-		std::vector<RawImage>& cPsi = pooledPsi[i];
-		std::vector<RawImage>& cPhi = pooledPhi[i];
+		PyramidOverlay& cPsi = view.psi;
+		PyramidOverlay& cPhi = view.phi;
+		unsigned levels = pooledPsi[i].size();
 		float x = t.ix+xv*times[i];
 		float y = t.iy+yv*times[i];
 
-		for (unsigned depth=1; depth<cPsi.size(); ++depth)
+		for (unsigned depth=1; depth<levels; ++depth)
 		{
 			float scale = std::pow(2.0,static_cast<float>(depth));
 			// Block psf dim * 2 to make sure all light is blocked
@@ -203,30 +505,46 @@ void KBMOSearch::repoolArea(trajRegion& t)
 				{
 					float pixel;
 					float nPsi = -FLT_MAX;
-					pixel = cPsi[depth-1].getPixel(px*2,  py*2);
+					pixel = cPsi.getPixel(i, depth-1, px*2,  py*2);
 					nPsi = pixelExtreme(pixel, nPsi, POOL_MAX);
-					pixel = cPsi[depth-1].getPixel(px*2+1,py*2);
+					pixel = cPsi.getPixel(i, depth-1, px*2+1,py*2);
 					nPsi = pixelExtreme(pixel, nPsi, POOL_MAX);
-					pixel = cPsi[depth-1].getPixel(px*2,  py*2+1);
+					pixel = cPsi.getPixel(i, depth-1, px*2,  py*2+1);
 					nPsi = pixelExtreme(pixel, nPsi, POOL_MAX);
-					pixel = cPsi[depth-1].getPixel(px*2+1,py*2+1);
+					pixel = cPsi.getPixel(i, depth-1, px*2+1,py*2+1);
 					nPsi = pixelExtreme(pixel, nPsi, POOL_MAX);
-					cPsi[depth].setPixel(px,py, nPsi);
+					cPsi.setPixel(i, depth, px,py, nPsi);
 
 					float nPhi =  FLT_MAX;
-					pixel = cPhi[depth-1].getPixel(px*2,  py*2);
+					pixel = cPhi.getPixel(i, depth-1, px*2,  py*2);
 					nPhi = pixelExtreme(pixel, nPhi, POOL_MIN);
-					pixel = cPhi[depth-1].getPixel(px*2+1,py*2);
+					pixel = cPhi.getPixel(i, depth-1, px*2+1,py*2);
 					nPhi = pixelExtreme(pixel, nPhi, POOL_MIN);
-					pixel = cPhi[depth-1].getPixel(px*2,  py*2+1);
+					pixel = cPhi.getPixel(i, depth-1, px*2,  py*2+1);
 					nPhi = pixelExtreme(pixel, nPhi, POOL_MIN);
-					pixel = cPhi[depth-1].getPixel(px*2+1,py*2+1);
+					pixel = cPhi.getPixel(i, depth-1, px*2+1,py*2+1);
 					nPhi = pixelExtreme(pixel, nPhi, POOL_MIN);
-					cPhi[depth].setPixel(px,py, nPhi);
+					cPhi.setPixel(i, depth, px,py, nPhi);
 				}
 			}
 
 		}
+
+		// Refresh the bound index over every window that
+		// touches a masked or repooled pixel
+		const int window = 1 << REGION_INDEX_ORDER;
+		for (unsigned depth=0; depth<levels; ++depth)
+		{
+			float scale = std::pow(2.0,static_cast<float>(depth));
+			int minX = floor( static_cast<float>(x-psf.getDim())/scale )-1;
+			int maxX = ceil(  static_cast<float>(x+psf.getDim())/scale )+1;
+			int minY = floor( static_cast<float>(y-psf.getDim())/scale )-1;
+			int maxY = ceil(  static_cast<float>(y+psf.getDim())/scale )+1;
+			indexArea(cPsi, view.psiIndex, i, depth, POOL_MAX,
+					minX-window+1, minY-window+1, maxX+1, maxY+1);
+			indexArea(cPhi, view.phiIndex, i, depth, POOL_MIN,
+					minX-window+1, minY-window+1, maxX+1, maxY+1);
+		}
 	}
 }
 
@@ -280,6 +598,7 @@ void KBMOSearch::createSearchList(int angleSteps, int velocitySteps,
 
 		int trajCount = angleSteps*velocitySteps;
 		searchList = std::vector<trajectory>(trajCount);
+		bytesAllocated += trajCount*sizeof(trajectory);
 		for (int a=0; a<angleSteps; ++a)
 		{
 			for (int v=0; v<velocitySteps; ++v)
@@ -293,6 +612,7 @@ void KBMOSearch::createSearchList(int angleSteps, int velocitySteps,
 void KBMOSearch::createInterleavedPsiPhi()
 {
 	interleavedPsiPhi = std::vector<float>(stack.imgCount()*stack.getPPI()*2);
+	bytesAllocated += interleavedPsiPhi.size()*sizeof(float);
 	for (int i=0; i<stack.imgCount(); ++i)
 	{
 		unsigned iImgPix = i*stack.getPPI()*2;
@@ -324,41 +644,86 @@ void KBMOSearch::gpuSearch(int minObservations)
 
 std::vector<trajRegion> KBMOSearch::resSearch(float xVel, float yVel,
 		float radius, int minObservations, float minLH)
+{
+	velocityDisc disc = {xVel, yVel, radius};
+	long long nodes = 0;
+	return resSearch(std::vector<velocityDisc>(1, disc),
+			std::vector<std::pair<float,float>>(), minObservations, minLH, nodes);
+}
+
+std::vector<trajRegion> KBMOSearch::resSearch(
+		const std::vector<velocityDisc>& discs,
+		const std::vector<std::pair<float,float>>& polygon,
+		int minObservations, float minLH, long long& nodes)
 {
 	int maxDepth = pooledPsi[0].size()-1;
 	int minDepth = 0;
 	float finalTime = stack.getTimes().back();
 	assert(maxDepth>0 && maxDepth < 127);
 	trajRegion root = {0.0,0.0,0.0,0.0, static_cast<short>(maxDepth), 0, 0.0, 0.0};
-	calculateLH(root);
+	// Objects are removed from this search's copy of the pyramids only
+	RegionView view(pooledPsi, pooledPhi, psiIndex, phiIndex);
+	calculateLH(root, view);
 	std::vector<trajRegion> fResults;
-	// A function to sort trajectories
-	auto cmpLH = [](trajRegion a, trajRegion b)
-			{ return a.likelihood < b.likelihood; };
-	std::priority_queue<trajRegion, std::vector<trajRegion>,
-		decltype(cmpLH)> candidates(cmpLH);
+	RegionQueue candidates(frontierBudget);
 	candidates.push(root);
-	while (!candidates.empty() && candidates.size() < 150000000)
-	{
-		nodesProcessed++;
-		trajRegion t = candidates.top();
-		assert(t.likelihood != NO_DATA);
-		calculateLH(t);
-		candidates.pop();
-		if (t.likelihood < minLH || t.obs_count < minObservations)
-			continue;
-		if (t.likelihood<candidates.top().likelihood) {
-			// if the new score is lower, push it back into the queue
-			candidates.push(t);
-			continue;
-		}
-		if (debugInfo && (nodesProcessed % 1000) == 0) {
-			std::cout << "\r                                             ";
-			std::cout << "\rdepth: " << static_cast<int>(t.depth)
-					  << " lh: " << t.likelihood << " queue size: "
-					  << candidates.size() << std::flush;
+	std::vector<trajRegion> batch;
+	nodes = 0;
+	std::vector<std::vector<trajRegion>> children;
+	std::vector<trajRegion> popped;
+	while (!candidates.empty())
+	{
+		// Expand a batch of the best regions concurrently, then go through
+		// them in order as the search would one region at a time. Objects
+		// may have been removed since a region was pushed, so its
+		// likelihood is recomputed first. A region that falls below the
+		// best region in the queue is pushed back rather than expanded, so
+		// results stay best first. The queue is not changed while the
+		// batch is expanded, so its top then only catches regions that
+		// fall behind what was left in the queue. The batch size is fixed,
+		// so a given search returns the same results for any number of
+		// threads
+		popped.clear();
+		while (!candidates.empty() && popped.size() < regionBatchSize) {
+			popped.push_back(candidates.top());
+			candidates.pop();
 		}
-		if (t.depth==minDepth) {
+		batch = popped;
+		float queueTop = candidates.empty() ?
+				-FLT_MAX : candidates.top().likelihood;
+		long long batchStart = nodes;
+		nodes += batch.size();
+		nodesProcessed += batch.size();
+		children.assign(batch.size(), std::vector<trajRegion>());
+		#pragma omp parallel for schedule(dynamic)
+		for (int b=0; b<static_cast<int>(batch.size()); ++b)
+		{
+			trajRegion& t = batch[b];
+			assert(t.likelihood != NO_DATA);
+			calculateLH(t, view);
+			if (t.likelihood < minLH || t.obs_count < minObservations
+					|| t.likelihood < queueTop || t.depth == minDepth)
+				continue;
+			children[b] = subdivide(t);
+			filterBounds(children[b], discs, polygon, finalTime);
+			calculateLHBatch(children[b], view);
+			filterLH(children[b], minLH, minObservations);
+		}
+
+		for (unsigned b=0; b<batch.size(); ++b)
+		{
+			trajRegion& t = batch[b];
+			if (t.likelihood < minLH || t.obs_count < minObservations)
+				continue;
+			if (!candidates.empty() && t.likelihood<candidates.top().likelihood) {
+				// The new score is lower, push it back into the queue
+				candidates.push(t);
+				continue;
+			}
+			if (t.depth != minDepth) {
+				for (auto& nt : children[b]) candidates.push(nt);
+				continue;
+			}
 			float s = std::pow(2.0, static_cast<float>(minDepth));
 			t.ix *= s;
 			t.iy *= s;
@@ -367,19 +732,40 @@ std::vector<trajRegion> KBMOSearch::resSearch(float xVel, float yVel,
 			// Remove the objects pixels from future searching
 			// and make sure section of images are
 			// repooled after object removal
-			removeObjectFromImages(t);
-			repoolArea(t);
+			removeObjectFromImages(t, view);
+			repoolArea(t, view);
 			if (debugInfo) std::cout << "\nFound Candidate at x: " << t.ix << " y: " << t.iy << "\n";
 			fResults.push_back(t);
 			if (fResults.size() >= maxResultCount) break;
-		} else {
-			std::vector<trajRegion> sublist = subdivide(t);
-			filterBounds(sublist, xVel, yVel, finalTime, radius);
-			calculateLHBatch(sublist);
-			filterLH(sublist, minLH, minObservations);
-			for (auto& nt : sublist) candidates.push(nt);
+			// The rest of the batch was scored before the object was
+			// removed, put it back as it was popped
+			for (unsigned r=b+1; r<batch.size(); ++r) candidates.push(popped[r]);
+			break;
 		}
+		if (debugInfo && batchStart/1000 != nodes/1000) {
+			std::cout << "\r                                             ";
+			std::cout << "\rdepth: " << static_cast<int>(batch[0].depth)
+					  << " lh: " << batch[0].likelihood << " queue size: "
+					  << candidates.size() << std::flush;
+		}
+		if (fResults.size() >= maxResultCount) break;
+	}
+	regionsSpilled += candidates.spilledCount();
+	spillMerges += candidates.mergeCount();
+	spillCompactions += candidates.compactionCount();
+	{
+		// Largest spill file of any search
+		std::lock_guard<std::mutex> lock(statsLock);
+		double& fileBytes = stageStats["bytes_spill_file"];
+		fileBytes = std::max(fileBytes,
+				static_cast<double>(candidates.filePeakCount()*sizeof(trajRegion)));
 	}
+	const unsigned long long tileBytes = sizeof(float) << (2*OVERLAY_TILE_ORDER);
+	bytesAllocated += tileBytes*(view.psi.tileCount()+view.phi.tileCount()
+			+view.psiIndex.tileCount()+view.phiIndex.tileCount());
+	if (debugInfo && candidates.spilledCount() > 0)
+		std::cout << "\n" << candidates.spilledCount()
+				  << " regions spilled to disk";
 	std::cout << std::endl;
 	return fResults;
 }
@@ -508,38 +894,103 @@ std::vector<trajRegion> KBMOSearch::subdivide(trajRegion& t)
 std::vector<trajRegion>& KBMOSearch::filterBounds(std::vector<trajRegion>& tlist,
 		float xVel, float yVel, float ft, float radius)
 {
+	velocityDisc disc = {xVel, yVel, radius};
+	return filterBounds(tlist, std::vector<velocityDisc>(1, disc),
+			std::vector<std::pair<float,float>>(), ft);
+}
+
+std::vector<trajRegion>& KBMOSearch::filterBounds(std::vector<trajRegion>& tlist,
+		const std::vector<velocityDisc>& discs,
+		const std::vector<std::pair<float,float>>& polygon, float ft)
+{
+	// Keep regions that reach the union of the discs and polygon
 	tlist.erase(
 			std::remove_if(tlist.begin(), tlist.end(),
-				std::bind([](trajRegion t, KBMOSearch* s,
-				float xv, float yv, float finalT, float rad) {
-					// 2 raised to the depth power
-					float scale = std::pow(2.0, static_cast<float>(t.depth));
-					float centerX = scale*(t.fx+0.5);
-					float centerY = scale*(t.fy+0.5);
-					float posX =    scale*(t.ix+0.5)+xv*finalT;
-					float posY =    scale*(t.iy+0.5)+yv*finalT;
-					// 2D box signed distance function
-					float dist =          s->squareSDF(scale, centerX,
-							centerY, posX-0.5*scale, posY+0.5*scale);
-					dist = std::min(dist, s->squareSDF(scale, centerX,
-							centerY, posX+0.5*scale, posY+0.5*scale));
-					dist = std::min(dist, s->squareSDF(scale, centerX,
-							centerY, posX-0.5*scale, posY-0.5*scale));
-					dist = std::min(dist, s->squareSDF(scale, centerX,
-							centerY, posX+0.5*scale, posY-0.5*scale));
-					/*
-					if (dist - rad > 0.0)
-						std::cout << "cuttingBounds: " <<
-					    t.ix << " " << t.iy <<
-					    " | " << t.fx << " " <<
-					    t.fy << "\n";
-					*/
-					return (dist - rad) > 0.0;
-				}, std::placeholders::_1, this, xVel, yVel, ft, radius)),
+				[&](trajRegion& t) {
+					for (auto& disc : discs)
+						if (discOverlaps(t, disc, ft)) return false;
+					return polygon.empty() || !polygonOverlaps(t, polygon, ft);
+				}),
 	tlist.end());
 	return tlist;
 }
 
+bool KBMOSearch::discOverlaps(trajRegion& t, const velocityDisc& disc, float ft)
+{
+	// 2 raised to the depth power
+	float scale = std::pow(2.0, static_cast<float>(t.depth));
+	float centerX = scale*(t.fx+0.5);
+	float centerY = scale*(t.fy+0.5);
+	float posX =    scale*(t.ix+0.5)+disc.xVel*ft;
+	float posY =    scale*(t.iy+0.5)+disc.yVel*ft;
+	// 2D box signed distance function
+	float dist =          squareSDF(scale, centerX,
+			centerY, posX-0.5*scale, posY+0.5*scale);
+	dist = std::min(dist, squareSDF(scale, centerX,
+			centerY, posX+0.5*scale, posY+0.5*scale));
+	dist = std::min(dist, squareSDF(scale, centerX,
+			centerY, posX-0.5*scale, posY-0.5*scale));
+	dist = std::min(dist, squareSDF(scale, centerX,
+			centerY, posX+0.5*scale, posY-0.5*scale));
+	return !((dist - disc.radius) > 0.0);
+}
+
+bool KBMOSearch::polygonOverlaps(trajRegion& t,
+		const std::vector<std::pair<float,float>>& polygon, float ft)
+{
+	// Velocities the region can hold form a box, the difference
+	// of its final and initial position boxes divided by ft
+	float scale = std::pow(2.0, static_cast<float>(t.depth));
+	float lx = scale*(t.fx-t.ix-1.0)/ft;
+	float hx = scale*(t.fx-t.ix+1.0)/ft;
+	float ly = scale*(t.fy-t.iy-1.0)/ft;
+	float hy = scale*(t.fy-t.iy+1.0)/ft;
+	auto inBox = [&](float x, float y)
+			{ return x>=lx && x<=hx && y>=ly && y<=hy; };
+	// A vertex inside the box
+	for (auto& v : polygon)
+		if (inBox(v.first, v.second)) return true;
+	// The box inside the polygon, even-odd rule on its center
+	float cx = (lx+hx)*0.5;
+	float cy = (ly+hy)*0.5;
+	bool inside = false;
+	for (unsigned i=0, j=polygon.size()-1; i<polygon.size(); j=i++)
+	{
+		const std::pair<float,float>& a = polygon[i];
+		const std::pair<float,float>& b = polygon[j];
+		if ((a.second > cy) != (b.second > cy) &&
+				cx < (b.first-a.first)*(cy-a.second)/(b.second-a.second)+a.first)
+			inside = !inside;
+	}
+	if (inside) return true;
+	// An edge crossing the box, clipped against each side in turn
+	for (unsigned i=0, j=polygon.size()-1; i<polygon.size(); j=i++)
+	{
+		float x0 = polygon[j].first;
+		float y0 = polygon[j].second;
+		float dx = polygon[i].first-x0;
+		float dy = polygon[i].second-y0;
+		float t0 = 0.0;
+		float t1 = 1.0;
+		const float p[4] = {-dx, dx, -dy, dy};
+		const float q[4] = {x0-lx, hx-x0, y0-ly, hy-y0};
+		bool crosses = true;
+		for (int k=0; k<4 && crosses; ++k)
+		{
+			if (p[k] == 0.0) {
+				if (q[k] < 0.0) crosses = false;
+			} else {
+				float r = q[k]/p[k];
+				if (p[k] < 0.0) t0 = std::max(t0, r);
+				else t1 = std::min(t1, r);
+				if (t0 > t1) crosses = false;
+			}
+		}
+		if (crosses) return true;
+	}
+	return false;
+}
+
 float KBMOSearch::squareSDF(float scale,
 		float centerX, float centerY, float pointX, float pointY)
 {
@@ -568,14 +1019,27 @@ std::vector<trajRegion>& KBMOSearch::filterLH(
 
 std::vector<trajRegion>& KBMOSearch::calculateLHBatch(std::vector<trajRegion>& tlist)
 {
-	for (auto& t : tlist) calculateLH(t);
+	RegionView view(pooledPsi, pooledPhi, psiIndex, phiIndex);
+	return calculateLHBatch(tlist, view);
+}
+
+std::vector<trajRegion>& KBMOSearch::calculateLHBatch(
+		std::vector<trajRegion>& tlist, RegionView& view)
+{
+	for (auto& t : tlist) calculateLH(t, view);
 	return tlist;
 }
 
 trajRegion& KBMOSearch::calculateLH(trajRegion& t)
+{
+	RegionView view(pooledPsi, pooledPhi, psiIndex, phiIndex);
+	return calculateLH(t, view);
+}
+
+trajRegion& KBMOSearch::calculateLH(trajRegion& t, RegionView& view)
 {
 
-	std::vector<float> times = stack.getTimes();
+	const std::vector<float>& times = stack.getTimes();
 	float endTime = times.back();
 	float xv = (t.fx-t.ix)/endTime;
 	float yv = (t.fy-t.iy)/endTime;
@@ -588,6 +1052,9 @@ trajRegion& KBMOSearch::calculateLH(trajRegion& t)
 	float psiSum = 0.0;
 	float phiSum = 0.0;
 	t.obs_count = 0;
+	// Counted locally to keep threads off the shared counters
+	long pixelsRead = 0;
+	long regionReads = 0;
 
 	// Second pass removes outliers
 	for (int i=0; i<stack.imgCount(); ++i)
@@ -596,26 +1063,34 @@ trajRegion& KBMOSearch::calculateLH(trajRegion& t)
 		float tempPhi = 0.0;
 		// Read from region rather than single pixel
 		if (t.depth > 0) {
-			searchRegionsBounded++;
 			float x = t.ix+0.5 + times[i] * xv;
 			float y = t.iy+0.5 + times[i] * yv;
-			int size = 1 << static_cast<int>(t.depth);
-			tempPsi = findExtremeInRegion(x, y, size, pooledPsi[i], POOL_MAX);
+			regionReads++;
+			tempPsi = indexedExtreme(x, y, size, view.psi,
+					view.psiIndex, i, POOL_MAX, pixelsRead);
 			if (tempPsi == NO_DATA) continue;
-			tempPhi = findExtremeInRegion(x, y, size, pooledPhi[i], POOL_MIN);
+			regionReads++;
+			tempPhi = indexedExtreme(x, y, size, view.phi,
+					view.phiIndex, i, POOL_MIN, pixelsRead);
 		} else {
-			individualEval++;
 			// Allow for fractional pixel coordinates
 			float xp = fractionalComp*(t.ix + times[i] * xv); // +0.5;
 			float yp = fractionalComp*(t.iy + times[i] * yv); // +0.5;
-			tempPsi = pooledPsi[i][d].getPixelInterp(xp,yp);
+			tempPsi = view.psi.getPixelInterp(i, d, xp,yp);
 			if (tempPsi == NO_DATA) continue;
-			tempPhi = pooledPhi[i][d].getPixelInterp(xp,yp);
+			tempPhi = view.phi.getPixelInterp(i, d, xp,yp);
 		}
 		psiSum += tempPsi;
 		phiSum += tempPhi;
 		t.obs_count++;
 	}
+	if (t.depth > 0) {
+		searchRegionsBounded += stack.imgCount();
+		regionsMaxed += regionReads;
+		totalPixelsRead += pixelsRead;
+	} else {
+		individualEval += stack.imgCount();
+	}
 
 	//assert(phiSum>0.0);
 	t.likelihood = phiSum > 0.0 ? psiSum/sqrt(phiSum) : NO_DATA;
@@ -629,7 +1104,7 @@ std::vector<float> KBMOSearch::observeTrajectory(
 {
 	std::vector<float> obs;
 	t.obs_count = 0;
-	std::vector<float> times = stack.getTimes();
+	const std::vector<float>& times = stack.getTimes();
 	float endTime = times.back();
 	float xv = (t.fx-t.ix)/endTime;
 	float yv = (t.fy-t.iy)/endTime;
@@ -665,7 +1140,33 @@ std::vector<float> KBMOSearch::observeTrajectory(
 float KBMOSearch::findExtremeInRegion(float x, float y,
 	int size, std::vector<RawImage>& pooledImgs, int poolType)
 {
+	long pixelsRead = 0;
+	float extreme = regionExtreme(x, y, size, pooledImgs, poolType, pixelsRead);
 	regionsMaxed++;
+	totalPixelsRead += pixelsRead;
+	return extreme;
+}
+
+float KBMOSearch::findIndexedExtreme(float x, float y, int size,
+		unsigned img, int poolType)
+{
+	// The bound a region search reads for an image's psi (POOL_MAX)
+	// or phi (POOL_MIN) pyramid
+	SharedReader reader(*this, true);
+	if (img >= pooledPsi.size())
+		throw std::runtime_error("Image index out of range");
+	RegionView view(pooledPsi, pooledPhi, psiIndex, phiIndex);
+	long pixelsRead = 0;
+	return poolType == POOL_MAX ?
+			indexedExtreme(x, y, size, view.psi, view.psiIndex,
+					img, POOL_MAX, pixelsRead) :
+			indexedExtreme(x, y, size, view.phi, view.phiIndex,
+					img, POOL_MIN, pixelsRead);
+}
+
+float KBMOSearch::regionExtreme(float x, float y, int size,
+		std::vector<RawImage>& pooledImgs, int poolType, long& pixelsRead)
+{
 	// check that maxSize is a power of two
 	assert((size&(-size))==size);
 	x *= static_cast<float>(size);
@@ -690,12 +1191,14 @@ float KBMOSearch::findExtremeInRegion(float x, float y,
 	hy = (hy+sizeToRead-1)/sizeToRead;
 	float regionExtreme =
 			poolType == POOL_MAX ? -FLT_MAX : FLT_MAX; // start opposite of goal
+	RawImage& level = pooledImgs[depth];
 	int curY = ly;
 	while (curY < hy) {
 		int curX = lx;
 		while (curX < hx) {
-			float pix = readPixelDepth(depth, curX, curY, pooledImgs);
+			float pix = level.getPixel(curX, curY);
 			regionExtreme = pixelExtreme(pix, regionExtreme, poolType);
+			pixelsRead++;
 			curX++;
 		}
 		curY++;
@@ -705,6 +1208,68 @@ float KBMOSearch::findExtremeInRegion(float x, float y,
 	return regionExtreme;
 }
 
+float KBMOSearch::indexedExtreme(float x, float y, int size,
+		PyramidOverlay& pyramid, PyramidOverlay& index, unsigned img,
+		int poolType, long& pixelsRead)
+{
+	// Same region as regionExtreme, but the box is only rounded out
+	// to the finest level where it spans at most two index windows
+	assert((size&(-size))==size);
+	const int window = 1 << REGION_INDEX_ORDER;
+	x *= static_cast<float>(size);
+	y *= static_cast<float>(size);
+	float s = static_cast<float>(size)*0.5;
+	int lx = static_cast<int>(floor(x-s));
+	int ly = static_cast<int>(floor(y-s));
+	int hx = static_cast<int>(ceil(x+s));
+	int hy = static_cast<int>(ceil(y+s));
+	int depth = 0;
+	int maxDepth = pyramid.levelCount(img)-1;
+	// Floor and ceiling division by the level's pixel size
+	auto lower = [](int v, int d) { return v >= 0 ? v >> d : -((-v+(1<<d)-1) >> d); };
+	auto upper = [&](int v, int d) { return -lower(-v, d); };
+	while (depth < maxDepth &&
+			std::max(upper(hx, depth)-lower(lx, depth),
+					 upper(hy, depth)-lower(ly, depth)) > 2*window)
+		++depth;
+	const int width = pyramid.getWidth(img, depth);
+	const int height = pyramid.getHeight(img, depth);
+	int ax = std::max(lower(lx, depth), 0);
+	int ay = std::max(lower(ly, depth), 0);
+	int bx = std::min(upper(hx, depth), width);
+	int by = std::min(upper(hy, depth), height);
+	if (bx <= ax || by <= ay) return NO_DATA;
+	float regionExtreme =
+			poolType == POOL_MAX ? -FLT_MAX : FLT_MAX; // start opposite of goal
+	if (bx-ax < window || by-ay < window) {
+		// Too small for a window, read the pixels directly
+		for (int cy=ay; cy<by; ++cy)
+		{
+			for (int cx=ax; cx<bx; ++cx)
+			{
+				regionExtreme = pixelExtreme(pyramid.getPixel(img, depth, cx, cy),
+						regionExtreme, poolType);
+			}
+		}
+		pixelsRead += (bx-ax)*(by-ay);
+	} else {
+		// Overlapping windows anchored at the box corners
+		int cx = bx-window;
+		int cy = by-window;
+		float a = index.getPixel(img, depth, ax, ay);
+		float b = index.getPixel(img, depth, cx, ay);
+		float c = index.getPixel(img, depth, ax, cy);
+		float d = index.getPixel(img, depth, cx, cy);
+		regionExtreme = poolType == POOL_MAX ?
+				std::max(std::max(a, b), std::max(c, d)) :
+				std::min(std::min(a, b), std::min(c, d));
+		pixelsRead += 4;
+	}
+	if (regionExtreme == FLT_MAX || regionExtreme == -FLT_MAX)
+		regionExtreme = NO_DATA;
+	return regionExtreme;
+}
+
 float KBMOSearch::pixelExtreme(float pixel, float prev, int poolType)
 {
 	return poolType == POOL_MAX ? maxMasked(pixel, prev) : minMasked(pixel, prev);
@@ -738,9 +1303,9 @@ int KBMOSearch::biggestFit(int x, int y, int maxX, int maxY) // inline?
 	return size;
 }
 
-void KBMOSearch::removeObjectFromImages(trajRegion& t)
+void KBMOSearch::removeObjectFromImages(trajRegion& t, RegionView& view)
 {
-	std::vector<float> times = stack.getTimes();
+	const std::vector<float>& times = stack.getTimes();
 	float endTime = times.back();
 	float xv = (t.fx-t.ix)/endTime;
 	float yv = (t.fy-t.iy)/endTime;
@@ -751,14 +1316,14 @@ void KBMOSearch::removeObjectFromImages(trajRegion& t)
 		float xp = fractionalComp*(t.ix + times[i] * xv); // +0.5;
 		float yp = fractionalComp*(t.iy + times[i] * yv); // +0.5;
 		int d = std::max(static_cast<int>(t.depth), 0);
-		pooledPsi[i][d].maskObject(xp,yp, psf);
-		pooledPhi[i][d].maskObject(xp,yp, psf);
+		view.psi.maskObject(i, d, xp,yp, psf);
+		view.phi.maskObject(i, d, xp,yp, psf);
 	}
 }
 
 trajectory KBMOSearch::convertTraj(trajRegion& t)
 {
-	std::vector<float> times = stack.getTimes();
+	const std::vector<float>& times = stack.getTimes();
 	float endTime = times.back();
 	float xv = (t.fx-t.ix)/endTime;
 	float yv = (t.fy-t.iy)/endTime;
@@ -778,7 +1343,7 @@ std::vector<RawImage> KBMOSearch::createStamps(trajectory t, int radius, std::ve
 	if (radius<0) throw std::runtime_error("stamp radius must be at least 0");
 	int dim = radius*2+1;
 	std::vector<RawImage> stamps;
-	std::vector<float> times = stack.getTimes();
+	const std::vector<float>& times = stack.getTimes();
 	for (int i=0; i<imgs.size(); ++i)
 	{
 		RawImage im(dim, dim);
@@ -813,7 +1378,7 @@ std::vector<float> KBMOSearch::createCurves(trajectory t, std::vector<RawImage*>
     int imgSize = imgs.size();
     std::vector<float> lightcurve;
     lightcurve.reserve(imgSize);
-    std::vector<float> times = stack.getTimes();
+    const std::vector<float>& times = stack.getTimes();
     for (int i=0; i<imgSize; ++i)
     {
         /* Do not use getPixelInterp(), because results from createCurves must
@@ -833,7 +1398,7 @@ RawImage KBMOSearch::stackedStamps(trajectory t, int radius, std::vector<RawImag
 	if (radius<0) throw std::runtime_error("stamp radius must be at least 0");
 	int dim = radius*2+1;
 	RawImage stamp(dim, dim);
-	std::vector<float> times = stack.getTimes();
+	const std::vector<float>& times = stack.getTimes();
 	for (int i=0; i<imgs.size(); ++i)
 	{
 		for (int x=0; x<dim; ++x)
@@ -851,6 +1416,184 @@ RawImage KBMOSearch::stackedStamps(trajectory t, int radius, std::vector<RawImag
 	return stamp;
 }
 
+void KBMOSearch::scienceStampsBatch(const trajectory *trajs, int count,
+		int radius, float *out)
+{
+	// Fills a count x imgCount x dim x dim array with the
+	// same stamps as scienceStamps
+	if (radius<0) throw std::runtime_error("stamp radius must be at least 0");
+	const int dim = radius*2+1;
+	const int stampSize = dim*dim;
+	const int imgCount = stack.imgCount();
+	const std::vector<float>& times = stack.getTimes();
+	std::vector<LayeredImage>& imgs = stack.getImages();
+	#pragma omp parallel
+	{
+		// Cut every trajectory's stamp from one image before moving
+		// to the next so the image stays in cache
+		for (int i=0; i<imgCount; ++i)
+		{
+			RawImage& sci = imgs[i].getScience();
+			#pragma omp for
+			for (int n=0; n<count; ++n)
+			{
+				const trajectory& t = trajs[n];
+				float *stamp = out+(static_cast<long>(n)*imgCount+i)*stampSize;
+				float cx = t.x + times[i] * t.xVel;
+				float cy = t.y + times[i] * t.yVel;
+				for (int y=0; y<dim; ++y)
+				{
+					for (int x=0; x<dim; ++x)
+					{
+						float pixVal = sci.getPixelInterp(
+								cx + static_cast<float>(x-radius),
+								cy + static_cast<float>(y-radius));
+						if (pixVal == NO_DATA) pixVal = 0.0;
+						stamp[y*dim+x] = pixVal;
+					}
+				}
+			}
+		}
+	}
+}
+
+void KBMOSearch::stackedScienceBatch(const trajectory *trajs, int count,
+		int radius, float *out)
+{
+	// Fills a count x dim x dim array with the same
+	// coadds as stackedScience
+	if (radius<0) throw std::runtime_error("stamp radius must be at least 0");
+	const int dim = radius*2+1;
+	const int stampSize = dim*dim;
+	const int imgCount = stack.imgCount();
+	const std::vector<float>& times = stack.getTimes();
+	std::vector<LayeredImage>& imgs = stack.getImages();
+	std::fill(out, out+static_cast<long>(count)*stampSize, 0.0);
+	#pragma omp parallel
+	{
+		for (int i=0; i<imgCount; ++i)
+		{
+			RawImage& sci = imgs[i].getScience();
+			#pragma omp for
+			for (int n=0; n<count; ++n)
+			{
+				const trajectory& t = trajs[n];
+				float *stamp = out+static_cast<long>(n)*stampSize;
+				float cx = t.x + times[i] * t.xVel;
+				float cy = t.y + times[i] * t.yVel;
+				for (int y=0; y<dim; ++y)
+				{
+					for (int x=0; x<dim; ++x)
+					{
+						float pixVal = sci.getPixel(
+								cx + static_cast<float>(x-radius),
+								cy + static_cast<float>(y-radius));
+						if ((pixVal == NO_DATA) || isnan(pixVal)) pixVal = 0.0;
+						stamp[y*dim+x] += pixVal;
+					}
+				}
+			}
+		}
+	}
+}
+
+void KBMOSearch::coaddStampsBatch(const trajectory *trajs, int count,
+		int radius, short method, const unsigned char *epochMask, float *out)
+{
+	/*Coadd the science stamps of many trajectories
+	 *  INPUT-
+	 *    const trajectory *trajs - The trajectories to coadd along
+	 *    int count - The number of trajectories
+	 *    int radius - The stamp radius
+	 *    short method - One of the coadd_method values
+	 *    const unsigned char *epochMask - Row major count x imgCount flags
+	 *      of the epochs to include, or nullptr to include every epoch
+	 *  OUTPUT-
+	 *    float *out - Row major count x dim x dim coadds
+	 *
+	 * Epochs are sampled like scienceStamps, so COADD_SUM over a mask
+	 * gives the sum of the selected sci_stamps. Masked pixels are left
+	 * out of the mean, median and inverse variance weighted coadds,
+	 * and pixels with no data in any selected epoch are 0.
+	 */
+	if (radius<0) throw std::runtime_error("stamp radius must be at least 0");
+	if (method != COADD_SUM && method != COADD_MEAN &&
+		method != COADD_MEDIAN && method != COADD_WEIGHTED)
+		throw std::runtime_error("Unknown coadd method");
+	const int dim = radius*2+1;
+	const int stampSize = dim*dim;
+	const int imgCount = stack.imgCount();
+	const std::vector<float>& times = stack.getTimes();
+	std::vector<LayeredImage>& imgs = stack.getImages();
+	#pragma omp parallel
+	{
+		// Stamps of the selected epochs and, when weighting,
+		// their variances, epoch major
+		std::vector<float> sci(imgCount*stampSize);
+		std::vector<float> var(method == COADD_WEIGHTED ? imgCount*stampSize : 0);
+		std::vector<float> pixVals(imgCount);
+		#pragma omp for schedule(dynamic)
+		for (int n=0; n<count; ++n)
+		{
+			const trajectory& t = trajs[n];
+			int epochs = 0;
+			for (int i=0; i<imgCount; ++i)
+			{
+				if (epochMask != nullptr &&
+					!epochMask[static_cast<long>(n)*imgCount+i]) continue;
+				float cx = t.x + times[i] * t.xVel;
+				float cy = t.y + times[i] * t.yVel;
+				float *sciStamp = sci.data()+epochs*stampSize;
+				for (int y=0; y<dim; ++y)
+				{
+					for (int x=0; x<dim; ++x)
+					{
+						float px = cx + static_cast<float>(x-radius);
+						float py = cy + static_cast<float>(y-radius);
+						float pixVal = imgs[i].getScience().getPixelInterp(px, py);
+						if (isnan(pixVal)) pixVal = NO_DATA;
+						sciStamp[y*dim+x] = pixVal;
+						if (method == COADD_WEIGHTED)
+							var[epochs*stampSize+y*dim+x] =
+								imgs[i].getVariance().getPixelInterp(px, py);
+					}
+				}
+				epochs++;
+			}
+			float *coadd = out+static_cast<long>(n)*stampSize;
+			for (int p=0; p<stampSize; ++p)
+			{
+				double total = 0.0;
+				double weights = 0.0;
+				int valid = 0;
+				for (int e=0; e<epochs; ++e)
+				{
+					float pixVal = sci[e*stampSize+p];
+					if (pixVal == NO_DATA) continue;
+					if (method == COADD_WEIGHTED) {
+						float varVal = var[e*stampSize+p];
+						if (varVal == NO_DATA || varVal <= 0.0) continue;
+						total += pixVal/varVal;
+						weights += 1.0/varVal;
+					} else {
+						total += pixVal;
+					}
+					pixVals[valid++] = pixVal;
+				}
+				float value = 0.0;
+				if (valid > 0) {
+					if (method == COADD_SUM) value = total;
+					else if (method == COADD_MEAN) value = total/valid;
+					else if (method == COADD_MEDIAN)
+						value = ImageStack::medianPixels(pixVals.data(), valid);
+					else value = total/weights;
+				}
+				coadd[p] = value;
+			}
+		}
+	}
+}
+
 RawImage KBMOSearch::stackedScience(trajRegion& t, int radius)
 {
 	std::vector<RawImage*> imgs;
@@ -932,6 +1675,172 @@ std::vector<float> KBMOSearch::phiCurves(trajectory& t)
 	for (auto& im : phiImages) imgs.push_back(&im);
 	return createCurves(t, imgs);
 }
+void KBMOSearch::psiPhiCurves(const trajectory *trajs, int count,
+		float *psiOut, float *phiOut)
+{
+    /*Generate psi and phi lightcurves for many trajectories at once
+     *  INPUT-
+     *    const trajectory *trajs - The trajectories to find lightcurves for
+     *    int count - The number of trajectories
+     *  OUTPUT-
+     *    float *psiOut, float *phiOut - Row major count x imgCount arrays,
+     *      filled with the same values as psiCurves and phiCurves
+     */
+	SharedReader reader(*this, false);
+	const int imgCount = psiImages.size();
+	#pragma omp parallel for
+	for (int n=0; n<count; ++n)
+	{
+		curveRow(trajs[n], psiOut+static_cast<long>(n)*imgCount,
+				phiOut+static_cast<long>(n)*imgCount);
+	}
+}
+
+void KBMOSearch::curveRow(const trajectory& t, float *psiRow, float *phiRow)
+{
+	// Same pixels as createCurves, psi and phi must be prepared
+	const std::vector<float>& times = stack.getTimes();
+	const int imgCount = psiImages.size();
+	for (int i=0; i<imgCount; ++i)
+	{
+		int x = t.x + int(times[i] * t.xVel + 0.5);
+		int y = t.y + int(times[i] * t.yVel + 0.5);
+		float psiVal = psiImages[i].getPixel(x, y);
+		float phiVal = phiImages[i].getPixel(x, y);
+		psiRow[i] = psiVal == NO_DATA ? 0.0 : psiVal;
+		phiRow[i] = phiVal == NO_DATA ? 0.0 : phiVal;
+	}
+}
+
+void KBMOSearch::sigmaGFilter(const trajectory *trajs, int count,
+		float lowerPercentile, float upperPercentile, float coeff,
+		float nSigma, bool fluxFilter, unsigned char *keepOut, float *lhOut)
+{
+	/*Clip outlying epochs from the light curves of many trajectories
+	 *  INPUT-
+	 *    const trajectory *trajs - The trajectories to filter
+	 *    int count - The number of trajectories
+	 *    float lowerPercentile, upperPercentile - The percentiles sigmaG
+	 *      is measured between
+	 *    float coeff - The sigmaG coefficient for those percentiles
+	 *    float nSigma - Epochs more than nSigma*sigmaG from the median
+	 *      are clipped
+	 *    bool fluxFilter - Clip on psi/phi instead of psi/sqrt(phi)
+	 *  OUTPUT-
+	 *    unsigned char *keepOut - Row major count x imgCount flags of
+	 *      the kept epochs
+	 *    float *lhOut - The likelihood of each trajectory over the kept
+	 *      epochs, 0 if none are kept
+	 *
+	 * Matches PostProcess._clipped_sigmaG, including numpy's linear
+	 * percentile interpolation.
+	 */
+	checkPercentiles(lowerPercentile, upperPercentile);
+	SharedReader reader(*this, false);
+	const int imgCount = psiImages.size();
+	#pragma omp parallel
+	{
+		std::vector<float> psi(imgCount);
+		std::vector<float> phi(imgCount);
+		std::vector<float> lh(imgCount);
+		std::vector<float> sorted(imgCount);
+		#pragma omp for
+		for (int n=0; n<count; ++n)
+		{
+			curveRow(trajs[n], psi.data(), phi.data());
+			lhOut[n] = sigmaGRow(psi.data(), phi.data(), lowerPercentile,
+					upperPercentile, coeff, nSigma, fluxFilter, lh, sorted,
+					keepOut+static_cast<long>(n)*imgCount);
+		}
+	}
+}
+
+void KBMOSearch::sigmaGFilter(const float *psiIn, const float *phiIn,
+		int count, int imgCount, float lowerPercentile,
+		float upperPercentile, float coeff, float nSigma, bool fluxFilter,
+		unsigned char *keepOut, float *lhOut)
+{
+	/*Clip outlying epochs from light curves already read
+	 *  INPUT-
+	 *    const float *psiIn, *phiIn - Row major count x imgCount psi and
+	 *      phi curves, as filled by psiPhiCurves
+	 *    int count - The number of curves
+	 *    int imgCount - The length of each curve
+	 *    The rest as in sigmaGFilter for trajectories
+	 *  OUTPUT-
+	 *    As in sigmaGFilter for trajectories
+	 */
+	checkPercentiles(lowerPercentile, upperPercentile);
+	#pragma omp parallel
+	{
+		std::vector<float> lh(imgCount);
+		std::vector<float> sorted(imgCount);
+		#pragma omp for
+		for (int n=0; n<count; ++n)
+		{
+			const long row = static_cast<long>(n)*imgCount;
+			lhOut[n] = sigmaGRow(psiIn+row, phiIn+row, lowerPercentile,
+					upperPercentile, coeff, nSigma, fluxFilter, lh, sorted,
+					keepOut+row);
+		}
+	}
+}
+
+void KBMOSearch::checkPercentiles(float lowerPercentile, float upperPercentile)
+{
+	if (lowerPercentile < 0.0 || upperPercentile > 100.0 ||
+		lowerPercentile > upperPercentile)
+		throw std::runtime_error("sigmaG percentiles must be in [0, 100]");
+}
+
+float KBMOSearch::sigmaGRow(const float *psi, const float *phi,
+		float lowerPercentile, float upperPercentile, float coeff,
+		float nSigma, bool fluxFilter, std::vector<float>& lh,
+		std::vector<float>& sorted, unsigned char *keep)
+{
+	// Clip one light curve, lh and sorted are scratch space the
+	// length of the curve. Returns the likelihood of the kept epochs
+	const int imgCount = lh.size();
+	for (int i=0; i<imgCount; ++i)
+	{
+		float maskedPhi = phi[i] == 0.0 ? 1e9f : phi[i];
+		lh[i] = fluxFilter ? psi[i]/maskedPhi : psi[i]/std::sqrt(maskedPhi);
+	}
+	sorted = lh;
+	std::sort(sorted.begin(), sorted.end());
+	float lower = percentile(sorted, lowerPercentile);
+	float median = percentile(sorted, 50.0);
+	float upper = percentile(sorted, upperPercentile);
+	float nSigmaG = nSigma*(coeff*(upper-lower));
+	double psiSum = 0.0;
+	double phiSum = 0.0;
+	bool kept = false;
+	bool allZero = true;
+	for (int i=0; i<imgCount; ++i)
+	{
+		keep[i] = lh[i] > median-nSigmaG && lh[i] < median+nSigmaG;
+		if (!keep[i]) continue;
+		kept = true;
+		if (psi[i] != 0.0) allZero = false;
+		psiSum += psi[i];
+		phiSum += phi[i];
+	}
+	return (!kept || allZero) ? 0.0 : psiSum/std::sqrt(phiSum);
+}
+
+float KBMOSearch::percentile(const std::vector<float>& sorted, float q)
+{
+	// numpy's default linear interpolation between closest ranks
+	if (sorted.empty()) return 0.0;
+	double rank = q/100.0*(sorted.size()-1);
+	unsigned below = static_cast<unsigned>(rank);
+	if (below >= sorted.size()-1) return sorted.back();
+	float t = rank-below;
+	float a = sorted[below];
+	float b = sorted[below+1];
+	return t >= 0.5 ? b-(b-a)*(1.0f-t) : a+(b-a)*t;
+}
+
 std::vector<RawImage>& KBMOSearch::getPsiImages() {
 	return psiImages;
 }
@@ -956,6 +1865,48 @@ void KBMOSearch::sortResults()
 	});
 }
 
+void KBMOSearch::suppressResults()
+{
+	// Keep a result only if no kept, more likely result starts within
+	// nmsPixelTolerance pixels and moves within nmsVelocityTolerance in
+	// both x and y. Results must already be sorted. Kept results are
+	// bucketed in square cells of the tolerance so only the neighbouring
+	// cells have to be checked.
+	const int cell = std::max(1, static_cast<int>(std::ceil(nmsPixelTolerance)));
+	const int cellsX = stack.getWidth()/cell+1;
+	const int cellsY = stack.getHeight()/cell+1;
+	std::vector<std::vector<unsigned>> grid(cellsX*cellsY);
+	std::vector<trajectory> kept;
+	for (auto& t : results)
+	{
+		int cx = t.x/cell;
+		int cy = t.y/cell;
+		bool duplicate = false;
+		for (int gy=std::max(cy-1, 0); gy<=std::min(cy+1, cellsY-1) && !duplicate; ++gy)
+		{
+			for (int gx=std::max(cx-1, 0); gx<=std::min(cx+1, cellsX-1) && !duplicate; ++gx)
+			{
+				for (unsigned k : grid[gy*cellsX+gx])
+				{
+					const trajectory& best = kept[k];
+					if (std::abs(static_cast<float>(t.x)-best.x) <= nmsPixelTolerance &&
+						std::abs(static_cast<float>(t.y)-best.y) <= nmsPixelTolerance &&
+						std::abs(t.xVel-best.xVel) <= nmsVelocityTolerance &&
+						std::abs(t.yVel-best.yVel) <= nmsVelocityTolerance) {
+						duplicate = true;
+						break;
+					}
+				}
+			}
+		}
+		if (duplicate) continue;
+		grid[std::min(cy, cellsY-1)*cellsX+std::min(cx, cellsX-1)].push_back(kept.size());
+		kept.push_back(t);
+	}
+	setStat("results_suppressed", results.size()-kept.size());
+	results = std::move(kept);
+}
+
 void KBMOSearch::filterResults(int minObservations)
 {
 	results.erase(
@@ -968,7 +1919,12 @@ void KBMOSearch::filterResults(int minObservations)
 
 std::vector<trajectory> KBMOSearch::getResults(int start, int count){
 	if (start<0) throw std::runtime_error("start must be 0 or greater");
-	return std::vector<trajectory>(results.begin()+start, results.begin()+start+count);
+	if (count<0) throw std::runtime_error("count must be 0 or greater");
+	// Suppression can leave fewer results than asked for
+	int size = results.size();
+	int first = std::min(start, size);
+	int last = first+std::min(count, size-first);
+	return std::vector<trajectory>(results.begin()+first, results.begin()+last);
 }
 
 void KBMOSearch::saveResults(std::string path, float portion)
@@ -991,22 +1947,68 @@ void KBMOSearch::saveResults(std::string path, float portion)
 	}
 }
 
-void KBMOSearch::startTimer(std::string message)
+std::map<std::string, double> KBMOSearch::getStats()
 {
-	if (debugInfo) {
-		std::cout << message << "... " << std::flush;
-		tStart = std::chrono::system_clock::now();
+	std::map<std::string, double> stats;
+	{
+		std::lock_guard<std::mutex> lock(statsLock);
+		stats = stageStats;
 	}
+	stats["pixels_read"] = totalPixelsRead;
+	stats["regions_bounded"] = regionsMaxed;
+	stats["regions_bounded_4d"] = searchRegionsBounded;
+	stats["trajectories_evaluated"] = individualEval;
+	stats["nodes_processed"] = nodesProcessed;
+	stats["regions_spilled"] = regionsSpilled;
+	stats["spill_merges"] = spillMerges;
+	stats["spill_compactions"] = spillCompactions;
+	stats["bytes_allocated"] = bytesAllocated;
+	{
+		std::lock_guard<std::mutex> lock(pyramidLock);
+		stats["bytes_psi_phi"] = 2.0*sizeof(float)*psiImages.size()*stack.getPPI();
+		stats["bytes_pyramids"] = pyramidBytes();
+	}
+	stats["bytes_results"] = results.size()*sizeof(trajectory);
+	return stats;
 }
 
-void KBMOSearch::endTimer()
+unsigned long long KBMOSearch::pyramidBytes()
 {
+	unsigned long long pixels = 0;
+	for (auto *set : {&pooledPsi, &pooledPhi, &psiIndex, &phiIndex})
+		for (auto& pyramid : *set)
+			for (auto& level : pyramid) pixels += level.getPPI();
+	return pixels*sizeof(float);
+}
+
+void KBMOSearch::setStat(const std::string& key, double value)
+{
+	std::lock_guard<std::mutex> lock(statsLock);
+	stageStats[key] = value;
+}
+
+void KBMOSearch::startTimer(const std::string& stage, const std::string& message)
+{
+	{
+		std::lock_guard<std::mutex> lock(statsLock);
+		stageStarts[stage] = std::chrono::system_clock::now();
+	}
+	if (debugInfo) std::cout << message << "... " << std::flush;
+}
+
+double KBMOSearch::endTimer(const std::string& stage)
+{
+	std::chrono::duration<double> elapsed;
+	{
+		std::lock_guard<std::mutex> lock(statsLock);
+		elapsed = std::chrono::system_clock::now()-stageStarts[stage];
+		stageStats["time_"+stage] = elapsed.count();
+	}
 	if (debugInfo) {
-		tEnd = std::chrono::system_clock::now();
-		tDelta = tEnd-tStart;
-		std::cout << " Took " << tDelta.count()
+		std::cout << " Took " << elapsed.count()
 				<< " seconds.\n" << std::flush;
 	}
+	return elapsed.count();
 }
 
 } /* namespace kbmod */
@@ -12,6 +12,14 @@
 #include <algorithm>
 #include <functional>
 #include <queue>
+#include <atomic>
+#include <omp.h>
+#include <mutex>
+#include <condition_variable>
+#include <tuple>
+#include <map>
+#include <string>
+#include <utility>
 #include <iostream>
 #include <fstream>
 #include <chrono>
@@ -22,13 +30,15 @@
 #include "common.h"
 #include "PointSpreadFunc.h"
 #include "ImageStack.h"
+#include "RegionQueue.h"
+#include "PyramidOverlay.h"
 
 namespace kbmod {
 
 extern "C" void
 deviceSearch(int trajCount, int imageCount, int minObservations, int psiPhiSize,
 			 int resultsCount, trajectory *trajectoriesToSearch, trajectory *bestTrajects,
-		     float *imageTimes, float *interleavedPsiPhi, int width, int height);
+		     const float *imageTimes, float *interleavedPsiPhi, int width, int height);
 
 extern "C" void
 devicePooledSetup(int imageCount, int depth, float *times, int *dimensions, float *interleavedImages,
@@ -41,6 +51,23 @@ extern "C" void
 deviceLHBatch(int imageCount, int depth, int regionCount, trajRegion *regions,
 		float **deviceTimes, float **deviceImages, float **deviceDimensions);
 
+/*
+ * One region search's copy-on-write view of the shared
+ * psi/phi pyramids and their bound indices
+ */
+struct RegionView {
+	RegionView(std::vector<std::vector<RawImage>>& psiPyramid,
+			std::vector<std::vector<RawImage>>& phiPyramid,
+			std::vector<std::vector<RawImage>>& psiBounds,
+			std::vector<std::vector<RawImage>>& phiBounds) :
+		psi(psiPyramid), phi(phiPyramid),
+		psiIndex(psiBounds), phiIndex(phiBounds) {}
+	PyramidOverlay psi;
+	PyramidOverlay phi;
+	PyramidOverlay psiIndex;
+	PyramidOverlay phiIndex;
+};
+
 class KBMOSearch {
 public:
 	KBMOSearch(ImageStack& imstack, PointSpreadFunc& PSF);
@@ -52,17 +79,31 @@ public:
 	void filterResults(int minObservations);
 	std::vector<trajRegion> regionSearch(float xVel, float yVel,
 			float radius, float minLH, int minObservations);
+	std::vector<trajRegion> regionSearchDiscs(
+			std::vector<std::tuple<float,float,float>> discs,
+			float minLH, int minObservations);
+	std::vector<trajRegion> regionSearchPolygon(
+			std::vector<std::pair<float,float>> vertices,
+			float minLH, int minObservations);
 	trajRegion& calculateLH(trajRegion& t);
 	std::vector<float> observeTrajectory(
 			trajRegion& t, std::vector<std::vector<RawImage>>& pooledImgs, int poolType);
 	float findExtremeInRegion(float x, float y, int size,
 			std::vector<RawImage>& pooledImgs, int poolType);
+	float findIndexedExtreme(float x, float y, int size,
+			unsigned img, int poolType);
 	int biggestFit(int x, int y, int maxX, int maxY); // inline?
 	float readPixelDepth(int depth, int x, int y, std::vector<RawImage>& pooledImgs);
 	std::vector<trajRegion>& calculateLHBatch(std::vector<trajRegion>& tlist);
 	std::vector<trajRegion> subdivide(trajRegion& t);
 	std::vector<trajRegion>& filterBounds(std::vector<trajRegion>& tlist,
 			float xVel, float yVel, float ft, float radius);
+	std::vector<trajRegion>& filterBounds(std::vector<trajRegion>& tlist,
+			const std::vector<velocityDisc>& discs,
+			const std::vector<std::pair<float,float>>& polygon, float ft);
+	bool discOverlaps(trajRegion& t, const velocityDisc& disc, float ft);
+	bool polygonOverlaps(trajRegion& t,
+			const std::vector<std::pair<float,float>>& polygon, float ft);
 	float squareSDF(float scale, float centerX, float centerY,
 			float pointX, float pointY);
 	std::vector<trajRegion>& filterLH(std::vector<trajRegion>& tlist, float minLH, int minObs);
@@ -84,6 +125,21 @@ public:
 	std::vector<RawImage> phiStamps(trajectory& t, int radius);
     std::vector<float> psiCurves(trajectory& t);
     std::vector<float> phiCurves(trajectory& t);
+	void psiPhiCurves(const trajectory *trajs, int count,
+			float *psiOut, float *phiOut);
+	void sigmaGFilter(const trajectory *trajs, int count,
+			float lowerPercentile, float upperPercentile, float coeff,
+			float nSigma, bool fluxFilter, unsigned char *keepOut, float *lhOut);
+	void sigmaGFilter(const float *psiIn, const float *phiIn,
+			int count, int imgCount, float lowerPercentile,
+			float upperPercentile, float coeff, float nSigma, bool fluxFilter,
+			unsigned char *keepOut, float *lhOut);
+	void scienceStampsBatch(const trajectory *trajs, int count,
+			int radius, float *out);
+	void stackedScienceBatch(const trajectory *trajs, int count,
+			int radius, float *out);
+	void coaddStampsBatch(const trajectory *trajs, int count, int radius,
+			short method, const unsigned char *epochMask, float *out);
 	std::vector<trajectory> getResults(int start, int end);
 	std::vector<RawImage>& getPsiImages();
     std::vector<RawImage>& getPhiImages();
@@ -92,6 +148,12 @@ public:
  	void clearPsiPhi();
 	void saveResults(std::string path, float fraction);
 	void setDebug(bool d) { debugInfo = d; };
+	unsigned getImageCount() { return stack.imgCount(); };
+	std::map<std::string, double> getStats();
+	void setFrontierBudget(unsigned long long bytes) { frontierBudget = bytes; };
+	void setRegionBatchSize(unsigned size);
+	void enableNMS(float pixelTolerance, float velocityTolerance);
+	void disableNMS() { nmsEnabled = false; };
 	virtual ~KBMOSearch() {};
 
 private:
@@ -99,19 +161,50 @@ private:
 			float maxAngle, float minVelocity, float maxVelocity, int minObservations);
 	std::vector<trajRegion> resSearch(float xVel, float yVel,
 			float radius, int minObservations, float minLH);
+	std::vector<trajRegion> resSearch(const std::vector<velocityDisc>& discs,
+			const std::vector<std::pair<float,float>>& polygon,
+			int minObservations, float minLH, long long& nodes);
+	std::vector<trajRegion> areaSearch(const std::vector<velocityDisc>& discs,
+			const std::vector<std::pair<float,float>>& polygon,
+			float minLH, int minObservations);
 	std::vector<trajRegion> resSearchGPU(float xVel, float yVel,
 			float radius, int minObservations, float minLH);
 	void clearPooled();
+	void curveRow(const trajectory& t, float *psiRow, float *phiRow);
+	void checkPercentiles(float lowerPercentile, float upperPercentile);
+	float sigmaGRow(const float *psi, const float *phi,
+			float lowerPercentile, float upperPercentile, float coeff,
+			float nSigma, bool fluxFilter, std::vector<float>& lh,
+			std::vector<float>& sorted, unsigned char *keep);
+	float percentile(const std::vector<float>& sorted, float q);
 	void preparePsiPhi();
+	void buildPsiPhi();
+	void releasePsiPhi();
 	void poolAllImages();
-	std::vector<std::vector<RawImage>>& poolSet(
-			std::vector<RawImage> imagesToPool,
-			std::vector<std::vector<RawImage>>& destination, short mode);
-	std::vector<RawImage> poolSingle(std::vector<RawImage>& mip, RawImage& img, short mode);
-	void repoolArea(trajRegion& t);
+	float regionExtreme(float x, float y, int size,
+			std::vector<RawImage>& pooledImgs, int poolType, long& pixelsRead);
+	trajRegion& calculateLH(trajRegion& t, RegionView& view);
+	std::vector<trajRegion>& calculateLHBatch(
+			std::vector<trajRegion>& tlist, RegionView& view);
+	float indexedExtreme(float x, float y, int size,
+			PyramidOverlay& pyramid, PyramidOverlay& index, unsigned img,
+			int poolType, long& pixelsRead);
+	void indexPyramid(std::vector<RawImage>& pyramid,
+			std::vector<RawImage>& index, int poolType);
+	void indexArea(RawImage& level, RawImage& index, int poolType,
+			int x0, int y0, int x1, int y1);
+	void indexArea(PyramidOverlay& pyramid, PyramidOverlay& index,
+			unsigned img, unsigned depth, int poolType,
+			int x0, int y0, int x1, int y1);
+	void windowExtremes(std::vector<float>& patch, int pw, int ph, int poolType);
+	void poolPair(RawImage& psi, RawImage& phi,
+			std::vector<RawImage>& psiMip, std::vector<RawImage>& phiMip);
+	void poolRow(RawImage& srcPsi, RawImage& srcPhi,
+			RawImage& destPsi, RawImage& destPhi, unsigned row);
+	void repoolArea(trajRegion& t, RegionView& view);
 	void cpuConvolve();
 	void gpuConvolve();
-	void removeObjectFromImages(trajRegion& t);
+	void removeObjectFromImages(trajRegion& t, RegionView& view);
 	void saveImages(std::string path);
 	void createSearchList(int angleSteps, int veloctiySteps, float minAngle,
 			float maxAngle, float minVelocity, float maxVelocity);
@@ -119,18 +212,36 @@ private:
 	void cpuSearch(int minObservations);
 	void gpuSearch(int minObservations);
 	void sortResults();
-	void startTimer(std::string message);
-	void endTimer();
-	long int totalPixelsRead;
-	long int regionsMaxed;
-	long int searchRegionsBounded;
-	long int individualEval;
-	long long nodesProcessed;
+	void suppressResults();
+	void startTimer(const std::string& stage, const std::string& message);
+	double endTimer(const std::string& stage);
+	void setStat(const std::string& key, double value);
+	unsigned long long pyramidBytes();
+	// Updated from several threads during region search
+	std::atomic<long> totalPixelsRead;
+	std::atomic<long> regionsMaxed;
+	std::atomic<long> searchRegionsBounded;
+	std::atomic<long> individualEval;
+	std::atomic<long long> nodesProcessed;
 	unsigned maxResultCount;
+	unsigned long long frontierBudget;
+	unsigned regionBatchSize;
 	bool psiPhiGenerated;
+	// Non-maximum suppression of the sorted grid search results
+	bool nmsEnabled;
+	float nmsPixelTolerance;
+	float nmsVelocityTolerance;
 	bool debugInfo;
-	std::chrono::time_point<std::chrono::system_clock> tStart, tEnd;
-	std::chrono::duration<double> tDelta;
+	std::atomic<long long> regionsSpilled;
+	std::atomic<long long> spillMerges;
+	std::atomic<long long> spillCompactions;
+	std::atomic<long long> bytesAllocated;
+	// Stage timings and rates of the latest run of each stage. Region
+	// searches may overlap, each records its stats together when done
+	std::map<std::string, double> stageStats;
+	std::map<std::string,
+		std::chrono::time_point<std::chrono::system_clock>> stageStarts;
+	std::mutex statsLock;
 	ImageStack stack;
 	PointSpreadFunc psf;
 	PointSpreadFunc psfSQ;
@@ -139,6 +250,21 @@ private:
 	std::vector<RawImage> phiImages;
 	std::vector<std::vector<RawImage>> pooledPsi;
 	std::vector<std::vector<RawImage>> pooledPhi;
+	std::vector<std::vector<RawImage>> psiIndex;
+	std::vector<std::vector<RawImage>> phiIndex;
+	// Guards building and freeing the psi/phi images and pyramids
+	std::mutex pyramidLock;
+	std::condition_variable readersDone;
+	unsigned sharedReaders;
+	/*
+	 * Builds the shared psi/phi images, and the pyramids if asked,
+	 * then keeps clearPsiPhi from freeing them until it is destroyed
+	 */
+	struct SharedReader {
+		SharedReader(KBMOSearch& s, bool pyramids);
+		~SharedReader();
+		KBMOSearch& search;
+	};
 	std::vector<float> interleavedPsiPhi;
 	std::vector<trajectory> results;
 
@@ -22,7 +22,12 @@ LayeredImage::LayeredImage(std::string path) {
 }
 
 LayeredImage::LayeredImage(std::string name, int w, int h,
-		float noiseStDev, float pixelVariance, double time)
+		float noiseStDev, float pixelVariance, double time) :
+		LayeredImage(name, w, h, noiseStDev, pixelVariance, time,
+				std::random_device()()) {}
+
+LayeredImage::LayeredImage(std::string name, int w, int h,
+		float noiseStDev, float pixelVariance, double time, unsigned long seed)
 {
 	fileName = name;
 	pixelsPerImage = w*h;
@@ -30,10 +35,21 @@ LayeredImage::LayeredImage(std::string name, int w, int h,
 	height = h;
 	captureTime = time;
 	std::vector<float> rawSci(pixelsPerImage);
-	std::random_device r;
-	std::default_random_engine generator(r());
-	std::normal_distribution<float> distrib(0.0, noiseStDev);
-	for (float& p : rawSci) p = distrib(generator);
+	// Box-Muller on counter based uniforms, one pair of pixels per
+	// counter, so the same seed always gives the same noise
+	const uint64_t key = splitMix64(seed);
+	const int pairs = (pixelsPerImage+1)/2;
+	#pragma omp parallel for
+	for (int p=0; p<pairs; ++p)
+	{
+		uint64_t bits = splitMix64(key+p);
+		// 32 bits for the radius keep tails out to about 6.7 sigma
+		float u1 = ((bits >> 32)+1.0f)*(1.0f/4294967296.0f);
+		float angle = (bits & 0xFFFFFF)*(2.0f*static_cast<float>(M_PI)/16777216.0f);
+		float r = noiseStDev*std::sqrt(-2.0f*std::log(u1));
+		rawSci[2*p] = r*std::cos(angle);
+		if (2*p+1 < pixelsPerImage) rawSci[2*p+1] = r*std::sin(angle);
+	}
 	science = RawImage(w,h, rawSci);
 	mask = RawImage(w,h,std::vector<float>(pixelsPerImage, 0.0));
 	variance = RawImage(w,h,std::vector<float>(pixelsPerImage, pixelVariance));
@@ -100,29 +116,45 @@ void LayeredImage::readFitsImg(const char *name, float *target)
 		fits_report_error(stderr, status);
 }
 
-void LayeredImage::addObject(float x, float y, float flux, PointSpreadFunc psf)
+void LayeredImage::addObject(float x, float y, float flux, PointSpreadFunc& psf)
 {
-	std::vector<float> k = psf.getKernel();
+	const float *k = psf.kernelData();
 	int dim = psf.getDim();
+	int shiftedDim = dim+1;
 	float initialX = x-static_cast<float>(psf.getRadius());
 	float initialY = y-static_cast<float>(psf.getRadius());
-	int count = 0;
+	// Every kernel pixel lands at the same subpixel offset, so the
+	// bilinear weights of the first one hold for all of them. Fold them
+	// into a kernel one pixel wider and add that in a single pass.
+	std::array<float,12> iv = science.bilinearInterp(initialX, initialY);
+	// Corners in the order of bilinearInterp, relative to the bottom left
+	const int offsetX[4] = {1, 1, 0, 0};
+	const int offsetY[4] = {1, 0, 0, 1};
+	std::vector<float> shifted(shiftedDim*shiftedDim, 0.0);
 	// Does x/y order need to be flipped?
-	for (int i=0; i<dim; ++i)
+	for (int c=0; c<4; ++c)
 	{
-		for (int j=0; j<dim; ++j)
+		float amount = iv[c*3+2];
+		for (int i=0; i<dim; ++i)
+		{
+			float *row = &shifted[(i+offsetX[c])*shiftedDim+offsetY[c]];
+			for (int j=0; j<dim; ++j)
+				row[j] += k[i*dim+j]*amount;
+		}
+	}
+	for (int i=0; i<shiftedDim; ++i)
+	{
+		for (int j=0; j<shiftedDim; ++j)
 		{
-			science.addPixelInterp(initialX+static_cast<float>(i),
-					               initialY+static_cast<float>(j),
-					               flux*k[count]);
-			count++;
+			science.addToPixel(iv[6]+static_cast<float>(i),
+					iv[7]+static_cast<float>(j),
+					flux*shifted[i*shiftedDim+j]);
 		}
 	}
 }
 
-void LayeredImage::maskObject(float x, float y, PointSpreadFunc psf)
+void LayeredImage::maskObject(float x, float y, PointSpreadFunc& psf)
 {
-	std::vector<float> k = psf.getKernel();
 	int dim = psf.getDim();
 	float initialX = x-static_cast<float>(psf.getRadius());
 	float initialY = y-static_cast<float>(psf.getRadius());
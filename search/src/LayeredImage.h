@@ -13,6 +13,7 @@
 #include <iostream>
 #include <string>
 #include <random>
+#include <cmath>
 #include <assert.h>
 #include <stdexcept>
 #include "RawImage.h"
@@ -25,12 +26,14 @@ public:
 	LayeredImage(std::string path);
 	LayeredImage(std::string name, int w, int h,
 		float noiseStDev, float pixelVariance, double time);
+	LayeredImage(std::string name, int w, int h,
+		float noiseStDev, float pixelVariance, double time, unsigned long seed);
 	void applyMaskFlags(int flag, std::vector<int> exceptions);
 	void applyMasterMask(RawImage masterMask);
 	void applyMaskThreshold(float thresh);
 	void subtractTemplate(RawImage subTemplate);
-	void addObject(float x, float y, float flux, PointSpreadFunc psf);
-	void maskObject(float x, float y, PointSpreadFunc psf);
+	void addObject(float x, float y, float flux, PointSpreadFunc& psf);
+	void maskObject(float x, float y, PointSpreadFunc& psf);
 	void growMask();
 	void saveLayers(std::string path);
 	void saveSci(std::string path);
@@ -0,0 +1,120 @@
+/*
+ * PyramidOverlay.cpp
+ *
+ *  Created on: Oct 18, 2026
+ *      Author: kbmod-usr
+ */
+
+#include "PyramidOverlay.h"
+
+namespace kbmod {
+
+PyramidOverlay::PyramidOverlay(std::vector<std::vector<RawImage>>& base) :
+		pyramids(base)
+{
+	const int tile = 1 << OVERLAY_TILE_ORDER;
+	// Every image has the same number of levels
+	depth = pyramids.empty() ? 0 : pyramids[0].size();
+	levels.reserve(pyramids.size()*depth);
+	for (auto& pyramid : pyramids)
+	{
+		for (auto& im : pyramid)
+		{
+			Level l;
+			l.data = im.getDataRef();
+			l.width = im.getWidth();
+			l.height = im.getHeight();
+			l.tilesX = (l.width+tile-1)/tile;
+			// Empty box until a tile is written
+			l.minX = l.minY = l.maxX = l.maxY = 0;
+			levels.push_back(l);
+		}
+	}
+}
+
+void PyramidOverlay::setPixel(unsigned img, unsigned level, int x, int y, float value)
+{
+	Level& l = levels[img*depth+level];
+	if (x<0 || y<0 || x>=l.width || y>=l.height) return;
+	const int tile = 1 << OVERLAY_TILE_ORDER;
+	const int mask = tile-1;
+	if (l.table.empty())
+		l.table.assign(l.tilesX*((l.height+tile-1)/tile), -1);
+	int tx = x >> OVERLAY_TILE_ORDER;
+	int ty = y >> OVERLAY_TILE_ORDER;
+	int& slot = l.table[ty*l.tilesX+tx];
+	if (slot < 0) {
+		// First write to this tile, copy it from the shared pyramid
+		std::vector<float> copy(tile*tile, NO_DATA);
+		int x0 = tx*tile;
+		int y0 = ty*tile;
+		int w = std::min(tile, l.width-x0);
+		int h = std::min(tile, l.height-y0);
+		for (int j=0; j<h; ++j)
+		{
+			float *row = l.data+(y0+j)*l.width+x0;
+			std::copy(row, row+w, copy.begin()+j*tile);
+		}
+		slot = tiles.size();
+		tiles.push_back(std::move(copy));
+		if (l.maxX == 0) {
+			l.minX = x0;
+			l.minY = y0;
+			l.maxX = x0+tile;
+			l.maxY = y0+tile;
+		} else {
+			l.minX = std::min(l.minX, x0);
+			l.minY = std::min(l.minY, y0);
+			l.maxX = std::max(l.maxX, x0+tile);
+			l.maxY = std::max(l.maxY, y0+tile);
+		}
+	}
+	tiles[slot][((y & mask) << OVERLAY_TILE_ORDER) + (x & mask)] = value;
+}
+
+float PyramidOverlay::getPixelInterp(unsigned img, unsigned level, float x, float y)
+{
+	// Same as RawImage::getPixelInterp, reading through the overlay
+	const Level& l = levels[img*depth+level];
+	if ((x<0.0 || y<0.0) || (x>static_cast<float>(l.width) ||
+	     y>static_cast<float>(l.height))) return NO_DATA;
+	std::array<float,12> iv = pyramids[img][level].bilinearInterp(x,y);
+	float interpSum = 0.0;
+	float total = 0.0;
+	for (int p=0; p<12; p+=3)
+	{
+		float pix = getPixel(img, level, iv[p], iv[p+1]);
+		if (pix != NO_DATA) {
+			interpSum += iv[p+2];
+			total += pix*iv[p+2];
+		}
+	}
+	if (interpSum == 0.0) {
+		return NO_DATA;
+	} else {
+		return total/interpSum;
+	}
+}
+
+void PyramidOverlay::maskObject(unsigned img, unsigned level,
+		float x, float y, PointSpreadFunc& psf)
+{
+	// Same area as RawImage::maskObject
+	RawImage& base = pyramids[img][level];
+	int dim = psf.getDim()*2;
+	float initialX = x-static_cast<float>(psf.getRadius()*2);
+	float initialY = y-static_cast<float>(psf.getRadius()*2);
+	for (int i=0; i<dim; ++i)
+	{
+		for (int j=0; j<dim; ++j)
+		{
+			std::array<float,12> iv = base.bilinearInterp(
+					initialX+static_cast<float>(i),
+					initialY+static_cast<float>(j));
+			for (int p=0; p<12; p+=3)
+				setPixel(img, level, iv[p], iv[p+1], NO_DATA);
+		}
+	}
+}
+
+} /* namespace kbmod */
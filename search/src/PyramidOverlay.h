@@ -0,0 +1,74 @@
+/*
+ * PyramidOverlay.h
+ *
+ *  Created on: Oct 18, 2026
+ *      Author: kbmod-usr
+ *
+ * Copy-on-write view of a set of image pyramids. Writes go to
+ * square tiles owned by the overlay, so the shared pyramids are
+ * never modified and several searches can read them at once.
+ * Reads are safe from many threads as long as nothing is written.
+ */
+
+#ifndef PYRAMIDOVERLAY_H_
+#define PYRAMIDOVERLAY_H_
+
+#include <vector>
+#include <array>
+#include "common.h"
+#include "RawImage.h"
+#include "PointSpreadFunc.h"
+
+namespace kbmod {
+
+class PyramidOverlay {
+public:
+	PyramidOverlay(std::vector<std::vector<RawImage>>& base);
+	inline float getPixel(unsigned img, unsigned level, int x, int y);
+	void setPixel(unsigned img, unsigned level, int x, int y, float value);
+	float getPixelInterp(unsigned img, unsigned level, float x, float y);
+	void maskObject(unsigned img, unsigned level,
+			float x, float y, PointSpreadFunc& psf);
+	RawImage& getBase(unsigned img, unsigned level)
+			{ return pyramids[img][level]; }
+	int getWidth(unsigned img, unsigned level)
+			{ return levels[img*depth+level].width; }
+	int getHeight(unsigned img, unsigned level)
+			{ return levels[img*depth+level].height; }
+	unsigned levelCount(unsigned img) { return pyramids[img].size(); }
+	unsigned tileCount() { return tiles.size(); }
+private:
+	struct Level {
+		float *data;
+		int width;
+		int height;
+		int tilesX;
+		// Bounding box of the written tiles, in pixels
+		int minX, minY, maxX, maxY;
+		// Tile slot for each tile of the level, -1 until written
+		std::vector<int> table;
+	};
+	std::vector<std::vector<RawImage>>& pyramids;
+	// Levels of every image, image major
+	std::vector<Level> levels;
+	unsigned depth;
+	std::vector<std::vector<float>> tiles;
+};
+
+inline float PyramidOverlay::getPixel(unsigned img, unsigned level, int x, int y)
+{
+	const Level& l = levels[img*depth+level];
+	if (x<0 || y<0 || x>=l.width || y>=l.height) return NO_DATA;
+	if (x>=l.minX && x<l.maxX && y>=l.minY && y<l.maxY) {
+		const int mask = (1 << OVERLAY_TILE_ORDER)-1;
+		int slot = l.table[(y >> OVERLAY_TILE_ORDER)*l.tilesX
+				+ (x >> OVERLAY_TILE_ORDER)];
+		if (slot >= 0) return tiles[slot][
+				((y & mask) << OVERLAY_TILE_ORDER) + (x & mask)];
+	}
+	return l.data[y*l.width+x];
+}
+
+} /* namespace kbmod */
+
+#endif /* PYRAMIDOVERLAY_H_ */
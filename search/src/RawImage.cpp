@@ -164,14 +164,14 @@ void RawImage::growMask()
 
 }
 
-std::vector<float> RawImage::bilinearInterp(float x, float y)
+std::array<float,12> RawImage::bilinearInterp(float x, float y)
 {
 	// Linear interpolation
 	// Find the 4 pixels (aPix, bPix, cPix, dPix)
 	// that the corners (a, b, c, d) of the
 	// new pixel land in, and blend into those
 
-	// Returns a vector with 4 pixel locations
+	// Returns an array with 4 pixel locations
 	// and their interpolation value
 
 	// Top right
@@ -206,16 +206,16 @@ std::vector<float> RawImage::bilinearInterp(float x, float y)
 	float diff = std::abs(aAmount+bAmount+cAmount+dAmount-1.0);
 	if (diff > 0.01) std::cout << "warning: bilinearInterpSum == " << diff << "\n";
 	//assert(std::abs(aAmount+bAmount+cAmount+dAmount-1.0)<0.001);
-	return { aPx, aPy, aAmount,
+	return {{ aPx, aPy, aAmount,
 		 bPx, bPy, bAmount,
 		 cPx, cPy, cAmount,
-		 dPx, dPy, dAmount };
+		 dPx, dPy, dAmount }};
 }
 
 void RawImage::addPixelInterp(float x, float y, float value)
 {
 	// Interpolation values
-	std::vector<float> iv = bilinearInterp(x,y);
+	std::array<float,12> iv = bilinearInterp(x,y);
 
 	addToPixel(iv[0], iv[1], value*iv[2]);
 
@@ -226,9 +226,8 @@ void RawImage::addPixelInterp(float x, float y, float value)
 	addToPixel(iv[9], iv[10],value*iv[11]);
 }
 
-void RawImage::maskObject(float x, float y, PointSpreadFunc psf)
+void RawImage::maskObject(float x, float y, PointSpreadFunc& psf)
 {
-	std::vector<float> k = psf.getKernel();
 	// *2 to mask extra area, to be sure object is masked
 	int dim = psf.getDim()*2;
 	float initialX = x-static_cast<float>(psf.getRadius()*2);
@@ -246,7 +245,7 @@ void RawImage::maskObject(float x, float y, PointSpreadFunc psf)
 
 void RawImage::maskPixelInterp(float x, float y)
 {
-	std::vector<float> iv = bilinearInterp(x,y);
+	std::array<float,12> iv = bilinearInterp(x,y);
 
 	setPixel(iv[0], iv[1], NO_DATA);
 
@@ -285,7 +284,7 @@ float RawImage::getPixelInterp(float x, float y)
 {
 	if ((x<0.0 || y<0.0) || (x>static_cast<float>(width) ||
 	     y>static_cast<float>(height))) return NO_DATA;
-	std::vector<float> iv = bilinearInterp(x,y);
+	std::array<float,12> iv = bilinearInterp(x,y);
 	float a = getPixel(iv[0], iv[1]);
 	float b = getPixel(iv[3], iv[4]);
 	float c = getPixel(iv[6], iv[7]);
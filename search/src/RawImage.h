@@ -9,6 +9,7 @@
 #define RAWIMAGE_H_
 
 #include <vector>
+#include <array>
 #include <fitsio.h>
 #include <iostream>
 #include <string>
@@ -50,10 +51,10 @@ public:
 	void setPixel(int x, int y, float value);
 	void addToPixel(float fx, float fy, float value);
 	void addPixelInterp(float x, float y, float value);
-	void maskObject(float x, float y, PointSpreadFunc psf);
+	void maskObject(float x, float y, PointSpreadFunc& psf);
 	void maskPixelInterp(float x, float y);
 	void growMask();
-	std::vector<float> bilinearInterp(float x, float y);
+	std::array<float,12> bilinearInterp(float x, float y);
 	float getPixel(int x, int y);
 	float getPixelInterp(float x, float y);
 	void saveToFile(std::string path);
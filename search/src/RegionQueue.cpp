@@ -0,0 +1,288 @@
+/*
+ * RegionQueue.cpp
+ *
+ *  Created on: Oct 18, 2026
+ *      Author: kbmod-usr
+ */
+
+#include "RegionQueue.h"
+
+namespace kbmod {
+
+RegionQueue::RegionQueue(unsigned long long memoryBudget)
+{
+	// At most half the budget reads runs back, one buffer for each
+	// open run and one more for writing out a merge
+	const unsigned long long buffers = REGION_MAX_RUNS+1;
+	runBuffer = std::min(std::max(memoryBudget/2/buffers/sizeof(trajRegion), 1ULL),
+			static_cast<unsigned long long>(REGION_RUN_BUFFER));
+	const unsigned long long bufferBytes = buffers*runBuffer*sizeof(trajRegion);
+	heapCapacity = memoryBudget > bufferBytes ?
+			(memoryBudget-bufferBytes)/sizeof(trajRegion) : 0;
+	// Keep at least two regions so a spill always leaves one in memory
+	heapCapacity = std::max(heapCapacity, 2ULL);
+	file = nullptr;
+	fileEnd = 0;
+	filePeak = 0;
+	spilled = 0;
+	onDisk = 0;
+	merges = 0;
+	compactions = 0;
+}
+
+RegionQueue::~RegionQueue()
+{
+	// The temporary file is removed when closed
+	if (file != nullptr) std::fclose(file);
+}
+
+void RegionQueue::push(const trajRegion& t)
+{
+	if (heap.size() >= heapCapacity) spill();
+	if (heap.size() == heap.capacity()) {
+		// Grow by hand so the heap never holds more than its share
+		unsigned long long grown =
+				std::max(2ULL*heap.capacity(), 16ULL);
+		heap.reserve(std::min(grown, heapCapacity));
+	}
+	heap.push_back(t);
+	std::push_heap(heap.begin(), heap.end(), lessLikely);
+}
+
+const trajRegion& RegionQueue::top()
+{
+	assert(!empty());
+	if (runBeforeHeap()) return runs[heads.front()].head();
+	return heap.front();
+}
+
+void RegionQueue::pop()
+{
+	assert(!empty());
+	if (!runBeforeHeap()) {
+		std::pop_heap(heap.begin(), heap.end(), lessLikely);
+		heap.pop_back();
+		return;
+	}
+	auto cmp = [this](unsigned a, unsigned b) { return headLessLikely(a, b); };
+	onDisk--;
+	std::pop_heap(heads.begin(), heads.end(), cmp);
+	unsigned r = heads.back();
+	if (advance(runs[r])) {
+		std::push_heap(heads.begin(), heads.end(), cmp);
+		return;
+	}
+	// The run is used up, move the last run into its slot
+	heads.pop_back();
+	unsigned last = runs.size()-1;
+	if (r != last) {
+		runs[r] = std::move(runs[last]);
+		for (auto& h : heads) if (h == last) h = r;
+	}
+	runs.pop_back();
+	// Everything was read back, write over the file from the start
+	if (runs.empty()) fileEnd = 0;
+}
+
+bool RegionQueue::empty()
+{
+	return heap.empty() && runs.empty();
+}
+
+unsigned long long RegionQueue::size()
+{
+	return heap.size()+onDisk;
+}
+
+bool RegionQueue::runBeforeHeap()
+{
+	// Whether the best run's head beats the heap, ties go to the heap
+	if (heads.empty()) return false;
+	return heap.empty() || lessLikely(heap.front(), runs[heads.front()].head());
+}
+
+void RegionQueue::spill()
+{
+	// Keep the more likely half in memory and write the
+	// rest out most likely first
+	std::sort(heap.begin(), heap.end(),
+			[](const trajRegion& a, const trajRegion& b)
+			{ return a.likelihood > b.likelihood; });
+	unsigned long long keep = heap.size()/2;
+	unsigned long long count = heap.size()-keep;
+	if (file == nullptr) {
+		file = std::tmpfile();
+		if (file == nullptr)
+			throw std::runtime_error("Could not create a file to spill"
+					" the region search frontier to");
+	}
+	compact();
+	unsigned long long offset = fileEnd;
+	write(heap.data()+keep, count);
+	addRun(offset, count, 0);
+	spilled += count;
+	onDisk += count;
+	heap.resize(keep);
+	std::make_heap(heap.begin(), heap.end(), lessLikely);
+	mergeRuns();
+}
+
+void RegionQueue::mergeRuns()
+{
+	// Once REGION_MERGE_WAYS runs share a level merge them into one
+	// run of the next level, so each region is rewritten a logarithmic
+	// number of times. Past REGION_MAX_RUNS merge the smallest runs
+	for (unsigned level=0; ; ++level)
+	{
+		std::vector<unsigned> same;
+		bool deeper = false;
+		for (unsigned i=0; i<runs.size(); ++i)
+		{
+			if (runs[i].level == level) same.push_back(i);
+			deeper = deeper || runs[i].level > level;
+		}
+		if (same.size() >= REGION_MERGE_WAYS) {
+			merge(same);
+		} else if (!deeper) {
+			break;
+		}
+	}
+	while (runs.size() > REGION_MAX_RUNS) {
+		std::vector<unsigned> order(runs.size());
+		for (unsigned i=0; i<order.size(); ++i) order[i] = i;
+		std::sort(order.begin(), order.end(), [this](unsigned a, unsigned b)
+				{ return regionsLeft(runs[a]) < regionsLeft(runs[b]); });
+		order.resize(REGION_MERGE_WAYS);
+		merge(order);
+	}
+}
+
+void RegionQueue::merge(std::vector<unsigned> merging)
+{
+	// Merge the runs into one at the end of the file
+	compact();
+	unsigned level = 0;
+	for (auto r : merging) level = std::max(level, runs[r].level+1);
+	auto cmp = [this](unsigned a, unsigned b) { return headLessLikely(a, b); };
+	std::make_heap(merging.begin(), merging.end(), cmp);
+	unsigned long long offset = fileEnd;
+	unsigned long long count = 0;
+	std::vector<trajRegion> out;
+	out.reserve(runBuffer);
+	while (!merging.empty()) {
+		std::pop_heap(merging.begin(), merging.end(), cmp);
+		unsigned r = merging.back();
+		out.push_back(runs[r].head());
+		if (advance(runs[r])) {
+			std::push_heap(merging.begin(), merging.end(), cmp);
+		} else {
+			// Mark the run used up
+			runs[r].buffer.clear();
+			merging.pop_back();
+		}
+		if (out.size() == runBuffer || merging.empty()) {
+			write(out.data(), out.size());
+			count += out.size();
+			out.clear();
+		}
+	}
+	std::vector<Run> kept;
+	for (auto& r : runs)
+		if (!r.buffer.empty()) kept.push_back(std::move(r));
+	runs.swap(kept);
+	heads.clear();
+	for (unsigned i=0; i<runs.size(); ++i) heads.push_back(i);
+	std::make_heap(heads.begin(), heads.end(), cmp);
+	addRun(offset, count, level);
+	merges++;
+}
+
+void RegionQueue::compact()
+{
+	// Runs are read from the front and merged runs are written at the
+	// end, so the space before them is dead. Once it is more than half
+	// the file move the regions still on disk to its start, keeping
+	// the file within a small multiple of the regions it holds
+	unsigned long long live = 0;
+	for (auto& r : runs) live += r.remaining;
+	if (fileEnd-live <= std::max(live, static_cast<unsigned long long>(runBuffer)))
+		return;
+	std::vector<unsigned> order(runs.size());
+	for (unsigned i=0; i<order.size(); ++i) order[i] = i;
+	std::sort(order.begin(), order.end(), [this](unsigned a, unsigned b)
+			{ return runs[a].offset < runs[b].offset; });
+	// Each run moves towards the start, so copying front to back
+	// never overwrites regions still to be copied
+	std::vector<trajRegion> moving;
+	moving.reserve(runBuffer);
+	fileEnd = 0;
+	for (auto i : order)
+	{
+		Run& r = runs[i];
+		unsigned long long from = r.offset;
+		r.offset = fileEnd;
+		for (unsigned long long done=0; done<r.remaining; )
+		{
+			unsigned long long count = std::min(r.remaining-done,
+					static_cast<unsigned long long>(runBuffer));
+			moving.resize(count);
+			read(moving.data(), from+done, count);
+			write(moving.data(), count);
+			done += count;
+		}
+	}
+	compactions++;
+}
+
+void RegionQueue::addRun(unsigned long long offset,
+		unsigned long long count, unsigned level)
+{
+	Run r;
+	r.offset = offset;
+	r.remaining = count;
+	r.level = level;
+	refill(r);
+	runs.push_back(std::move(r));
+	heads.push_back(runs.size()-1);
+	std::push_heap(heads.begin(), heads.end(),
+			[this](unsigned a, unsigned b) { return headLessLikely(a, b); });
+}
+
+bool RegionQueue::advance(Run& r)
+{
+	// Step to the run's next region, false once it is used up
+	if (++r.position < r.buffer.size()) return true;
+	if (r.remaining == 0) return false;
+	refill(r);
+	return true;
+}
+
+void RegionQueue::refill(Run& r)
+{
+	unsigned count = std::min(r.remaining,
+			static_cast<unsigned long long>(runBuffer));
+	r.buffer.resize(count);
+	read(r.buffer.data(), r.offset, count);
+	r.offset += count;
+	r.remaining -= count;
+	r.position = 0;
+}
+
+void RegionQueue::read(trajRegion *regions, unsigned long long offset,
+		unsigned long long count)
+{
+	if (std::fseek(file, static_cast<long>(offset*sizeof(trajRegion)), SEEK_SET) != 0 ||
+			std::fread(regions, sizeof(trajRegion), count, file) != count)
+		throw std::runtime_error("Failed reading region search frontier from disk");
+}
+
+void RegionQueue::write(const trajRegion *regions, unsigned long long count)
+{
+	if (std::fseek(file, static_cast<long>(fileEnd*sizeof(trajRegion)), SEEK_SET) != 0 ||
+			std::fwrite(regions, sizeof(trajRegion), count, file) != count)
+		throw std::runtime_error("Failed writing region search frontier to disk");
+	fileEnd += count;
+	filePeak = std::max(filePeak, fileEnd);
+}
+
+} /* namespace kbmod */
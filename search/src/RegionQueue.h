@@ -0,0 +1,94 @@
+/*
+ * RegionQueue.h
+ *
+ *  Created on: Oct 18, 2026
+ *      Author: kbmod-usr
+ *
+ * Max-priority queue of search regions with a memory budget.
+ * When the in memory heap fills up its less likely half is
+ * appended to a temporary file as a sorted run. Runs are read
+ * back a buffer at a time, and only when their head becomes
+ * the most likely region in the queue. Runs are merged as they
+ * pile up, so only a few are open at once and their buffers fit
+ * in the budget. Space freed by reading and merging runs is reclaimed
+ * by moving the regions still on disk to the start of the file.
+ */
+
+#ifndef REGIONQUEUE_H_
+#define REGIONQUEUE_H_
+
+#include <vector>
+#include <algorithm>
+#include <cstdio>
+#include <cfloat>
+#include <assert.h>
+#include <stdexcept>
+#include "common.h"
+
+namespace kbmod {
+
+class RegionQueue {
+public:
+	RegionQueue(unsigned long long memoryBudget);
+	RegionQueue(const RegionQueue&) = delete;
+	RegionQueue& operator=(const RegionQueue&) = delete;
+	virtual ~RegionQueue();
+	void push(const trajRegion& t);
+	const trajRegion& top();
+	void pop();
+	bool empty();
+	unsigned long long size();
+	unsigned long long spilledCount() { return spilled; }
+	unsigned runCount() { return runs.size(); }
+	unsigned long long mergeCount() { return merges; }
+	unsigned long long compactionCount() { return compactions; }
+	// Largest size the file reached, in regions
+	unsigned long long filePeakCount() { return filePeak; }
+private:
+	struct Run {
+		// Regions still on disk start at offset, in regions
+		unsigned long long offset;
+		unsigned long long remaining;
+		std::vector<trajRegion> buffer;
+		unsigned position;
+		// Merges the run's regions have been through
+		unsigned level;
+		const trajRegion& head() const { return buffer[position]; }
+	};
+	void spill();
+	void mergeRuns();
+	void merge(std::vector<unsigned> merging);
+	void compact();
+	void addRun(unsigned long long offset, unsigned long long count,
+			unsigned level);
+	unsigned long long regionsLeft(const Run& r)
+			{ return r.remaining+r.buffer.size()-r.position; }
+	bool advance(Run& r);
+	void refill(Run& r);
+	void read(trajRegion *regions, unsigned long long offset,
+			unsigned long long count);
+	void write(const trajRegion *regions, unsigned long long count);
+	bool runBeforeHeap();
+	static bool lessLikely(const trajRegion& a, const trajRegion& b)
+			{ return a.likelihood < b.likelihood; }
+	bool headLessLikely(unsigned a, unsigned b)
+			{ return lessLikely(runs[a].head(), runs[b].head()); }
+	std::vector<trajRegion> heap;
+	std::vector<Run> runs;
+	// Heap of indices into runs ordered by their heads
+	std::vector<unsigned> heads;
+	std::FILE *file;
+	// End of the data written to file, in regions
+	unsigned long long fileEnd;
+	unsigned long long filePeak;
+	unsigned long long heapCapacity;
+	unsigned runBuffer;
+	unsigned long long spilled;
+	unsigned long long onDisk;
+	unsigned long long merges;
+	unsigned long long compactions;
+};
+
+} /* namespace kbmod */
+
+#endif /* REGIONQUEUE_H_ */
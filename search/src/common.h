@@ -8,6 +8,8 @@
 #ifndef COMMON_H_
 #define COMMON_H_
 
+#include <vector>
+#include <cstdint>
 //#include "PointSpreadFunc.h"
 
 namespace kbmod {
@@ -16,7 +18,28 @@ constexpr unsigned int MAX_KERNEL_RADIUS = 15;
 constexpr unsigned short CONV_THREAD_DIM = 32;
 constexpr unsigned short POOL_THREAD_DIM = 32;
 enum pool_method {POOL_MIN, POOL_MAX};
+enum template_method {TEMPLATE_MEAN, TEMPLATE_MEDIAN, TEMPLATE_CLIPPED_MEAN};
+enum coadd_method {COADD_SUM, COADD_MEAN, COADD_MEDIAN, COADD_WEIGHTED};
+constexpr unsigned TEMPLATE_BLOCK_PIXELS = 256;
+constexpr int TEMPLATE_CLIP_ITERATIONS = 5;
 constexpr int REGION_RESOLUTION = 4;
+// Region bounds are answered from windows of 2^REGION_INDEX_ORDER
+// pooled pixels, so at most 4 lookups are needed per bound
+constexpr int REGION_INDEX_ORDER = 2;
+// Regions expanded together by a region search by default. Fixed rather
+// than scaled by the thread count so results do not depend on the machine
+constexpr unsigned REGION_BATCH_SIZE = 128;
+// Bytes of frontier kept in memory before spilling to disk
+constexpr unsigned long long REGION_FRONTIER_BUDGET = 2147483648ULL;
+// Regions read back from a spilled run at a time, fewer when
+// the frontier budget can't hold a buffer this size for every run
+constexpr unsigned REGION_RUN_BUFFER = 4096;
+// Spilled runs of the same level merged into one run of the next
+constexpr unsigned REGION_MERGE_WAYS = 4;
+// Most spilled runs open at once, the smallest are merged beyond it
+constexpr unsigned REGION_MAX_RUNS = 32;
+// Tiles a region search copies before masking are 2^order pixels wide
+constexpr int OVERLAY_TILE_ORDER = 5;
 constexpr unsigned short THREAD_DIM_X = 256;
 constexpr unsigned short THREAD_DIM_Y = 2;
 constexpr unsigned short RESULTS_PER_PIXEL = 4;
@@ -42,6 +65,46 @@ struct trajectory {
 	short obsCount;
 };
 
+/*
+ * Counter based random numbers for simulated images. The value for a
+ * key and counter does not depend on the order values are drawn in,
+ * so pixels can be filled by any number of threads.
+ */
+inline uint64_t splitMix64(uint64_t x)
+{
+	x += 0x9E3779B97F4A7C15ULL;
+	x = (x ^ (x >> 30)) * 0xBF58476D1CE4E5B9ULL;
+	x = (x ^ (x >> 27)) * 0x94D049BB133111EBULL;
+	return x ^ (x >> 31);
+}
+
+// Uniform in [0, 1)
+inline double counterUniform(uint64_t key, uint64_t counter)
+{
+	return (splitMix64(key+counter) >> 11)*(1.0/9007199254740992.0);
+}
+
+/*
+ * Settings of a simulated image stack, see ImageStack::synthetic
+ */
+struct syntheticParams {
+	int width;
+	int height;
+	// Capture time of each image
+	std::vector<float> times;
+	float noiseStDev;
+	float pixelVariance;
+	// Constant level added to every science pixel
+	float background;
+	// Static stars, with fluxes uniform in [0.5, 1.5]*starFlux
+	int starCount;
+	float starFlux;
+	// Fraction of pixels of each image flagged as bad in the mask
+	float badPixelFraction;
+	int badPixelFlag;
+	unsigned long seed;
+};
+
 // Trajectory used for searching max-pooled images
 struct trajRegion {
 	float ix;
@@ -54,6 +117,16 @@ struct trajRegion {
 	float flux;
 };
 
+/*
+ * Disc of velocities a region search covers, the radius
+ * is in pixels of displacement by the last image
+ */
+struct velocityDisc {
+	float xVel;
+	float yVel;
+	float radius;
+};
+
 } /* namespace kbmod */
 
 #endif /* COMMON_H_ */
@@ -280,7 +280,7 @@ __global__ void searchImages(int trajectoryCount, int width, int height,
 extern "C" void
 deviceSearch(int trajCount, int imageCount, int minObservations, int psiPhiSize,
 			 int resultsCount, trajectory *trajectoriesToSearch, trajectory *bestTrajects,
-			 float *imageTimes, float *interleavedPsiPhi, int width, int height)
+			 const float *imageTimes, float *interleavedPsiPhi, int width, int height)
 {
 	// Allocate Device memory
 	trajectory *deviceTests;
@@ -10,21 +10,11 @@ def setup_search(path, tfile):
     print("Done.")
     psf = kb.psf(params['psf_sigma'])
     print("Generating images... ", end="", flush=True)
-    imgs = []
-    for i in range(params['img_count']):
-        time = i/(params['img_count']-1)
-        im = kb.layered_image('img'+str(i), 
-            params['x_dim'],
-            params['y_dim'],
-            params['noise'],
-            params['noise']*params['noise'],
-            time)
-        for t in t_list:
-            im.add_object(t.x+time*t.x_v, t.y+time*t.y_v, t.flux, psf)
-        imgs.append(im)
-
-    stack = kb.image_stack(imgs)
-    del imgs
+    times = [i/(params['img_count']-1) for i in range(params['img_count'])]
+    stack = kb.synthetic_stack(params['x_dim'], params['y_dim'], times, psf,
+        noise=params['noise'], variance=params['noise']*params['noise'],
+        seed=params.get('seed', 0))
+    stack.inject(t_list, psf)
     search = kb.stack_search(stack, psf)
     search.set_debug(True)
     del stack
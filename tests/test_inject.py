@@ -0,0 +1,48 @@
+import unittest
+import numpy as np
+from kbmodpy import kbmod as kb
+
+class test_inject(unittest.TestCase):
+
+   def setUp(self):
+      self.p = kb.psf(1.2)
+      self.trajs = np.zeros(3, dtype=kb.trajectory_dtype)
+      self.trajs['x'] = [10, 30, 2]
+      self.trajs['y'] = [12, 5, 40]
+      self.trajs['x_v'] = [20.5, -8.25, 3.0]
+      self.trajs['y_v'] = [14.0, 16.5, -30.0]
+      self.trajs['flux'] = [250.0, 120.0, 90.0]
+
+   def images(self):
+      return [kb.layered_image(str(i), 50, 45, 0.0, 1.0, i/4)
+              for i in range(5)]
+
+   def test_matches_add_object(self):
+      expected = self.images()
+      for i, im in enumerate(expected):
+         time = i/4
+         for t in self.trajs:
+            im.add_object(t['x']+time*t['x_v'], t['y']+time*t['y_v'],
+                          t['flux'], self.p)
+      stack = kb.image_stack(self.images())
+      stack.inject(self.trajs, self.p)
+      for im, ex in zip(stack.get_images(), expected):
+         np.testing.assert_allclose(np.array(im.science()),
+            np.array(ex.science()), rtol=1e-5, atol=1e-4)
+      # Lists of trajectories work too
+      again = kb.image_stack(self.images())
+      again.inject(kb.array_to_trajectories(self.trajs), self.p)
+      for im, ex in zip(again.get_images(), stack.get_images()):
+         np.testing.assert_array_equal(np.array(im.science()),
+            np.array(ex.science()))
+
+   def test_flux_conserved(self):
+      stack = kb.image_stack(self.images())
+      stack.inject(self.trajs[:1], self.p)
+      # The first object stays well inside every image
+      for im in stack.get_images():
+         self.assertAlmostEqual(np.array(im.science()).sum()/250.0,
+            np.array(self.p).sum(), places=4)
+
+if __name__ == '__main__':
+   unittest.main()
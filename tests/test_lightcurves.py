@@ -0,0 +1,144 @@
+import unittest
+import numpy as np
+from kbmodpy import kbmod as kb
+
+class test_lightcurves(unittest.TestCase):
+
+   def setUp(self):
+      p = kb.psf(1.0)
+      imgs = []
+      for i in range(8):
+         time = i/8
+         im = kb.layered_image(str(i), 64, 48, 4.0, 16.0, time)
+         im.add_object(10+time*20.0, 12+time*15.0, 200.0, p)
+         imgs.append(im)
+      self.search = kb.stack_search(kb.image_stack(imgs), p)
+      self.search.gpu(10, 10, 0.0, 1.5, 5.0, 40.0, 4)
+
+   def test_matches_single_curves(self):
+      results = self.search.get_results(0, 50)
+      arr = self.search.get_results_array(0, 50)
+      self.assertEqual(arr.dtype, kb.trajectory_dtype)
+      self.assertEqual(len(arr), 50)
+      psi, phi = self.search.psi_phi_curves(arr)
+      self.assertEqual(psi.shape, (50, 8))
+      self.assertEqual(phi.shape, (50, 8))
+      for i, t in enumerate(results):
+         self.assertEqual(arr[i]['x'], t.x)
+         self.assertEqual(arr[i]['lh'], np.float32(t.lh))
+         np.testing.assert_array_equal(psi[i], self.search.psi_curves(t))
+         np.testing.assert_array_equal(phi[i], self.search.phi_curves(t))
+
+   def test_off_image(self):
+      arr = np.zeros(1, dtype=kb.trajectory_dtype)
+      arr['x'] = 60
+      arr['x_v'] = 100.0
+      psi, phi = self.search.psi_phi_curves(arr)
+      # Pixels that leave the image read as zero
+      self.assertEqual(psi[0][-1], 0.0)
+      self.assertEqual(phi[0][-1], 0.0)
+      self.assertNotEqual(phi[0][0], 0.0)
+
+   def test_stamp_batches(self):
+      results = self.search.get_results(0, 20)
+      arr = kb.trajectories_to_array(results)
+      np.testing.assert_array_equal(arr, self.search.get_results_array(0, 20))
+      self.assertIs(kb.trajectories_to_array(arr), arr)
+      back = kb.array_to_trajectories(arr)
+      self.assertEqual([(t.x, t.y, t.lh) for t in back],
+                       [(t.x, t.y, t.lh) for t in results])
+      stamps = self.search.sci_stamps_batch(arr, 3)
+      coadds = self.search.stacked_sci_batch(arr, 3)
+      self.assertEqual(stamps.shape, (20, 8, 7, 7))
+      self.assertEqual(coadds.shape, (20, 7, 7))
+      for i, t in enumerate(results):
+         single = [np.array(s) for s in self.search.sci_stamps(t, 3)]
+         np.testing.assert_array_equal(stamps[i], single)
+         np.testing.assert_array_equal(coadds[i],
+            np.array(self.search.stacked_sci(t, 3)))
+      with self.assertRaises(RuntimeError):
+         self.search.stacked_sci_batch(arr, -1)
+
+   def test_coadd_modes(self):
+      results = self.search.get_results(0, 10)
+      arr = kb.trajectories_to_array(results)
+      epochs = np.zeros((10, 8), dtype=bool)
+      epochs[:, ::2] = True
+      epochs[3, :] = False
+      sums = self.search.coadd_stamps_batch(arr, 3, kb.coadd_sum, epochs)
+      means = self.search.coadd_stamps_batch(arr, 3, kb.coadd_mean, epochs)
+      medians = self.search.coadd_stamps_batch(arr, 3, kb.coadd_median, epochs)
+      weighted = self.search.coadd_stamps_batch(arr, 3, kb.coadd_weighted, epochs)
+      for i, t in enumerate(results):
+         single = np.array([np.array(s) for s in self.search.sci_stamps(t, 3)])
+         keep = single[epochs[i]]
+         if len(keep) == 0:
+            np.testing.assert_array_equal(sums[i], 0.0)
+            np.testing.assert_array_equal(medians[i], 0.0)
+            continue
+         np.testing.assert_allclose(sums[i], keep.sum(axis=0), rtol=1e-5, atol=1e-3)
+         np.testing.assert_allclose(means[i], keep.mean(axis=0), rtol=1e-5, atol=1e-3)
+         np.testing.assert_allclose(medians[i], np.median(keep, axis=0), rtol=1e-5)
+         # Constant variance weights every epoch equally
+         np.testing.assert_allclose(weighted[i], means[i], rtol=1e-5, atol=1e-3)
+      every = self.search.coadd_stamps_batch(arr, 3, kb.coadd_sum)
+      np.testing.assert_allclose(every,
+         self.search.sci_stamps_batch(arr, 3).sum(axis=1), rtol=1e-5, atol=1e-3)
+      with self.assertRaises(RuntimeError):
+         self.search.coadd_stamps_batch(arr, 3, 7)
+      with self.assertRaises(RuntimeError):
+         self.search.coadd_stamps_batch(arr, 3, kb.coadd_sum, epochs[:2])
+
+   def clipped_sigmaG(self, psi, phi, coeff, n_sigma=2):
+      # Same steps as PostProcess._clipped_sigmaG
+      masked_phi = np.copy(phi)
+      masked_phi[masked_phi==0] = 1e9
+      lh = psi/np.sqrt(masked_phi)
+      lower, median, upper = np.percentile(lh, [25, 50, 75])
+      n_sigmaG = n_sigma*(coeff*(upper-lower))
+      good = np.logical_and(lh > median-n_sigmaG, lh < median+n_sigmaG)
+      if not good.any() or (psi[good]==0).all():
+         return good, 0.0
+      return good, np.sum(psi[good])/np.sqrt(np.sum(phi[good]))
+
+   def test_sigmag_filter(self):
+      arr = self.search.get_results_array(0, 200)
+      psi, phi = self.search.psi_phi_curves(arr)
+      coeff = 0.7413
+      keep, lh = self.search.sigmag_filter(arr, 25, 75, coeff)
+      self.assertEqual(keep.shape, (200, 8))
+      self.assertEqual(keep.dtype, bool)
+      for i in range(200):
+         good, new_lh = self.clipped_sigmaG(psi[i], phi[i], coeff)
+         np.testing.assert_array_equal(keep[i], good)
+         self.assertAlmostEqual(lh[i], new_lh, delta=1e-4*max(1.0, abs(new_lh)))
+      with self.assertRaises(RuntimeError):
+         self.search.sigmag_filter(arr, 75, 25, coeff)
+
+   def test_sigmag_filter_curves(self):
+      arr = self.search.get_results_array(0, 200)
+      psi, phi = self.search.psi_phi_curves(arr)
+      coeff = 0.7413
+      for flux in [False, True]:
+         keep, lh = self.search.sigmag_filter(arr, 25, 75, coeff, flux=flux)
+         # The same clipping on curves already read
+         curve_keep, curve_lh = self.search.sigmag_filter(
+            psi, phi, 25, 75, coeff, flux=flux)
+         np.testing.assert_array_equal(curve_keep, keep)
+         np.testing.assert_array_equal(curve_lh, lh)
+      # Curves that did not come from the images are clipped too
+      curve_keep, curve_lh = self.search.sigmag_filter(
+         psi[:, :5].astype(np.float64), phi[:, :5], 25, 75, coeff)
+      self.assertEqual(curve_keep.shape, (200, 5))
+      for i in range(200):
+         good, new_lh = self.clipped_sigmaG(psi[i, :5], phi[i, :5], coeff)
+         np.testing.assert_array_equal(curve_keep[i], good)
+         self.assertAlmostEqual(curve_lh[i], new_lh,
+            delta=1e-4*max(1.0, abs(new_lh)))
+      with self.assertRaises(RuntimeError):
+         self.search.sigmag_filter(psi, phi[:, :5], 25, 75, coeff)
+      with self.assertRaises(RuntimeError):
+         self.search.sigmag_filter(psi, phi, 75, 25, coeff)
+
+if __name__ == '__main__':
+   unittest.main()
@@ -1,4 +1,5 @@
 import unittest
+import math
 from kbmodpy import kbmod as kb
 import numpy as np
 
@@ -51,6 +52,84 @@ class test_pooling(unittest.TestCase):
       for _ in range(8):
          im = im.pool_max()
       self.assertAlmostEqual(np.array(im)[0][0], test_val, delta=0.001)
- 
+
+   def test_search_pyramid(self):
+      p = kb.psf(1.0)
+      imgs = []
+      for i in range(3):
+         im = kb.layered_image(str(i), 67, 45, 3.0, 9.0, i*0.1)
+         im.get_variance().set_pixel(10+i, 12, kb.no_data)
+         imgs.append(im)
+      search = kb.stack_search(kb.image_stack(imgs), p)
+      # nothing passes the likelihood threshold so the pyramids are
+      # left untouched by the search
+      search.region_search(10.0, 10.0, 5.0, 1e9, 1)
+      psi_pooled = search.get_psi_pooled()
+      phi_pooled = search.get_phi_pooled()
+      for i in range(3):
+         psi = search.get_psi_images()[i]
+         phi = search.get_phi_images()[i]
+         self.assertEqual(len(psi_pooled[i]), 8)
+         for depth in range(1, len(psi_pooled[i])):
+            psi = psi.pool_max()
+            phi = phi.pool_min()
+            np.testing.assert_array_equal(
+               np.array(psi_pooled[i][depth]), np.array(psi))
+            np.testing.assert_array_equal(
+               np.array(phi_pooled[i][depth]), np.array(phi))
+
+   def window_extreme(self, levels, x, y, size, pool_type):
+      # Read every pixel of the window the region search bounds with
+      x *= size
+      y *= size
+      lx = math.floor(x-size*0.5)
+      ly = math.floor(y-size*0.5)
+      hx = math.ceil(x+size*0.5)
+      hy = math.ceil(y+size*0.5)
+      upper = lambda v, d: -((-v) >> d)
+      depth = 0
+      while depth < len(levels)-1 and max(upper(hx, depth)-(lx >> depth),
+            upper(hy, depth)-(ly >> depth)) > 8:
+         depth += 1
+      pix = np.array(levels[depth])
+      ax, ay = max(lx >> depth, 0), max(ly >> depth, 0)
+      bx, by = max(upper(hx, depth), 0), max(upper(hy, depth), 0)
+      pix = pix[ay:by, ax:bx]
+      pix = pix[pix != kb.no_data]
+      if pix.size == 0:
+         return kb.no_data
+      extreme = pix.max() if pool_type == kb.pool_max else pix.min()
+      if abs(extreme) == np.finfo(np.float32).max:
+         return kb.no_data
+      return extreme
+
+   def test_indexed_extreme(self):
+      p = kb.psf(1.0)
+      stack = kb.synthetic_stack(67, 45, [0.0, 0.5], p, noise=3.0,
+         variance=9.0, bad_pixel_fraction=0.2, seed=5)
+      stack.apply_mask_flags(1, [])
+      search = kb.stack_search(stack, p)
+      psi_pooled = search.get_psi_pooled()
+      self.assertEqual(len(psi_pooled), 0)
+      search.indexed_extreme(0.0, 0.0, 1, 0, kb.pool_max)
+      pooled = {kb.pool_max: search.get_psi_pooled(),
+                kb.pool_min: search.get_phi_pooled()}
+      self.assertEqual(len(pooled[kb.pool_max][1]), 8)
+      for size in [1, 2, 4, 8, 16, 32, 128]:
+         # About 40 positions run past every edge of the image,
+         # odd eighths so every offset within a pixel is covered
+         step = 0.125*(int((70.0/size+3.0)/5.0) | 1)
+         steps = np.arange(-1.5, 70.0/size+1.5, step)
+         for x in steps:
+            for y in steps[steps < 48.0/size+1.5]:
+               for img in [0, 1]:
+                  for pool_type in [kb.pool_max, kb.pool_min]:
+                     self.assertEqual(
+                        search.indexed_extreme(x, y, size, img, pool_type),
+                        self.window_extreme(pooled[pool_type][img],
+                           x, y, size, pool_type), (x, y, size, img))
+      with self.assertRaises(RuntimeError):
+         search.indexed_extreme(0.0, 0.0, 1, 2, kb.pool_max)
+
 if __name__ == '__main__':
    unittest.main()
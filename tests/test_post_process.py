@@ -0,0 +1,56 @@
+import os
+import sys
+import unittest
+import numpy as np
+from kbmodpy import kbmod as kb
+sys.path.insert(0, os.path.join(
+   os.path.dirname(os.path.abspath(__file__)), '..', 'analysis'))
+from analysis_utils import PostProcess
+
+class test_post_process(unittest.TestCase):
+
+   def setUp(self):
+      p = kb.psf(1.0)
+      self.times = [i/8 for i in range(8)]
+      imgs = []
+      for time in self.times:
+         im = kb.layered_image(str(time), 64, 48, 4.0, 16.0, time)
+         im.add_object(10+time*20.0, 12+time*15.0, 200.0, p)
+         imgs.append(im)
+      self.search = kb.stack_search(kb.image_stack(imgs), p)
+      self.search.enable_nms(2.0, 4.0)
+      self.search.gpu(10, 10, 0.0, 1.5, 5.0, 40.0, 4)
+      self.image_params = {'mjd': np.array(self.times)}
+      self.post = PostProcess({'num_cores': 1, 'sigmaG_lims': [25, 75],
+                               'pool_type': 'thread'})
+      self.chunk_size = 500000
+
+   def tearDown(self):
+      self.post.shutdown()
+
+   def test_results_past_end(self):
+      count = len(self.search.get_results(0, self.chunk_size))
+      self.assertGreater(count, 0)
+      self.assertLess(count, self.chunk_size)
+      self.assertEqual(len(self.search.get_results_array(0, self.chunk_size)),
+                       count)
+      self.assertEqual(len(self.search.get_results(count, 10)), 0)
+      self.assertEqual(len(self.search.get_results_array(count+10, 10)), 0)
+      self.assertEqual(len(self.search.get_results(count-1, 10)), 1)
+
+   def test_load_results(self):
+      keep = self.post.load_results(self.search, self.image_params, -1e9,
+                                    chunk_size=self.chunk_size)
+      self.assertGreater(len(keep['results']), 0)
+      self.assertEqual(len(keep['results']), len(keep['psi_curves']))
+      self.assertLessEqual(len(keep['results']),
+         len(self.search.get_results(0, self.chunk_size)))
+
+   def test_stream_results(self):
+      keep = self.post.stream_results(self.search, self.image_params, -1e9,
+                                      chunk_size=self.chunk_size)
+      self.assertEqual(len(keep['results']), len(keep['stamps']))
+      self.assertEqual(len(keep['final_results']), len(keep['results']))
+
+if __name__ == '__main__':
+   unittest.main()
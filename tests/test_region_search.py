@@ -1,6 +1,33 @@
+import os
+import sys
+import resource
+import subprocess
 import unittest
+import threading
 from kbmodpy import kbmod as kb
 
+# Region search on a noise free stack, printing every result
+REGION_SEARCH = '''
+import sys
+import numpy as np
+from kbmodpy import kbmod as kb
+p = kb.psf(1.0)
+stack = kb.synthetic_stack(120, 100, [i/9 for i in range(10)], p,
+   noise=0.0, variance=1.0)
+objs = np.zeros(5, dtype=kb.trajectory_dtype)
+objs['x'] = [57, 61, 85, 105, 13]
+objs['y'] = [21, 75, 85, 29, 34]
+objs['x_v'] = [5.4, 29.7, 4.6, 13.0, -18.3]
+objs['y_v'] = [60.3, 43.1, 26.4, 63.1, 24.3]
+objs['flux'] = [95.0, 63.0, 90.0, 70.0, 76.0]
+stack.inject(objs, p)
+search = kb.stack_search(stack, p)
+if len(sys.argv) > 1:
+   search.set_region_batch_size(int(sys.argv[1]))
+res = search.region_search(10.0, 40.0, 60.0, 4.0, 3)
+print([(r.ix, r.iy, r.fx, r.fy, r.likelihood) for r in res])
+'''
+
 class test_multires(unittest.TestCase):
 
    def setUp(self):
@@ -33,5 +60,169 @@ class test_multires(unittest.TestCase):
       self.assertAlmostEqual(r.flux, self.flux, delta=60)
       #self.assertEqual(r.lh
 
+   def test_disc_union(self):
+      # A disc far from the object's velocity adds nothing
+      results = self.search.region_search_discs(
+         [(-40.0, 30.0, 10.0), (self.xv, self.yv, 10.0)], 12.0, 3)
+      r = results[0]
+      self.assertEqual(r.ix,136)
+      self.assertEqual(r.iy,103)
+      self.assertAlmostEqual(r.flux, self.flux, delta=60)
+
+   def test_velocity_polygon(self):
+      around = [(20.0, 10.0), (45.0, 12.0), (40.0, 35.0), (25.0, 30.0)]
+      results = self.search.region_search_polygon(around, 12.0, 3)
+      r = results[0]
+      self.assertEqual(r.ix,136)
+      self.assertEqual(r.iy,103)
+      elsewhere = [(-60.0, -60.0), (-30.0, -60.0), (-45.0, -30.0)]
+      results = self.search.region_search_polygon(elsewhere, 12.0, 3)
+      self.assertNotIn((136, 103), [(r.ix, r.iy) for r in results])
+      with self.assertRaises(RuntimeError):
+         self.search.region_search_polygon(around[:2], 12.0, 3)
+
+   def test_frontier_spill(self):
+      full = self.search.region_search(self.xv, self.yv, 
+         10.0, 12.0, 3)
+      # Room for only a few hundred regions in memory
+      self.search.set_frontier_budget(8192)
+      spilled = self.search.region_search(self.xv, self.yv, 
+         10.0, 12.0, 3)
+      self.assertEqual(len(spilled), len(full))
+      for a, b in zip(spilled, full):
+         self.assertEqual(a.ix, b.ix)
+         self.assertEqual(a.iy, b.iy)
+         self.assertAlmostEqual(a.likelihood, b.likelihood, delta=1e-4)
+
+   def test_many_spills(self):
+      full = self.search.region_search(self.xv, self.yv, 
+         10.0, 6.0, 3)
+      # Room for two regions, so nearly every push spills a run
+      self.search.set_frontier_budget(64)
+      soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+      # Far fewer open files than runs
+      resource.setrlimit(resource.RLIMIT_NOFILE, (min(soft, 64), hard))
+      try:
+         spilled = self.search.region_search(self.xv, self.yv, 
+            10.0, 6.0, 3)
+      finally:
+         resource.setrlimit(resource.RLIMIT_NOFILE, (soft, hard))
+      stats = self.search.get_stats()
+      self.assertGreater(stats['regions_spilled'], 500)
+      self.assertGreater(stats['spill_merges'], 100)
+      self.assertEqual(len(spilled), len(full))
+      for a, b in zip(spilled, full):
+         self.assertEqual(a.ix, b.ix)
+         self.assertEqual(a.iy, b.iy)
+         self.assertAlmostEqual(a.likelihood, b.likelihood, delta=1e-4)
+
+   def test_spill_file_size(self):
+      self.search.set_frontier_budget(64)
+      self.search.region_search(self.xv, self.yv, 10.0, 6.0, 3)
+      stats = self.search.get_stats()
+      self.assertGreater(stats['spill_merges'], 100)
+      self.assertGreater(stats['spill_compactions'], 0)
+      # Every spill and merge writes regions out, but the space of runs
+      # read back is reused, so the file stays smaller than the regions
+      # spilled rather than growing with every merge
+      self.assertGreater(stats['bytes_spill_file'], 0)
+      self.assertLess(stats['bytes_spill_file'],
+         kb.traj_region_dtype.itemsize*stats['regions_spilled'])
+
+   def test_array_results(self):
+      results = self.search.region_search(self.xv, self.yv, 
+         10.0, 12.0, 3)
+      arr = self.search.region_search_array(self.xv, self.yv, 
+         10.0, 12.0, 3)
+      self.assertEqual(arr.dtype, kb.traj_region_dtype)
+      # A view of the results, not a copy
+      self.assertFalse(arr.flags.owndata)
+      self.assertEqual(len(arr), len(results))
+      self.assertEqual(arr[0]['ix'], results[0].ix)
+      self.assertEqual(arr[0]['likelihood'], results[0].likelihood)
+      grid = kb.region_to_grid(arr, 0.9)
+      self.assertEqual(grid.dtype, kb.trajectory_dtype)
+      t = kb.region_to_grid(results, 0.9)[0]
+      self.assertEqual((grid[0]['x'], grid[0]['y']), (t.x, t.y))
+      self.assertEqual((grid[0]['x_v'], grid[0]['y_v']), (t.x_v, t.y_v))
+      back = kb.grid_to_region(grid, 0.9)
+      self.assertEqual(back.dtype, kb.traj_region_dtype)
+      r = kb.grid_to_region([t], 0.9)[0]
+      self.assertEqual((back[0]['fx'], back[0]['fy']), (r.fx, r.fy))
+
+   def test_pyramids_unchanged(self):
+      first = self.search.region_search(self.xv, self.yv, 
+         10.0, 12.0, 3)
+      level = self.search.get_psi_pooled()[0][0]
+      self.assertNotEqual(level.get_pixel(self.ix, self.iy), kb.no_data)
+      second = self.search.region_search(self.xv, self.yv, 
+         10.0, 12.0, 3)
+      self.assertEqual([(r.ix, r.iy) for r in first],
+                       [(r.ix, r.iy) for r in second])
+
+   def test_concurrent_searches(self):
+      expected = self.search.region_search(self.xv, self.yv, 
+         10.0, 12.0, 3)
+      results = [None]*3
+      def run(i):
+         results[i] = self.search.region_search(self.xv, self.yv, 
+            10.0, 12.0, 3)
+      threads = [threading.Thread(target=run, args=(i,)) for i in range(3)]
+      for t in threads:
+         t.start()
+      for t in threads:
+         t.join()
+      for res in results:
+         self.assertEqual([(r.ix, r.iy) for r in res],
+                          [(r.ix, r.iy) for r in expected])
+
+   def test_clear_during_search(self):
+      expected = self.search.region_search(self.xv, self.yv, 
+         10.0, 12.0, 3)
+      results = [None]*3
+      def run(i):
+         results[i] = self.search.region_search(self.xv, self.yv, 
+            10.0, 12.0, 3)
+      threads = [threading.Thread(target=run, args=(i,)) for i in range(3)]
+      for t in threads:
+         t.start()
+      # Waits for running searches before freeing the pyramids,
+      # later searches build them again
+      for _ in range(10):
+         self.search.clear_psi_phi()
+      for t in threads:
+         t.join()
+      for res in results:
+         self.assertEqual([(r.ix, r.iy) for r in res],
+                          [(r.ix, r.iy) for r in expected])
+
+class test_thread_count(unittest.TestCase):
+
+   def search_with_threads(self, threads, *args):
+      env = dict(os.environ, OMP_NUM_THREADS=str(threads))
+      return subprocess.check_output(
+         [sys.executable, '-c', REGION_SEARCH]+[str(a) for a in args],
+         env=env, universal_newlines=True)
+
+   def test_same_results(self):
+      # Regions are expanded in fixed size batches,
+      # however many threads share the work
+      single = self.search_with_threads(1)
+      self.assertEqual(len(eval(single)), 5)
+      for threads in [2, 8]:
+         self.assertEqual(self.search_with_threads(threads), single)
+
+   def test_batch_size(self):
+      # Regions that fall behind the queue are pushed back rather than
+      # expanded, so batches find what one region at a time does
+      single = self.search_with_threads(2, 1)
+      self.assertEqual(len(eval(single)), 5)
+      for size in [7, 128]:
+         self.assertEqual(self.search_with_threads(2, size), single)
+      search = kb.stack_search(kb.image_stack(
+         [kb.layered_image('a', 8, 8, 0.0, 1.0, 0.0)]), kb.psf(1.0))
+      with self.assertRaises(RuntimeError):
+         search.set_region_batch_size(0)
+
 if __name__ == '__main__':
    unittest.main()
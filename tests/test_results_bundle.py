@@ -0,0 +1,83 @@
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+import numpy as np
+from kbmodpy import kbmod as kb
+sys.path.insert(0, os.path.join(
+   os.path.dirname(os.path.abspath(__file__)), '..', 'analysis'))
+from analysis_utils import Interface
+from create_stamps import create_stamps
+
+class test_results_bundle(unittest.TestCase):
+
+   def setUp(self):
+      self.dir = tempfile.mkdtemp()
+      self.path = os.path.join(self.dir, 'results_test.npz')
+      self.loader = create_stamps()
+
+   def tearDown(self):
+      shutil.rmtree(self.dir)
+
+   def make_keep(self, count, final_results):
+      keep = Interface().gen_results_dict()
+      for i in range(count):
+         t = kb.trajectory()
+         t.lh, t.flux, t.obs_count = 10.0+i, 100.0+i, 5+i
+         t.x, t.y, t.x_v, t.y_v = i, 2*i, 1.5*i, -0.5*i
+         keep['results'].append(t)
+         # Rows of every length from 2 to 4
+         n = i%3+2
+         keep['lc'].append(np.arange(n, dtype=float)+i)
+         keep['lc_index'].append(np.arange(n)+i)
+         keep['times'].append(np.linspace(0.0, 1.0, n)+i)
+         keep['psi_curves'].append(np.full(6, float(i)))
+         keep['phi_curves'].append(np.full(6, i+1.0))
+         keep['new_lh'].append(20.0+i)
+         keep['stamps'].append(np.arange(9.0).reshape(3, 3)+i+1)
+      keep['final_results'] = final_results
+      keep['all_stamps'] = [np.full((4, 3, 3), float(i)) for i in final_results]
+      Interface().save_results(self.dir, 'test', keep)
+      return keep
+
+   def check(self, count, final_results):
+      keep = self.make_keep(count, final_results)
+      results = self.loader.load_results(self.path)
+      self.assertEqual(len(results), len(final_results))
+      self.assertEqual(list(results['x']), list(final_results))
+      self.assertEqual(list(results['lh']), [10.0+i for i in final_results])
+      self.assertEqual(list(results['num_obs']), [5+i for i in final_results])
+      lc, lc_index = self.loader.load_lightcurves(self.path)
+      psi, phi, psi_index = self.loader.load_psi_phi(self.path)
+      times = self.loader.load_times(self.path)
+      stamps = self.loader.load_stamps(self.path)
+      for rows, key in [(lc, 'lc'), (lc_index, 'lc_index'),
+                        (psi_index, 'lc_index'), (times, 'times'),
+                        (psi, 'psi_curves'), (phi, 'phi_curves')]:
+         self.assertEqual(len(rows), len(final_results))
+         for row, i in zip(rows, final_results):
+            np.testing.assert_array_equal(row, keep[key][i])
+      self.assertEqual(len(stamps), len(final_results))
+      for row, i in zip(stamps, final_results):
+         expected = keep['stamps'][i].flatten()
+         np.testing.assert_allclose(row, expected/expected.sum())
+      bundle = self.loader.load_bundle(self.path)
+      np.testing.assert_array_equal(bundle['filtered_likes'],
+         [20.0+i for i in final_results])
+      if len(final_results) > 0:
+         np.testing.assert_array_equal(bundle['all_ps'], keep['all_stamps'])
+
+   def test_reordered(self):
+      self.check(7, [5, 0, 3, 6, 1])
+
+   def test_single(self):
+      self.check(7, [4])
+      self.check(1, [0])
+
+   def test_empty(self):
+      self.check(7, [])
+      self.check(0, [])
+
+if __name__ == '__main__':
+   unittest.main()
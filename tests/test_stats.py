@@ -0,0 +1,79 @@
+import unittest
+import threading
+from kbmodpy import kbmod as kb
+
+class test_stats(unittest.TestCase):
+
+   def setUp(self):
+      p = kb.psf(1.0)
+      imgs = []
+      for i in range(8):
+         time = i/8
+         im = kb.layered_image(str(i), 64, 48, 4.0, 16.0, time)
+         im.add_object(10+time*20.0, 12+time*15.0, 200.0, p)
+         imgs.append(im)
+      self.search = kb.stack_search(kb.image_stack(imgs), p)
+
+   def test_grid_stats(self):
+      self.search.gpu(10, 10, 0.0, 1.5, 5.0, 40.0, 4)
+      stats = self.search.get_stats()
+      for stage in ['psi_phi', 'convolve', 'interleave',
+                    'grid_search', 'sort']:
+         self.assertGreaterEqual(stats['time_'+stage], 0.0)
+      self.assertEqual(stats['grid_trajectories'], 100*64*48)
+      self.assertGreater(stats['grid_trajectories_per_second'], 0.0)
+      self.assertEqual(stats['bytes_psi_phi'], 2*4*8*64*48)
+      self.assertGreaterEqual(stats['bytes_allocated'],
+         stats['bytes_psi_phi']+stats['bytes_results'])
+      self.assertNotIn('time_region_search', stats)
+
+   def test_nms(self):
+      self.search.gpu(10, 10, 0.0, 1.5, 5.0, 40.0, 4)
+      all_results = self.search.get_results(0, 100)
+      self.search.enable_nms(2.0, 4.0)
+      self.search.gpu(10, 10, 0.0, 1.5, 5.0, 40.0, 4)
+      stats = self.search.get_stats()
+      self.assertGreater(stats['results_suppressed'], 0)
+      self.assertGreaterEqual(stats['time_nms'], 0.0)
+      kept = self.search.get_results(0, 100)
+      self.assertEqual(kept[0].lh, all_results[0].lh)
+      for i in range(len(kept)):
+         for j in range(i):
+            self.assertFalse(abs(kept[i].x-kept[j].x) <= 2 and
+                             abs(kept[i].y-kept[j].y) <= 2 and
+                             abs(kept[i].x_v-kept[j].x_v) <= 4.0 and
+                             abs(kept[i].y_v-kept[j].y_v) <= 4.0)
+      with self.assertRaises(RuntimeError):
+         self.search.enable_nms(-1.0, 1.0)
+
+   def test_region_stats(self):
+      self.search.region_search(20.0, 15.0, 5.0, 10.0, 4)
+      stats = self.search.get_stats()
+      self.assertGreaterEqual(stats['time_pooling'], 0.0)
+      self.assertGreater(stats['time_region_search'], 0.0)
+      self.assertGreater(stats['nodes_processed'], 0)
+      self.assertEqual(stats['region_nodes'], stats['nodes_processed'])
+      self.assertGreater(stats['pixels_read'], 0)
+      self.assertGreater(stats['bytes_pyramids'], 0)
+      self.search.region_search(20.0, 15.0, 5.0, 10.0, 4)
+      again = self.search.get_stats()
+      self.assertEqual(again['nodes_processed'], 2*stats['nodes_processed'])
+
+   def test_concurrent_region_stats(self):
+      threads = [threading.Thread(target=self.search.region_search,
+         args=(20.0, 15.0, 5.0, 10.0, 4)) for _ in range(3)]
+      for t in threads:
+         t.start()
+      for t in threads:
+         t.join()
+      stats = self.search.get_stats()
+      self.assertEqual(stats['region_searches'], 3)
+      # Each search covers the same nodes, and the
+      # time and rate reported come from one of them
+      self.assertEqual(3*stats['region_nodes'], stats['nodes_processed'])
+      self.assertAlmostEqual(
+         stats['region_nodes_per_second']*stats['time_region_search'],
+         stats['region_nodes'], delta=1e-6*stats['region_nodes'])
+
+if __name__ == '__main__':
+   unittest.main()
@@ -0,0 +1,49 @@
+import unittest
+import numpy as np
+from kbmodpy import kbmod as kb
+
+class test_synthetic(unittest.TestCase):
+
+   def setUp(self):
+      self.p = kb.psf(1.0)
+      self.times = [i/9 for i in range(10)]
+
+   def make(self, seed, **kwargs):
+      return kb.synthetic_stack(60, 50, self.times, self.p, noise=4.0,
+         variance=16.0, seed=seed, **kwargs)
+
+   def sciences(self, stack):
+      return np.array([np.array(im.science()) for im in stack.get_images()])
+
+   def test_reproducible(self):
+      first = self.sciences(self.make(3, star_count=5, star_flux=500.0))
+      again = self.sciences(self.make(3, star_count=5, star_flux=500.0))
+      other = self.sciences(self.make(4, star_count=5, star_flux=500.0))
+      np.testing.assert_array_equal(first, again)
+      self.assertFalse(np.array_equal(first, other))
+      # Every image has its own noise
+      self.assertFalse(np.array_equal(first[0], first[1]))
+      one = kb.layered_image('a', 60, 50, 4.0, 16.0, 0.0, 9)
+      two = kb.layered_image('a', 60, 50, 4.0, 16.0, 0.0, 9)
+      np.testing.assert_array_equal(np.array(one.science()),
+         np.array(two.science()))
+
+   def test_layers(self):
+      stack = self.make(1, background=100.0, star_count=3, star_flux=800.0,
+         bad_pixel_fraction=0.1, bad_pixel_flag=4)
+      self.assertEqual(len(stack.get_images()), 10)
+      np.testing.assert_allclose(stack.get_times(), self.times, atol=1e-6)
+      sci = self.sciences(stack)
+      self.assertAlmostEqual(np.median(sci), 100.0, delta=2.0)
+      # Stars stay still, so the median of the stack keeps them
+      stars = np.median(sci, axis=0)-100.0
+      self.assertGreater(stars.max(), 50.0)
+      np.testing.assert_allclose(np.std(sci-stars-100.0), 4.0, rtol=0.1)
+      masks = np.array([np.array(im.mask()) for im in stack.get_images()])
+      self.assertTrue(np.isin(masks, [0.0, 4.0]).all())
+      self.assertAlmostEqual((masks == 4.0).mean(), 0.1, delta=0.02)
+      var = np.array([np.array(im.variance()) for im in stack.get_images()])
+      self.assertTrue((var == 16.0).all())
+
+if __name__ == '__main__':
+   unittest.main()
@@ -0,0 +1,52 @@
+import unittest
+import numpy as np
+from kbmodpy import kbmod as kb
+
+class test_template(unittest.TestCase):
+
+   def setUp(self):
+      self.im_count = 7
+      self.width = 37
+      self.height = 23
+      self.values = [1.0, 2.0, 3.0, 4.0, 5.0, 6.0, 100.0]
+      self.images = []
+      for i in range(self.im_count):
+         im = kb.layered_image(str(i), self.width, self.height, 
+            0.0, 1.0, i)
+         sci = np.full((self.height, self.width), 
+            self.values[i], dtype=np.float32)
+         # a pixel masked in all but two images
+         if i > 1:
+            sci[5][9] = kb.no_data
+         im.set_science(kb.raw_image(sci))
+         self.images.append(im)
+      self.stack = kb.image_stack(self.images)
+
+   def test_mean(self):
+      self.stack.build_template(kb.template_mean, 0.0)
+      temp = np.array(self.stack.get_template())
+      self.assertAlmostEqual(temp[0][0], np.mean(self.values), delta=0.001)
+      self.assertAlmostEqual(temp[5][9], 1.5, delta=0.001)
+
+   def test_median(self):
+      self.stack.build_template(kb.template_median, 0.0)
+      temp = np.array(self.stack.get_template())
+      self.assertAlmostEqual(temp[0][0], 4.0, delta=0.001)
+      self.assertAlmostEqual(temp[22][36], 4.0, delta=0.001)
+      self.assertAlmostEqual(temp[5][9], 1.5, delta=0.001)
+
+   def test_clipped_mean(self):
+      self.stack.build_template(kb.template_clipped_mean, 2.0)
+      temp = np.array(self.stack.get_template())
+      self.assertAlmostEqual(temp[0][0], 3.5, delta=0.001)
+
+   def test_difference(self):
+      self.stack.template_difference(kb.template_median, 0.0)
+      sci = self.stack.sciences()
+      self.assertAlmostEqual(sci[0][0][0], -3.0, delta=0.001)
+      self.assertAlmostEqual(sci[6][10][10], 96.0, delta=0.001)
+      self.assertAlmostEqual(sci[1][5][9], 0.5, delta=0.001)
+      self.assertEqual(sci[2][5][9], kb.no_data)
+
+if __name__ == '__main__':
+   unittest.main()
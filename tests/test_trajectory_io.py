@@ -0,0 +1,78 @@
+import os
+import tempfile
+import unittest
+import numpy as np
+from kbmodpy import kbmod as kb
+
+class test_trajectory_io(unittest.TestCase):
+
+   def setUp(self):
+      self.arr = np.zeros(50, dtype=kb.trajectory_dtype)
+      self.arr['lh'] = np.linspace(1.0, 50.0, 50)
+      self.arr['flux'] = 300.0
+      self.arr['x'] = np.arange(50)*3
+      self.arr['y'] = np.arange(50)[::-1]
+      self.arr['x_v'] = np.linspace(-20.0, 20.0, 50)
+      self.arr['y_v'] = 7.25
+      self.arr['obs_count'] = 10
+      self.dir = tempfile.mkdtemp()
+      self.path = os.path.join(self.dir, 'results.traj')
+
+   def tearDown(self):
+      if os.path.exists(self.path):
+         os.remove(self.path)
+      os.rmdir(self.dir)
+
+   def test_binary(self):
+      kb.save_trajectories(self.arr, self.path)
+      loaded = kb.load_trajectories(self.path, as_array=True)
+      self.assertEqual(loaded.dtype, kb.trajectory_dtype)
+      np.testing.assert_array_equal(loaded, self.arr)
+      t_list = kb.load_trajectories(self.path)
+      self.assertEqual(len(t_list), 50)
+      self.assertEqual(t_list[10].x, 30)
+
+   def test_text(self):
+      t_list = kb.array_to_trajectories(self.arr)
+      kb.save_trajectories(t_list, self.path, text=True)
+      with open(self.path) as f:
+         lines = f.read().splitlines()
+      # Same as the legacy format
+      self.assertEqual(lines, [str(t) for t in t_list])
+      loaded = kb.load_trajectories(self.path, as_array=True)
+      # Text keeps six decimals
+      for name in loaded.dtype.names:
+         np.testing.assert_allclose(loaded[name], self.arr[name], atol=1e-6)
+
+   def test_legacy(self):
+      path = os.path.join(os.path.dirname(__file__), 'benchmark', 'many.traj')
+      t_list = kb.load_trajectories(path)
+      with open(path) as f:
+         first = f.readline().split()
+      self.assertEqual(len(t_list), 24)
+      self.assertEqual(t_list[0].x, int(first[5]))
+      self.assertAlmostEqual(t_list[0].x_v, float(first[9]), places=5)
+      self.assertAlmostEqual(t_list[0].flux, float(first[3]), places=5)
+
+   def test_matching(self):
+      tests = self.arr[[5, 20, 40]].copy()
+      results = self.arr[::-1].copy()
+      results['x'][9] += 2
+      # Close to the same test as the result before it
+      results[30] = results[29]
+      results['x'][30] += 1
+      before = results.copy()
+      matched, unmatched = kb.match_trajectory_indices(results, tests, 0.5, 1)
+      np.testing.assert_array_equal(matched, [29, 44])
+      np.testing.assert_array_equal(unmatched, [2])
+      np.testing.assert_array_equal(results, before)
+      t_list = kb.array_to_trajectories(tests)
+      m, u = kb.match_trajectories(kb.array_to_trajectories(results), t_list, 0.5, 1)
+      self.assertEqual([t.x for t in m], [results['x'][29], results['x'][44]])
+      self.assertEqual([t.x for t in u], [120])
+      self.assertTrue(all(t.obs_count == 10 for t in t_list))
+      # First matching result of each test, the last result when missed
+      self.assertEqual(kb.score_results(results, tests, 0.5, 1), (44+49+29)/3)
+
+if __name__ == '__main__':
+   unittest.main()